@@ -0,0 +1,427 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import itertools
+import json
+import os
+import platform
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+
+# Benchmarks the packet encoders/decoders of both sides and end-to-end loopback transfers
+# against a local server, and writes the results to a JSON baseline that a later run can be
+# compared with:
+#     python Benchmark.py --output before.json
+#     (change something)
+#     python Benchmark.py --output after.json --compare before.json
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_CLIENT_DIR = os.path.join(_ROOT, 'Client')
+_SERVER_DIR = os.path.join(_ROOT, 'Server')
+
+
+
+def load_module(name, path):
+    '''
+        This Method is used to load a module from a file under a name of our choosing,
+        so the Client's and the Server's EncoderDecoder can be loaded side by side.
+    '''
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def ops_per_second(function, repeat=3):
+    '''
+        Returns:
+            float: How many times per second function can be called (the best of repeat timings).
+    '''
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return max(number / elapsed for elapsed in timer.repeat(repeat, number))
+
+
+def run_micro_benchmarks():
+    '''
+        This Method is used to time the encoding and decoding of every packet type.
+        Returns:
+            results (dict): benchmark name -> operations (packets) per second.
+    '''
+    client = load_module('ClientEncoderDecoder', os.path.join(_CLIENT_DIR, 'EncoderDecoder.py'))
+    server = load_module('ServerEncoderDecoder', os.path.join(_SERVER_DIR, 'EncoderDecoder.py'))
+    payload_packet = server.create_payload_packet(1000, 7)
+    request_packet = client.create_request_packet(10**9)
+    extended_request = client.create_request_packet(10**9, rate_bps=10**8, duration_ms=10000, direction=2, adaptive=1)
+    offer_packet = server.create_offer_packet(2000, 2001, 5)
+    feedback_packet = client.create_feedback_packet(900, 1000)
+    factory = server.PayloadPacketFactory()
+    batch_size = factory.batch_size
+    benchmarks = {
+        'server.create_payload_packet': lambda: server.create_payload_packet(1000, 7),
+        'client.create_payload_packet': lambda: client.create_payload_packet(client.PAYLOAD_SIZE, 1000, 7),
+        'server.PayloadPacketFactory.packet': lambda: factory.packet(1000, 7),
+        'client.decode_payload_header': lambda: client.decode_payload_header(payload_packet, len(payload_packet)),
+        'client.is_payload_packet': lambda: client.is_payload_packet(payload_packet),
+        'client.create_request_packet': lambda: client.create_request_packet(10**9),
+        'server.decode_request_packet': lambda: server.decode_request_packet(request_packet),
+        'server.decode_request_packet (extended)': lambda: server.decode_request_packet(extended_request),
+        'server.decode_tcp_request': lambda: server.decode_tcp_request(b"1000000000 10000 2"),
+        'server.create_offer_packet': lambda: server.create_offer_packet(2000, 2001, 5),
+        'client.decode_offer_packet': lambda: client.decode_offer_packet(offer_packet),
+        'client.create_feedback_packet': lambda: client.create_feedback_packet(900, 1000),
+        'server.decode_feedback_packet': lambda: server.decode_feedback_packet(feedback_packet),
+    }
+    results = {}
+    for name, function in benchmarks.items():
+        results[name] = ops_per_second(function)
+        print(f"  {name}: {results[name]:,.0f} ops/second")
+    # a batch builds batch_size packets, so report packets per second
+    name = 'server.PayloadPacketFactory.batch (per packet)'
+    results[name] = ops_per_second(lambda: factory.batch(1000, 1, batch_size)) * batch_size
+    print(f"  {name}: {results[name]:,.0f} ops/second")
+    return results
+
+
+
+def free_port(kind):
+    '''
+        Returns:
+            int: A port that is free right now for the given socket kind (SOCK_STREAM or SOCK_DGRAM).
+    '''
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(server_args=(), timeout=10.0):
+    '''
+        This Method is used to start a local server process that doesn't broadcast offers.
+        Returns:
+            (process, udp_port, tcp_port) (tuple): the server's subprocess.Popen and its ports.
+        Raises:
+            Exception: If the server doesn't accept connections within timeout seconds.
+    '''
+    udp_port = free_port(socket.SOCK_DGRAM)
+    tcp_port = free_port(socket.SOCK_STREAM)
+    command = [sys.executable, 'Server.py', '--udp-port', str(udp_port), '--tcp-port', str(tcp_port), '--no-broadcast']
+    # in a process group of its own, so that its worker processes are stopped with it (see stop_server)
+    process = subprocess.Popen(command + list(server_args), cwd=_SERVER_DIR, start_new_session=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            # the server returns quietly from connections that close without a request
+            socket.create_connection(('127.0.0.1', tcp_port), timeout=0.5).close()
+            return process, udp_port, tcp_port
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    stop_server(process)
+    raise Exception("the benchmark server didn't start")
+
+
+def stop_server(process, timeout=10.0):
+    '''
+        This Method is used to terminate the server started by start_server, and every process it started,
+        and wait until all of them are gone. The ones still running after timeout seconds are killed.
+    '''
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    deadline = time.monotonic() + timeout
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        pass
+    while True:
+        try:
+            # signal 0 only checks whether anyone in the group is left
+            os.killpg(process.pid, signal.SIGKILL if time.monotonic() >= deadline else 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+    process.wait()
+
+
+def process_tree(pid):
+    '''
+        Returns:
+            pids (list): The process and all its descendants, e.g. a server's worker processes and
+                         their process pools (from /proc, Linux only: just pid elsewhere).
+    '''
+    pids = [pid]
+    for parent in pids:
+        try:
+            tasks = os.listdir(f"/proc/{parent}/task")
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                with open(f"/proc/{parent}/task/{task}/children") as children:
+                    pids.extend(int(child) for child in children.read().split())
+            except (OSError, ValueError):
+                pass
+    return pids
+
+
+def process_cpu_seconds(pid):
+    '''
+        Returns:
+            float: The user + system CPU time of a process so far, including its children that exited
+                   and were waited for (from /proc, Linux only), None if unknown.
+    '''
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # the fields after the command name, utime, stime, cutime and cstime are the 12th to 15th of them
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return sum(int(field) for field in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def process_peak_rss_kb(pid):
+    '''
+        Returns:
+            int: The peak resident set size of a process in KB (from /proc, Linux only), None if unknown.
+    '''
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def server_cpu_seconds(pid):
+    '''
+        Returns:
+            float: The CPU time of a server and all its processes so far (see process_cpu_seconds), None if unknown.
+    '''
+    seconds = [process_cpu_seconds(process) for process in process_tree(pid)]
+    if seconds[0] is None:
+        return None
+    return sum(value for value in seconds if value is not None)
+
+
+def server_peak_rss_kb(pid):
+    '''
+        Returns:
+            int: The sum of the peak RSS of a server and all its processes in KB, None if unknown.
+                 The processes may peak at different times, so this is an upper bound of the server's peak.
+    '''
+    peaks = [process_peak_rss_kb(process) for process in process_tree(pid)]
+    if peaks[0] is None:
+        return None
+    return sum(value for value in peaks if value is not None)
+
+
+def client_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_loopback_scenario(client, server, pid, protocol, file_size, connections, udp_rate_bps=0, payload_size=None):
+    '''
+        This Method is used to run one round of transfers against the local server and measure it.
+        Returns:
+            result (dict): The scenario's rates, loss, CPU times and peak RSS.
+    '''
+    tcp_connections = connections if protocol == 'TCP' else 0
+    udp_connections = connections if protocol == 'UDP' else 0
+    server_cpu = server_cpu_seconds(pid)
+    cpu = client_cpu_seconds()
+    start_time = time.perf_counter()
+    # the client prints a report per transfer, keep the benchmark's output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        records = client.run_round(server, file_size, tcp_connections, udp_connections, udp_rate_bps,
+                                   payload_size=payload_size or client.PAYLOAD_SIZE)
+    wall = time.perf_counter() - start_time
+    cpu = client_cpu_seconds() - cpu
+    server_cpu_after = server_cpu_seconds(pid)
+    errors = [record['error'] for record in records if record['error'] is not None]
+    total_bytes = sum(record['bytes_received'] or 0 for record in records)
+    losses = [record['loss_percent'] for record in records if record['loss_percent'] is not None]
+    return {
+        'protocol': protocol,
+        'file_size': file_size,
+        'payload_size': payload_size,
+        'connections': connections,
+        'wall_seconds': wall,
+        'bytes_per_second': total_bytes / wall,
+        # TCP has no packets of its own, the kernel segments the stream
+        'packets_per_second': total_bytes / payload_size / wall if protocol == 'UDP' else None,
+        'loss_percent': statistics.mean(losses) if losses else None,
+        'client_cpu_seconds': cpu,
+        'server_cpu_seconds': server_cpu_after - server_cpu if server_cpu is not None and server_cpu_after is not None else None,
+        # ru_maxrss is in KB on Linux, peaks are for the whole process so far (the server's summed over its processes)
+        'client_peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'server_peak_rss_kb': server_peak_rss_kb(pid),
+        'errors': len(errors),
+    }
+
+
+def run_loopback_benchmarks(sizes, connection_levels, protocols=('TCP', 'UDP'), repeat=3, udp_rate_bps=0, server_args=(),
+                            payload_sizes=(512,)):
+    '''
+        This Method is used to run every protocol x size x connections scenario against a local server,
+        and for UDP every payload size too.
+        Each scenario runs repeat times and the run with the median rate is kept.
+        Returns:
+            results (list): One result dict per scenario (see run_loopback_scenario).
+    '''
+    sys.path.insert(0, _CLIENT_DIR)
+    import Client as client
+    process, udp_port, tcp_port = start_server(server_args)
+    server = ('127.0.0.1', udp_port, tcp_port)
+    results = []
+    try:
+        for protocol in protocols:
+            for file_size, payload_size, connections in itertools.product(
+                    sizes, payload_sizes if protocol == 'UDP' else [None], connection_levels):
+                runs = [run_loopback_scenario(client, server, process.pid, protocol, file_size, connections, udp_rate_bps,
+                                              payload_size)
+                        for _ in range(repeat)]
+                runs.sort(key=lambda run: run['bytes_per_second'])
+                result = runs[len(runs) // 2]
+                results.append(result)
+                loss = f", loss {result['loss_percent']:.2f}%" if result['loss_percent'] is not None else ""
+                server_cpu = f"{result['server_cpu_seconds']:.3f} s" if result['server_cpu_seconds'] is not None else "unknown"
+                print(f"  {scenario_name(result)}: {result['bytes_per_second'] * 8:,.0f} bits/second{loss}, "
+                      f"client CPU {result['client_cpu_seconds']:.3f} s, server CPU {server_cpu}")
+    finally:
+        stop_server(process)
+    return results
+
+
+def run_session_benchmarks(tests=20, file_size=100, server_args=()):
+    '''
+        This Method is used to time repeated small tests on one persistent TCP connection, in every direction.
+        A test after the first should take about as long as the first one (the connection is already up),
+        a later test much slower than the first means small writes are held back (e.g. by Nagle's algorithm
+        waiting for a delayed ACK) and the result is marked stalled.
+        Returns:
+            results (list): One dict per direction: the first test's and the median later test's seconds, and stalled.
+    '''
+    sys.path.insert(0, _CLIENT_DIR)
+    import Client as client
+    process, _, tcp_port = start_server(server_args)
+    results = []
+    try:
+        for direction, name in enumerate(client.DIRECTION_NAMES):
+            session = client.TcpSession('127.0.0.1', tcp_port)
+            seconds = []
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for _ in range(tests):
+                        start_time = time.perf_counter()
+                        record = session.run_test(file_size, 1, direction=direction)
+                        seconds.append(time.perf_counter() - start_time)
+                        records = record if isinstance(record, list) else [record]
+                        if any(record['error'] is not None for record in records):
+                            raise Exception(records[0]['error'])
+            finally:
+                session.close()
+            later = statistics.median(seconds[1:])
+            # a few milliseconds of slack, a first test that happened to be quick shouldn't count
+            stalled = later > 2 * seconds[0] + 0.005
+            results.append({'direction': name, 'file_size': file_size, 'tests': tests,
+                            'first_seconds': seconds[0], 'later_seconds': later, 'stalled': stalled})
+            print(f"  TCP session {name} {file_size} bytes x {tests}: first {seconds[0] * 1000:.2f} ms, "
+                  f"later (median) {later * 1000:.2f} ms{' STALLED' if stalled else ''}")
+    finally:
+        stop_server(process)
+    return results
+
+
+def scenario_name(result):
+    payload = f" ({result['payload_size']} byte payloads)" if result.get('payload_size') else ""
+    return f"{result['protocol']} {result['file_size']} bytes{payload} x {result['connections']}"
+
+
+def scenario_key(result):
+    return (result['protocol'], result['file_size'], result.get('payload_size'), result['connections'])
+
+
+def compare(baseline, current):
+    '''
+        This Method is used to print the change of every metric from a previous baseline.
+    '''
+    print(f"\nCompared with the baseline of {baseline.get('created')}:")
+    for name, value in current['micro'].items():
+        old = baseline.get('micro', {}).get(name)
+        if old:
+            print(f"  {name}: {(value - old) * 100 / old:+.1f}%")
+    old_scenarios = {scenario_key(result): result for result in baseline.get('loopback', [])}
+    for result in current['loopback']:
+        old = old_scenarios.get(scenario_key(result))
+        if old is None:
+            continue
+        changes = []
+        for metric in ('bytes_per_second', 'client_cpu_seconds', 'server_cpu_seconds'):
+            if old.get(metric) and result.get(metric) is not None:
+                changes.append(f"{metric} {(result[metric] - old[metric]) * 100 / old[metric]:+.1f}%")
+        print(f"  {scenario_name(result)}: {', '.join(changes)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the packet codecs and loopback transfers, and records a baseline.")
+    parser.add_argument('--output', default='baseline.json', help="the baseline file to write (default: baseline.json)")
+    parser.add_argument('--compare', help="a previous baseline file to compare the results with")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000],
+                        help="file sizes in bytes of the loopback transfers (default: 1000000 10000000)")
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 4],
+                        help="numbers of concurrent connections of the loopback transfers (default: 1 4)")
+    parser.add_argument('--payload-sizes', type=int, nargs='+', default=[512],
+                        help="UDP payload sizes in bytes of the loopback transfers (default: 512)")
+    parser.add_argument('--protocols', choices=('TCP', 'UDP'), nargs='+', default=['TCP', 'UDP'])
+    parser.add_argument('--repeat', type=int, default=3, help="runs per loopback scenario, the median is kept (default: 3)")
+    parser.add_argument('--udp-rate', type=int, default=0, help="UDP target rate in bits/second (default: 0 = unlimited)")
+    parser.add_argument('--server-args', default='',
+                        help="extra arguments for the server, e.g. \"--engine asyncio\" (default: none)")
+    parser.add_argument('--skip-micro', action='store_true', help="don't run the encoder/decoder micro-benchmarks")
+    parser.add_argument('--skip-loopback', action='store_true', help="don't run the loopback transfers")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    current = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'server_args': args.server_args,
+        'micro': {},
+        'loopback': [],
+        'sessions': [],
+    }
+    if not args.skip_micro:
+        print("Encoder/decoder micro-benchmarks:")
+        current['micro'] = run_micro_benchmarks()
+    if not args.skip_loopback:
+        print("Loopback transfers:")
+        current['loopback'] = run_loopback_benchmarks(args.sizes, args.connections, args.protocols, args.repeat,
+                                                      args.udp_rate, args.server_args.split(), args.payload_sizes)
+        if 'TCP' in args.protocols:
+            print("Back-to-back tests on a persistent TCP connection:")
+            current['sessions'] = run_session_benchmarks(server_args=args.server_args.split())
+    with open(args.output, 'w') as output:
+        json.dump(current, output, indent=2)
+    print(f"\nWrote {args.output}")
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(json.load(baseline), current)
+    if any(result['stalled'] for result in current['sessions']):
+        sys.exit("\nBack-to-back tests on a persistent TCP connection stalled, see above")
@@ -1,12 +1,62 @@
+import argparse
+import itertools
 import socket
-import struct
 import threading
 import time
 from EncoderDecoder import create_request_packet
-from EncoderDecoder import is_payload_packet
+from EncoderDecoder import create_stop_packet
+from EncoderDecoder import decode_payload_header
+from EncoderDecoder import decode_report_packet
+from EncoderDecoder import create_feedback_packet
+from EncoderDecoder import create_tcp_request
+from EncoderDecoder import create_test_frame
+from EncoderDecoder import PayloadPacketFactory
+from EncoderDecoder import REPORT_PACKET_SIZE
+from EncoderDecoder import DIRECTION_DOWNLOAD
+from EncoderDecoder import DIRECTION_UPLOAD
+from EncoderDecoder import DIRECTION_BIDIRECTIONAL
+from EncoderDecoder import DIRECTION_NAMES
+from Helpers import send_pattern
+from Helpers import send_pattern_until
+from Helpers import receive_exactly
+from Helpers import send_blocks
+from Helpers import send_blocks_until
+from Helpers import receive_blocks
+from Helpers import send_packets
+from Helpers import send_batch
+from Helpers import enable_udp_gso
+from Helpers import get_path_mtu
+from Helpers import create_socket
+from Helpers import socket_tuning
+from Helpers import TUNING_PROFILES
+from Helpers import TCP_RECEIVE_SIZE
+from Pacer import TokenBucket
+from Receiver import UdpReceiver
+from Receiver import AdaptiveIdleTimeout
+from Receiver import RECEIVE_BUFFER_SIZE
+from SegmentTracker import SegmentTracker
+from Sampler import ThroughputSampler
+from Results import new_result
+from Results import summarize
+from Results import ResultsWriter
+from Results import latency_result
+from Latency import LatencyProbe
+from Latency import PROBE_INTERVAL
+from Latency import IDLE_PROBE_DURATION
 from EncoderDecoder import PAYLOAD_SIZE
+from EncoderDecoder import PAYLOAD_HEADER_SIZE
+from EncoderDecoder import MAX_PAYLOAD_SIZE
+from EncoderDecoder import decode_offer_packet
+from Discovery import OfferDiscovery
+from Discovery import SELECTION_STRATEGIES
 
 _OFFER_PORT = 13117
+# how long past its duration a time-bounded transfer may run before the client ends it
+_STOP_GRACE = 1.0
+# how often an adaptive UDP download reports what it received, in seconds
+_FEEDBACK_INTERVAL = 0.05
+# the most a paced UDP upload may send back to back, in bytes
+UDP_PACING_BURST = 64 * 1024
 
 class bcolors:
     HEADER = '\033[95m'
@@ -39,19 +89,12 @@ def listen_for_offer(offer_port):
             # !!! recvfrom is blocking so No Busy Waiting !!!
             # address format is (ip, port)
             data, address = udp_socket.recvfrom(1024)  # Receive one udp packet up to 1kB
-            try:
-                # '!I B H H' means: ! - network byte order, I - unsigned int (4 bytes), 
-                #                   B - unsigned char (1 byte), H - unsigned short (2 bytes)
-                offer = struct.unpack('!I B H H', data)
-                magic_cookie = offer[0] 
-                message_type = offer[1]
-                # Validate the magic cookie and message type
-                if not(magic_cookie == 0xabcddcba and message_type == 0x2):
-                    print(f"[ERROR] Invalid packet received from {address[0]}.")
-                else:
-                    return (address, offer)
-            except struct.error as e:
-                print(f"[ERROR] Error decoding packet from {address[0]}: {e}")
+            # validates the magic cookie and message type, accepts offers that carry the server's load
+            offer = decode_offer_packet(data)
+            if offer is None:
+                print(f"[ERROR] Invalid packet received from {address[0]}.")
+            else:
+                return (address, (0xabcddcba, 0x2, offer[0], offer[1]))
     except Exception as e:
         print(f"[ERROR] An error occurred: {e}")
     finally: # finally always runs before return. for cleanup.
@@ -59,118 +102,783 @@ def listen_for_offer(offer_port):
 
 
 
-def start_tcp_connection(server_ip, tcp_port, file_size, id):
+def start_tcp_connection(server_ip, tcp_port, file_size, id, report_intervals=False, duration=0,
+                         direction=DIRECTION_DOWNLOAD, profile='default'):
     """
-    Start a TCP connection to download the specified file size.
+    Start a TCP connection to download the specified file size,
+    or, when duration (seconds) is set, whatever the server streams in that much time.
+    direction turns it into an upload, where the client streams the data and the server reports
+    what it received, or into both at once.
+    report_intervals prints the rate of every sampling interval, not just the percentiles.
+    profile is the socket tuning profile (see Helpers.TUNING_PROFILES).
+    Returns the transfer's result record (see Results.new_result),
+    or the list of the download and upload records of a bidirectional transfer.
     """
     try:
-        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_socket = create_socket(socket.SOCK_STREAM, profile)
         tcp_socket.connect((server_ip, tcp_port))
+        results = run_tcp_test(tcp_socket, file_size, id, report_intervals, duration, direction)
+        add_tuning(results, tcp_socket, profile)
+        return results[0] if len(results) == 1 else results
+
+    except Exception as e:
+        print(f"Error in TCP connection #{id}: {e}")
+        return new_result('TCP', id, file_size, direction=DIRECTION_NAMES[direction], test_duration=duration or None,
+                          tuning=profile, error=str(e))
+    finally:
+        tcp_socket.close()
 
-        size_message = f"{file_size}\n".encode('utf-8') # bytes
-        tcp_socket.send(size_message)
-        bytes_received = 0
 
-        # to measure time, we use time.perf_counter() 
-        # which is designed for high resolution time measurements
-        start_time = time.perf_counter()
 
-        while bytes_received < file_size:
-            data = tcp_socket.recv(4096)  # Receive 4KB chunks
-            if not data:
-                raise Exception("Connection ERROR: No data received")
-            bytes_received += len(data)
+class TcpSession:
+    """
+    A persistent TCP connection to the server that runs test after test, each one started by a test
+    frame and its data sent in blocks (see EncoderDecoder), so a campaign connects once per TCP slot
+    instead of once per test, and later tests start on a connection whose window has already grown.
+    It connects on its first test, and again on the test after a failed one or after the server closed
+    the connection for being idle (between rounds longer apart than the server's SESSION_IDLE_TIMEOUT).
+    """
 
-        end_time = time.perf_counter()
+    def __init__(self, server_ip, tcp_port, profile='default'):
+        self.server_ip = server_ip
+        self.tcp_port = tcp_port
+        self.profile = profile
+        self.sock = None
+        self.tests = 0
 
-        total_time = end_time - start_time
-        total_speed_bps = file_size*8 // total_time
+    def run_test(self, file_size, id, report_intervals=False, duration=0, direction=DIRECTION_DOWNLOAD):
+        """
+        Run one test on the connection, the same as start_tcp_connection does on a connection of its own.
+        """
+        try:
+            if self.sock is not None and self.closed_by_server():
+                self.close()
+            if self.sock is None:
+                self.sock = create_socket(socket.SOCK_STREAM, self.profile)
+                self.sock.connect((self.server_ip, self.tcp_port))
+                # the test frame and the end block are small writes, don't let Nagle hold them back
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            results = run_tcp_test(self.sock, file_size, id, report_intervals, duration, direction, framed=True)
+            add_tuning(results, self.sock, self.profile)
+            self.tests += 1
+            return results[0] if len(results) == 1 else results
+        except Exception as e:
+            print(f"Error in TCP connection #{id}: {e}")
+            # the connection is left in the middle of a test, the next one starts over
+            self.close()
+            return new_result('TCP', id, file_size, direction=DIRECTION_NAMES[direction], test_duration=duration or None,
+                              tuning=self.profile, error=str(e))
 
-        print(f"TCP transfer #{id} finished, total time: {total_time:.6f} seconds, total speed: {total_speed_bps} bits/second")
+    def closed_by_server(self):
+        """
+        Whether the server closed the connection while it was idle, without waiting for anything.
+        """
+        # non-blocking, the timeout of the last test would make the peek wait for data
+        self.sock.setblocking(False)
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK) == b""
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
 
-    except Exception as e:
-        print(f"Error in TCP connection #{id}: {e}")
-    finally:
-        tcp_socket.close()
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
 
 
-def start_udp_communication(server_ip, udp_port, file_size, id):
+def run_tcp_test(tcp_socket, file_size, id, report_intervals=False, duration=0, direction=DIRECTION_DOWNLOAD,
+                 framed=False):
     """
-    Start a UDP connection to download the specified file size.
+    Run one test on a connected TCP socket (see start_tcp_connection).
+    framed runs it as the next test of a persistent connection (see TcpSession),
+    otherwise it is the only test of the connection and its upload ends the sending side.
+    Returns the list of the test's result records.
     """
-    try:
-        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    duration_ms = int(duration * 1000)
+    if framed:
+        # a stalled test fails instead of hanging the session, the server ends a timed test by itself
+        tcp_socket.settimeout(_STOP_GRACE if duration_ms else None)
+        tcp_socket.sendall(create_test_frame(0 if duration_ms else file_size, duration_ms, direction))
+        send_upload, receive_download = send_tcp_blocks, receive_tcp_blocks
+    else:
+        tcp_socket.send(create_tcp_request(0 if duration_ms else file_size, duration_ms, direction))
+        send_upload, receive_download = send_tcp_upload, receive_tcp_download
+    results = []
+    # the number of bytes uploaded, filled in by the upload (in its own thread for a bidirectional test)
+    upload = []
+    uploader = None
+    if direction == DIRECTION_BIDIRECTIONAL:
+        uploader = threading.Thread(target=lambda: upload.append(send_upload(tcp_socket, file_size, duration)),
+                                    daemon=True)
+        uploader.start()
+    elif direction == DIRECTION_UPLOAD:
+        upload.append(send_upload(tcp_socket, file_size, duration))
+    if direction == DIRECTION_UPLOAD:
+        # the server answers the end of the upload with its report
+        report = receive_exactly(tcp_socket, REPORT_PACKET_SIZE)
+    else:
+        # after the data of a bidirectional test the server sends its report of the upload
+        trailer = REPORT_PACKET_SIZE if direction == DIRECTION_BIDIRECTIONAL else 0
+        result, report = receive_download(tcp_socket, file_size, id, duration, report_intervals, trailer)
+        results.append(result)
+    if direction != DIRECTION_DOWNLOAD:
+        if uploader is not None:
+            uploader.join()
+        if framed and len(report) < REPORT_PACKET_SIZE:
+            raise ConnectionError("the server closed the connection before its report")
+        report = decode_report_packet(report, len(report)) if upload else None
+        results.append(upload_result('TCP', id, file_size, duration, report))
+    return results
 
-        # send size message
-        request_packet = create_request_packet(file_size)
-        udp_socket.sendto(request_packet, (server_ip, udp_port))
-        bytes_received = 0
 
-        # "The Client detects that the UDP transfer 
-        # concludes after no data has been received for 1 second."
-        udp_socket.settimeout(1)  
-        # to measure time, we use time.perf_counter() 
-        # which is designed for high resolution time measurements
-        start_time = time.perf_counter()
+def send_tcp_upload(tcp_socket, file_size, duration=0):
+    """
+    Stream file_size bytes (or, when duration is set, as much as possible for that many seconds)
+    to the server, then shut down the sending side so the server knows the upload is over.
+    Returns the number of bytes sent.
+    """
+    if duration:
+        sent = send_pattern_until(tcp_socket, time.perf_counter() + duration)
+    else:
+        send_pattern(tcp_socket, file_size)
+        sent = file_size
+    tcp_socket.shutdown(socket.SHUT_WR)
+    return sent
 
-        while bytes_received < file_size:
-            try:
-                data, address = udp_socket.recvfrom(1024)  # Receive one udp packet up to 1kB
-                if(is_payload_packet(data)):
-                    bytes_received += PAYLOAD_SIZE
-            except socket.timeout:
-                break
-        
-        end_time = time.perf_counter()
 
-        total_time = end_time - start_time
-        succ_rate = 100 if bytes_received >= file_size else bytes_received*100 / file_size
-        total_speed_bps = file_size*8*succ_rate // (total_time*100)
+def send_tcp_blocks(tcp_socket, file_size, duration=0):
+    """
+    Send the upload of a test on a persistent connection as data blocks, ending with the end block
+    so the connection stays open for the next test.
+    Returns the number of bytes sent.
+    """
+    if duration:
+        return send_blocks_until(tcp_socket, time.perf_counter() + duration)
+    send_blocks(tcp_socket, file_size)
+    return file_size
+
+
+def receive_tcp_download(tcp_socket, file_size, id, duration=0, report_intervals=False, trailer=0):
+    """
+    Receive the download of a TCP transfer and print its rates.
+    trailer is the number of bytes the server sends after the data (its upload report),
+    they are returned separately and not counted as download.
+    Returns a tuple (result record, trailer bytes).
+    """
+    bytes_received = 0
+    # the data is received into one large preallocated buffer and thrown away
+    buffer = memoryview(bytearray(TCP_RECEIVE_SIZE))
+    recv_into = tcp_socket.recv_into
+    # to measure time, we use time.perf_counter() 
+    # which is designed for high resolution time measurements
+    start_time = time.perf_counter()
+    sampler = ThroughputSampler(start_time)
+    tail = b""
+
+    if duration:
+        # the server closes the connection at its deadline, we stop by ourselves a bit later if it doesn't
+        deadline = start_time + duration + _STOP_GRACE
+        tcp_socket.settimeout(_STOP_GRACE)
+        try:
+            while time.perf_counter() < deadline:
+                nbytes = recv_into(buffer)
+                if not nbytes:
+                    break
+                bytes_received += nbytes
+                sampler.add(nbytes, time.perf_counter())
+                if trailer:
+                    # the length of the data is unknown, so the trailer is whatever comes last
+                    tail = (tail + buffer[max(0, nbytes - trailer):nbytes])[-trailer:]
+        except socket.timeout:
+            pass
+        bytes_received -= len(tail)
+        file_size = bytes_received
+    while bytes_received < file_size:
+        # never read past the data into the trailer
+        nbytes = recv_into(buffer, min(TCP_RECEIVE_SIZE, file_size - bytes_received))
+        if not nbytes:
+            raise Exception("Connection ERROR: No data received")
+        bytes_received += nbytes
+        sampler.add(nbytes, time.perf_counter())
+
+    end_time = time.perf_counter()
+    if trailer and not duration:
+        tail = receive_exactly(tcp_socket, trailer)
+    return download_result(id, file_size, duration, end_time - start_time, sampler, report_intervals), tail
+
+
+def receive_tcp_blocks(tcp_socket, file_size, id, duration=0, report_intervals=False, trailer=0):
+    """
+    Receive the download of a test on a persistent connection, its data blocks up to the end block,
+    and print its rates. The data blocks carry their length, so a timed download needs no deadline.
+    trailer is the number of bytes the server sends after the end block (its upload report).
+    Returns a tuple (result record, trailer bytes).
+    """
+    start_time = time.perf_counter()
+    sampler = ThroughputSampler(start_time)
+    bytes_received, tail = receive_blocks(tcp_socket, sampler)
+    end_time = time.perf_counter()
+    if len(tail) > trailer:
+        raise Exception("Connection ERROR: unexpected data after the download")
+    if trailer:
+        tail += receive_exactly(tcp_socket, trailer - len(tail))
+    return download_result(id, bytes_received, duration, end_time - start_time, sampler, report_intervals), tail
+
+
+def download_result(id, file_size, duration, total_time, sampler, report_intervals=False):
+    """
+    Print the rates of a TCP download of file_size bytes and turn it into the transfer's result record.
+    """
+    total_speed_bps = file_size*8 // total_time
+
+    print(f"TCP transfer #{id} finished, total time: {total_time:.6f} seconds, total speed: {total_speed_bps} bits/second")
+    print(sampler.report(f"TCP transfer #{id}", report_intervals))
+    return new_result('TCP', id, file_size, test_duration=duration or None, bytes_received=file_size,
+                      duration=total_time, bitrate_bps=total_speed_bps, loss_percent=0,
+                      interval=sampler.interval, interval_bytes=sampler.samples())
+
+
+def add_tuning(results, sock, profile):
+    """
+    Record the tuning profile and the kernel values the transfer's socket ended up with
+    (read after the transfer, so they include the kernel's buffer autotuning) in its result records.
+    """
+    tuning = socket_tuning(sock)
+    for result in results:
+        result.update(tuning, tuning=profile)
+
+
+def upload_result(protocol, id, file_size, duration, report, segments_sent=0, payload_size=None):
+    """
+    Print the server's report of an upload and turn it into the transfer's result record.
+    report is the decoded report packet (None if none arrived), segments_sent and payload_size
+    (UDP only) are what the loss is measured against and the size of the packets.
+    """
+    if report is None:
+        print(f"Error in {protocol} upload #{id}: the server didn't report the upload")
+        return new_result(protocol, id, file_size, direction='upload', test_duration=duration or None,
+                          payload_size=payload_size, error="no report from the server")
+    bytes_received, packets_received, duration_ns = report
+    total_time = duration_ns / 1e9
+    # the server measures from the first to the last arrival, the first packet's bytes arrived before its clock started
+    measured_bytes = (packets_received - 1) * payload_size if packets_received > 1 else bytes_received
+    total_speed_bps = measured_bytes*8 // total_time if total_time > 0 else 0
+    loss_percent = 0
+    segments_lost = None
+    line = f"{protocol} upload #{id} finished, server measured total time: {total_time:.6f} seconds, total speed: {total_speed_bps} bits/second"
+    if protocol == 'UDP':
+        succ_rate = min(100, packets_received*100 / segments_sent) if segments_sent else 0
+        loss_percent = 100 - succ_rate
+        segments_lost = max(0, segments_sent - packets_received)
+        line += f", percentage of packets received successfully: {succ_rate:.2f}%"
+    print(line)
+    return new_result(protocol, id, file_size, direction='upload', test_duration=duration or None,
+                      payload_size=payload_size, bytes_received=bytes_received, duration=total_time, bitrate_bps=total_speed_bps,
+                      loss_percent=loss_percent, segments_lost=segments_lost)
+
+
+def start_udp_communication(server_ip, udp_port, file_size, id, rate_bps=0, report_intervals=False, duration=0,
+                            direction=DIRECTION_DOWNLOAD, adaptive=False, payload_size=PAYLOAD_SIZE, profile='default'):
+    """
+    Start a UDP connection to download the specified file size,
+    or, when duration (seconds) is set, whatever the server streams in that much time.
+    rate_bps asks the server to pace its sends to that many bits/second (0 = as fast as possible),
+    an upload is paced the same way.
+    adaptive makes the download report what it received every _FEEDBACK_INTERVAL seconds, and the
+    server adapt its rate (starting at rate_bps) to the loss, to find the highest sustainable rate.
+    payload_size is the payload bytes per packet (both ways), 0 = as large as the path MTU allows.
+    direction turns it into an upload, where the client streams the payload packets and the server
+    reports what it received, or into both at once.
+    report_intervals prints the rate of every sampling interval, not just the percentiles.
+    profile is the socket tuning profile (see Helpers.TUNING_PROFILES).
+    Returns the transfer's result record (see Results.new_result),
+    or the list of the download and upload records of a bidirectional transfer.
+    """
+    try:
+        udp_socket = create_socket(socket.SOCK_DGRAM, profile)
+
+        # send size message
+        duration_ms = int(duration * 1000)
+        if duration_ms:
+            file_size = 0
+        if not payload_size:
+            # the largest datagram that doesn't need IP fragmentation (IP and UDP headers are 28 bytes)
+            payload_size = min(MAX_PAYLOAD_SIZE, get_path_mtu(server_ip) - 28 - PAYLOAD_HEADER_SIZE)
+        request_packet = create_request_packet(file_size, rate_bps=rate_bps, duration_ms=duration_ms, direction=direction,
+                                               adaptive=int(adaptive),
+                                               payload_size=payload_size if payload_size != PAYLOAD_SIZE else 0)
+        udp_socket.sendto(request_packet, (server_ip, udp_port))
+        # receive into preallocated buffers and only look at the packet headers,
+        # one byte more than a payload packet so an oversized datagram shows up as a wrong length
+        receiver = UdpReceiver(udp_socket, max(RECEIVE_BUFFER_SIZE, PAYLOAD_HEADER_SIZE + payload_size + 1))
+        if direction == DIRECTION_DOWNLOAD:
+            result = receive_udp_download(udp_socket, receiver, file_size, id, duration, report_intervals,
+                                          feedback=adaptive, payload_size=payload_size)
+            add_tuning([result], udp_socket, profile)
+            return result
 
-        print(f"UDP transfer #{id} finished, total time: {total_time:.6f} seconds, total speed: {total_speed_bps} bits/second, percentage of packets received successfully: {succ_rate:.2f}%")
+        # the server answers with an empty report, from the socket to upload to
+        udp_socket.settimeout(_STOP_GRACE)
+        answer = wait_for_report(receiver)
+        if answer is None:
+            raise Exception("the server didn't answer the upload request")
+        server_address = answer[1]
+        results = []
+        # reports that show up while downloading, the server may finish before we send the stop packet
+        reports = []
+        if direction == DIRECTION_BIDIRECTIONAL:
+            upload = []
+            uploader = threading.Thread(target=lambda: upload.append(
+                send_udp_upload(udp_socket, server_address, file_size, duration, rate_bps, payload_size)), daemon=True)
+            uploader.start()
+            results.append(receive_udp_download(udp_socket, receiver, file_size, id, duration, report_intervals, reports,
+                                                adaptive, payload_size))
+            uploader.join()
+            segments_sent = upload[0] if upload else 0
+        else:
+            segments_sent = send_udp_upload(udp_socket, server_address, file_size, duration, rate_bps, payload_size)
+        report = reports[0] if reports else finish_udp_upload(udp_socket, receiver, server_address)
+        results.append(upload_result('UDP', id, file_size, duration, report, segments_sent, payload_size))
+        add_tuning(results, udp_socket, profile)
+        return results[0] if len(results) == 1 else results
 
     except Exception as e:
         print(f"Error in UDP connection: {e}")
+        return new_result('UDP', id, file_size, direction=DIRECTION_NAMES[direction], test_duration=duration or None,
+                          payload_size=payload_size, tuning=profile, error=str(e))
     finally:
         udp_socket.close()
 
 
+def receive_udp_download(udp_socket, receiver, file_size, id, duration=0, report_intervals=False, reports=None,
+                         feedback=False, payload_size=PAYLOAD_SIZE):
+    """
+    Receive the payload packets of a UDP download through the given UdpReceiver and print its statistics.
+    Upload reports that arrive meanwhile are appended to reports (if given).
+    feedback sends the server a feedback packet every _FEEDBACK_INTERVAL seconds (adaptive downloads).
+    Returns the transfer's result record.
+    """
+    duration_ms = int(duration * 1000)
+    # a time-bounded stream announces its number of segments in its last packet
+    number_of_segments = file_size//payload_size if file_size % payload_size == 0 else file_size//payload_size+1
+    # duplicates must not count, so progress is measured in distinct segments
+    tracker = SegmentTracker(number_of_segments)
+
+    # "The Client detects that the UDP transfer 
+    # concludes after no data has been received for 1 second."
+    # That second is only the wait for the first packet, after that the idle timeout
+    # adapts to the observed inter-arrival times.
+    idle = AdaptiveIdleTimeout()
+    udp_socket.settimeout(idle.timeout)
+    # the timeout the socket has, changed when the adaptive one moves away from it by more than a quarter
+    applied_timeout = idle.timeout
+    # to measure time, we use time.perf_counter() 
+    # which is designed for high resolution time measurements
+    start_time = time.perf_counter()
+    sampler = ThroughputSampler(start_time)
+    # a time-bounded transfer is stopped by us if the server's last packet doesn't show up
+    deadline = start_time + duration + _STOP_GRACE if duration_ms else None
+    server_address = None
+    last_feedback = start_time
+
+    while not tracker.complete and (duration_ms or number_of_segments > 0):
+        try:
+            buffer, nbytes, address = receiver.receive()
+            header = decode_payload_header(buffer, nbytes, payload_size)
+            if header is not None:
+                now = time.perf_counter()
+                idle.arrival(now)
+                server_address = address
+                total_segments, segment_number = header
+                if total_segments and not tracker.total_segments:
+                    tracker.set_total(total_segments)
+                if tracker.record(segment_number):
+                    sampler.add(payload_size, now)
+                if feedback and now - last_feedback >= _FEEDBACK_INTERVAL:
+                    # the server adapts its rate to the loss since the previous feedback
+                    udp_socket.sendto(create_feedback_packet(tracker.received, tracker.highest_segment), address)
+                    last_feedback = now
+                if deadline is not None and now >= deadline:
+                    break
+                timeout = idle.timeout if deadline is None else min(idle.timeout, deadline - now)
+                if segment_number == tracker.total_segments or abs(timeout - applied_timeout) > applied_timeout / 4:
+                    # after the final segment this only waits a few gaps for reordered stragglers
+                    udp_socket.settimeout(timeout)
+                    applied_timeout = timeout
+            elif reports is not None:
+                report = decode_report_packet(buffer, nbytes)
+                if report is not None:
+                    reports.append(report)
+        except socket.timeout:
+            break
+
+    end_time = time.perf_counter()
+    if duration_ms and server_address is not None and not tracker.total_segments:
+        # the server is still streaming, tell it to stop
+        udp_socket.sendto(create_stop_packet(), server_address)
+
+    # measure from the first to the last packet, the idle wait at the end is not transfer time
+    if tracker.received > 1 and idle.last_arrival > idle.first_arrival:
+        total_time = idle.last_arrival - idle.first_arrival
+        # the first packet's bytes arrived before the clock started
+        measured_bytes = (tracker.received - 1) * payload_size
+    else:
+        total_time = end_time - start_time
+        measured_bytes = tracker.received * payload_size
+    number_of_segments = tracker.expected
+    if tracker.complete:
+        succ_rate = 100
+    else:
+        # nothing expected: an empty download succeeded, a time-bounded one that got nothing did not
+        succ_rate = tracker.received*100 / number_of_segments if number_of_segments else (0 if duration_ms else 100)
+    total_speed_bps = measured_bytes*8 // total_time
+
+    print(f"UDP transfer #{id} finished, total time: {total_time:.6f} seconds, total speed: {total_speed_bps} bits/second, percentage of packets received successfully: {succ_rate:.2f}%")
+    print(f"UDP transfer #{id} segments: {tracker.received}/{number_of_segments} received, {tracker.lost} lost "
+          f"(longest burst: {tracker.longest_loss_burst()}), {tracker.duplicates} duplicates, "
+          f"{tracker.reordered} reordered (max distance: {tracker.max_reorder_distance})")
+    print(sampler.report(f"UDP transfer #{id}", report_intervals))
+    return new_result('UDP', id, file_size, test_duration=duration or None, payload_size=payload_size,
+                      bytes_received=tracker.received*payload_size, duration=total_time,
+                      bitrate_bps=total_speed_bps, loss_percent=100-succ_rate, segments_lost=tracker.lost,
+                      duplicates=tracker.duplicates, reordered=tracker.reordered,
+                      max_reorder_distance=tracker.max_reorder_distance,
+                      longest_loss_burst=tracker.longest_loss_burst(), interval=sampler.interval,
+                      interval_bytes=sampler.samples())
+
+
+def send_udp_upload(udp_socket, address, file_size, duration=0, rate_bps=0, payload_size=PAYLOAD_SIZE):
+    """
+    Send the payload packets of an upload to the server's per-client address: file_size bytes worth,
+    or for duration seconds when it is set (total_segments is 0 until the last packet, like the server's streams).
+    rate_bps paces the sends (0 = as fast as possible). Where the kernel supports UDP GSO every
+    batch leaves in a single send.
+    Returns the number of segments sent.
+    """
+    # send the segments in batches built by patching a preallocated template
+    packet_factory = PayloadPacketFactory(payload_size=payload_size)
+    # the kernel splits one send of the whole batch into its packets
+    gso = packet_factory.batch_size > 1 and enable_udp_gso(udp_socket, packet_factory.packet_size)
+    batch_size = packet_factory.batch_size
+    pacer = None
+    if rate_bps:
+        pacer = TokenBucket(rate_bps, UDP_PACING_BURST)
+        batch_size = pacer.packets_per_wakeup(packet_factory.packet_size, batch_size)
+    number_of_segments = None
+    if duration:
+        deadline = time.perf_counter() + duration
+    else:
+        number_of_segments = file_size//payload_size if file_size % payload_size == 0 else file_size//payload_size+1
+    segment = 1
+    while True:
+        if number_of_segments is None:
+            if time.perf_counter() >= deadline:
+                send_packets(udp_socket, [packet_factory.packet(segment, segment)], address)
+                return segment
+            packets = packet_factory.batch(0, segment, batch_size)
+        else:
+            if segment > number_of_segments:
+                return number_of_segments
+            packets = packet_factory.batch(number_of_segments, segment, min(batch_size, number_of_segments - segment + 1))
+        if pacer is not None:
+            pacer.consume(len(packets) * packet_factory.packet_size)
+        gso = send_batch(udp_socket, packets, packet_factory.buffer(len(packets)), address, gso)
+        segment += len(packets)
+
+
+def wait_for_report(receiver):
+    """
+    Receive until a report packet arrives (other packets, e.g. download stragglers, are skipped),
+    or until the socket's timeout expires.
+    Returns a tuple (report, address), or None on timeout.
+    """
+    try:
+        while True:
+            buffer, nbytes, address = receiver.receive()
+            report = decode_report_packet(buffer, nbytes)
+            if report is not None:
+                return (report, address)
+    except socket.timeout:
+        return None
+
+
+def finish_udp_upload(udp_socket, receiver, server_address, attempts=3):
+    """
+    End an upload with a stop packet and wait for the server's report, resending a lost stop packet.
+    Returns the report (bytes_received, packets_received, duration_ns), or None if none arrived.
+    """
+    udp_socket.settimeout(_STOP_GRACE)
+    for _ in range(attempts):
+        udp_socket.sendto(create_stop_packet(), server_address)
+        answer = wait_for_report(receiver)
+        if answer is not None:
+            return answer[0]
+    return None
+
+
+
+def run_transfer(results, writer, run, transfer, *args):
+    """
+    Run one transfer function and collect its result record(s) (thread target).
+    """
+    transfer_results = transfer(*args)
+    if isinstance(transfer_results, dict):
+        transfer_results = [transfer_results]
+    for result in transfer_results:
+        result['run'] = run
+        result['timestamp'] = time.time()
+        results.append(result)  # list.append is atomic, no lock needed
+        if writer is not None:
+            writer.write(result)
 
-def start(file_size, tcp_connections, udp_connections):
-    address, offer = listen_for_offer(_OFFER_PORT)
-    magic_cookie, message_type, udp_port, tcp_port = offer
-    print(f"Received offer packet from {address[0]}: ")
+
+def discover_server(discovery=None, strategy='first'):
+    """
+    Find a server to test against.
+    With a running OfferDiscovery the server is picked from its table by strategy (instantly once
+    an offer was seen), otherwise this waits for the first server that makes an offer.
+    Returns a tuple (server_ip, udp_port, tcp_port).
+    """
+    if discovery is not None:
+        server_ip, udp_port, tcp_port = discovery.select(strategy)
+    else:
+        address, offer = listen_for_offer(_OFFER_PORT)
+        magic_cookie, message_type, udp_port, tcp_port = offer
+        server_ip = address[0]
+    print(f"Received offer packet from {server_ip}: ")
     print(f"  UDP Port: {udp_port}")
     print(f"  TCP Port: {tcp_port}")
     print("\n")
+    return (server_ip, udp_port, tcp_port)
+
+
+def start(file_size, tcp_connections, udp_connections, udp_rate_bps=0, report_intervals=False, writer=None,
+          discovery=None, strategy='first', duration=0, direction=DIRECTION_DOWNLOAD, adaptive=False,
+          payload_size=PAYLOAD_SIZE, profile='default', probe=None, probe_interval=PROBE_INTERVAL):
+    """
+    Run one round of transfers against a discovered server (see discover_server).
+    Returns the list of transfer result records.
+    """
+    return run_round(discover_server(discovery, strategy), file_size, tcp_connections, udp_connections, udp_rate_bps,
+                     report_intervals, writer, duration, direction, adaptive, payload_size, profile, probe, probe_interval)
+
+
+def run_round(server, file_size, tcp_connections, udp_connections, udp_rate_bps=0, report_intervals=False, writer=None,
+              duration=0, direction=DIRECTION_DOWNLOAD, adaptive=False, payload_size=PAYLOAD_SIZE, profile='default',
+              probe=None, probe_interval=PROBE_INTERVAL, sessions=None):
+    """
+    Run one round of concurrent transfers against the given (server_ip, udp_port, tcp_port).
+    With duration (seconds) every transfer streams for that long instead of moving file_size bytes.
+    direction is one of the DIRECTION_* values, for every transfer of the round.
+    adaptive lets the server adapt the UDP rate to the client's feedback.
+    payload_size is the UDP payload bytes per packet, 0 = as large as the path MTU allows.
+    profile is the socket tuning profile of every connection (see Helpers.TUNING_PROFILES).
+    probe ('UDP' or 'TCP') measures the RTT with latency probes every probe_interval seconds, for
+    IDLE_PROBE_DURATION seconds before the transfers start and then next to them (latency under load).
+    sessions (a list of TcpSession, at least one per TCP connection) runs the TCP transfers on
+    persistent connections instead of a new connection each.
+    Every transfer's result record, a summary per protocol and the latency records, are written to writer (if given).
+    Returns the list of transfer result records.
+    """
+    server_ip, udp_port, tcp_port = server
+    run = f"{time.time():.6f}"
+    results = []
     threads = []
+    probes = []
+    if probe is not None:
+        probes.append(('idle', LatencyProbe(server, probe, probe_interval).run(IDLE_PROBE_DURATION)))
+        probes.append(('loaded', LatencyProbe(server, probe, probe_interval).start()))
     # Start TCP connections
     for i in range(tcp_connections):
-        thread = threading.Thread(target=start_tcp_connection, args=(address[0], tcp_port, file_size, i), daemon=True)
+        if sessions is not None:
+            args = (results, writer, run, sessions[i].run_test, file_size, i, report_intervals, duration, direction)
+        else:
+            args = (results, writer, run, start_tcp_connection, server_ip, tcp_port, file_size, i, report_intervals, duration, direction, profile)
+        thread = threading.Thread(target=run_transfer, args=args, daemon=True)
         threads.append(thread)
         thread.start()
     # Start UDP connections
     for i in range(udp_connections):
-        thread = threading.Thread(target=start_udp_communication, args=(address[0], udp_port, file_size, i), daemon=True)
+        thread = threading.Thread(target=run_transfer, args=(results, writer, run, start_udp_communication, server_ip, udp_port, file_size, i, udp_rate_bps, report_intervals, duration, direction, adaptive, payload_size, profile), daemon=True)
         threads.append(thread)
         thread.start()
     # Wait for all threads to finish
     for thread in threads:
         thread.join()
+    if probes:
+        report_latency(probes, run, writer)
+    for summary in summarize(results, run, time.time()):
+        print(f"{summary['protocol']} {summary['direction']} summary: {summary['id']} transfers, {summary['bytes_received']} bytes, "
+              f"aggregate speed: {summary['bitrate_bps']:.0f} bits/second")
+        if writer is not None:
+            writer.write(summary)
+    if writer is not None:
+        writer.flush()
+    return results
+
+
+def report_latency(probes, run, writer=None):
+    """
+    Stop the loaded latency probe, then print and write (if writer is given) the record of every phase
+    and how much the load added to the median RTT.
+    probes is a list of (phase, LatencyProbe).
+    """
+    records = {}
+    for phase, probe in probes:
+        probe.stop()
+        print(probe.report(f"{phase.capitalize()}"))
+        records[phase] = latency_result(probe, phase, run, time.time())
+        if writer is not None:
+            writer.write(records[phase])
+    idle, loaded = records['idle']['rtt_p50'], records['loaded']['rtt_p50']
+    if idle is not None and loaded is not None:
+        print(f"Latency under load: median RTT {idle * 1000:.3f} ms idle, {loaded * 1000:.3f} ms loaded "
+              f"({(loaded - idle) * 1000:+.3f} ms)")
+
+
+def run_campaign(server, sizes, tcp_counts, udp_counts, udp_rate_bps=0, repeat=1, interval=0, duration=0,
+                 report_intervals=False, writer=None, test_duration=0, direction=DIRECTION_DOWNLOAD, adaptive=False,
+                 payload_size=PAYLOAD_SIZE, profile='default', probe=None, probe_interval=PROBE_INTERVAL,
+                 persistent=False):
+    """
+    Run unattended rounds against one server: every combination of sizes x TCP counts x UDP counts,
+    the whole matrix repeat times (0 = until the duration is over), with interval seconds between rounds.
+    duration (seconds, 0 = unlimited) stops the campaign before any round that would start after it.
+    test_duration (seconds) makes every transfer time-bounded, the sizes are then ignored.
+    direction is one of the DIRECTION_* values, for every transfer.
+    adaptive lets the server adapt the UDP rate to the client's feedback.
+    payload_size is the UDP payload bytes per packet, 0 = as large as the path MTU allows.
+    profile is the socket tuning profile (see Helpers.TUNING_PROFILES).
+    probe ('UDP' or 'TCP') measures the idle and loaded RTT of every round with latency probes.
+    persistent runs the TCP transfers of every round on the same connections (see TcpSession),
+    as many as the largest TCP count, closed when the campaign is over.
+    Returns the number of rounds run.
+    """
+    if repeat == 0 and duration <= 0:
+        raise ValueError("an endless campaign (repeat 0) needs a duration")
+    deadline = time.monotonic() + duration if duration > 0 else None
+    if test_duration > 0:
+        sizes = [0]
+    matrix = list(itertools.product(sizes, tcp_counts, udp_counts))
+    sessions = None
+    if persistent:
+        server_ip, udp_port, tcp_port = server
+        sessions = [TcpSession(server_ip, tcp_port, profile) for _ in range(max(tcp_counts, default=0))]
+    rounds = 0
+    repetition = 0
+    try:
+        while repeat == 0 or repetition < repeat:
+            for file_size, tcp_connections, udp_connections in matrix:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return rounds
+                if rounds > 0 and interval > 0:
+                    time.sleep(interval)
+                target = f"{test_duration} seconds" if test_duration > 0 else f"{file_size} bytes"
+                print(f"{bcolors.HEADER} Round {rounds + 1} (repetition {repetition + 1}): {target}, "
+                      f"{tcp_connections} TCP, {udp_connections} UDP {bcolors.ENDC}")
+                run_round(server, file_size, tcp_connections, udp_connections, udp_rate_bps, report_intervals, writer,
+                          test_duration, direction, adaptive, payload_size, profile, probe, probe_interval, sessions)
+                rounds += 1
+            repetition += 1
+        return rounds
+    finally:
+        for session in sessions or []:
+            session.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Speed test client. Interactive unless --sizes or --test-duration is given.")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        help="run unattended: file sizes in bytes to test (each is combined with every --tcp and --udp count)")
+    parser.add_argument('--test-duration', type=float, default=0,
+                        help="run unattended: every transfer downloads for this many seconds instead of a file size")
+    parser.add_argument('--tcp', type=int, nargs='+', default=[1], help="numbers of TCP connections to test (default: 1)")
+    parser.add_argument('--udp', type=int, nargs='+', default=[1], help="numbers of UDP connections to test (default: 1)")
+    parser.add_argument('--udp-rate', type=int, default=0, help="UDP target rate in bits/second (default: 0 = unlimited)")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="UDP downloads send feedback and the server adapts its rate to find the highest one without loss (starts at --udp-rate if set)")
+    parser.add_argument('--payload-size', type=int, default=PAYLOAD_SIZE,
+                        help=f"UDP payload bytes per packet, up to {MAX_PAYLOAD_SIZE} (default: {PAYLOAD_SIZE}, 0 = as large as the path MTU allows)")
+    parser.add_argument('--tuning', choices=tuple(TUNING_PROFILES), default='default',
+                        help="socket tuning profile: OS defaults, large buffers for high bandwidth-delay paths, or low latency (default: default)")
+    parser.add_argument('--latency', choices=('UDP', 'TCP'),
+                        help="measure the RTT with probes of this protocol, idle before every round and under the round's load")
+    parser.add_argument('--probe-interval', type=float, default=PROBE_INTERVAL,
+                        help=f"seconds between two latency probes (default: {PROBE_INTERVAL})")
+    parser.add_argument('--persistent', action='store_true',
+                        help="run the TCP tests of an unattended run on persistent connections, one per TCP connection, instead of connecting for every test")
+    parser.add_argument('--direction', choices=DIRECTION_NAMES, default='download',
+                        help="download from the server, upload to it (the server reports what it received) or both at once (default: download)")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="how many times to run the whole matrix (default: 1, 0 = until --duration is over)")
+    parser.add_argument('--interval', type=float, default=0, help="seconds to wait between rounds (default: 0)")
+    parser.add_argument('--duration', type=float, default=0,
+                        help="stop starting new rounds after this many seconds (default: 0 = unlimited)")
+    parser.add_argument('--select', choices=SELECTION_STRATEGIES, default='first',
+                        help="how to pick among the advertising servers: the first seen, the lowest RTT or the lowest load (default: first)")
+    parser.add_argument('--discovery-ttl', type=float, default=5,
+                        help="forget servers that haven't sent an offer for this many seconds (default: 5)")
+    parser.add_argument('--output', help="append a result record per transfer and a summary per run to this file")
+    parser.add_argument('--format', choices=('jsonl', 'csv'),
+                        help="format of the --output file (default: from its extension, jsonl otherwise)")
+    parser.add_argument('--intervals', action='store_true', help="print the rate of every 100 ms interval")
+    args = parser.parse_args()
+    values = [args.udp_rate, args.payload_size, args.probe_interval, args.repeat, args.interval, args.duration, args.test_duration] + args.tcp + args.udp + (args.sizes or [])
+    if any(value < 0 for value in values):
+        parser.error("values must be non-negative")
+    if args.latency and args.probe_interval == 0:
+        parser.error("--probe-interval must be positive")
+    if args.payload_size > MAX_PAYLOAD_SIZE:
+        parser.error(f"--payload-size can be at most {MAX_PAYLOAD_SIZE}")
+    if args.repeat == 0 and args.duration == 0:
+        parser.error("--repeat 0 needs a --duration")
+    return args
 
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        while(True):
+        writer = ResultsWriter(args.output, args.format) if args.output else None
+    except (OSError, ValueError) as e:
+        print(f"{bcolors.RED} [ERROR] Can't write the results: {e} {bcolors.ENDC}")
+        raise SystemExit(1)
+    discovery = None
+    try:
+        # keeps listening for offers in the background, so later rounds don't wait for a broadcast
+        discovery = OfferDiscovery(_OFFER_PORT, args.discovery_ttl)
+        unattended = bool(args.sizes) or args.test_duration > 0
+        if unattended:
+            # discover the server once and reuse it for every round
+            server = discover_server(discovery, args.select)
+            rounds = run_campaign(server, args.sizes or [], args.tcp, args.udp, args.udp_rate, args.repeat,
+                                  args.interval, args.duration, args.intervals, writer, args.test_duration,
+                                  DIRECTION_NAMES.index(args.direction), args.adaptive, args.payload_size, args.tuning,
+                                  args.latency, args.probe_interval, args.persistent)
+            print(f"\n{bcolors.OKGREEN} Complete, {rounds} rounds {bcolors.ENDC}")
+        while(not unattended):
             # Prompt user for inputs
             # (in python 3, int can hold very large numbers)
             try:
-                file_size = int(input(f"{bcolors.HEADER} Enter file size in Bytes: {bcolors.ENDC}"))
-                if file_size < 0:
+                size = input(f"{bcolors.HEADER} Enter file size in Bytes (or a test duration, e.g. 10s): {bcolors.ENDC}").strip()
+                duration = 0
+                if size.endswith('s'):
+                    file_size, duration = 0, float(size[:-1])
+                else:
+                    file_size = int(size)
+                if file_size < 0 or duration < 0:
                     raise ValueError("File size must be a non-negative integer")
                 tcp_connections = int(input(f"{bcolors.HEADER} Enter the number of TCP connections: {bcolors.ENDC}"))
                 udp_connections = int(input(f"{bcolors.HEADER} Enter the number of UDP connections: {bcolors.ENDC}"))
-                start(file_size, tcp_connections, udp_connections)
+                udp_rate_bps = 0
+                if udp_connections > 0:
+                    udp_rate_bps = int(input(f"{bcolors.HEADER} Enter the UDP target rate in bits/second (0 = unlimited): {bcolors.ENDC}") or 0)
+                if tcp_connections < 0 or udp_connections < 0 or udp_rate_bps < 0:
+                    raise ValueError("values must be non-negative integers")
+                start(file_size, tcp_connections, udp_connections, udp_rate_bps, args.intervals, writer, discovery, args.select,
+                      duration, DIRECTION_NAMES.index(args.direction), args.adaptive, args.payload_size, args.tuning,
+                      args.latency, args.probe_interval)
                 print(f"\n{bcolors.OKGREEN} Complete, {bcolors.ENDC}", end="")
             except ValueError as e:
                 print(f"\n{bcolors.RED} [ERROR] Invalid input. values must be non-negative Integers. {bcolors.ENDC}")
@@ -179,6 +887,11 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"\n{bcolors.RED} [ERROR] Client shutting down. {bcolors.ENDC}")
         print(f"\n{bcolors.RED} [CAUSE] {bcolors.ENDC} {e}")
+    finally:
+        if discovery is not None:
+            discovery.close()
+        if writer is not None:
+            writer.close()
     
 
 
@@ -0,0 +1,124 @@
+import socket
+import threading
+import time
+from EncoderDecoder import decode_offer_packet
+
+# the ways OfferDiscovery.select() can pick a server
+SELECTION_STRATEGIES = ('first', 'rtt', 'load')
+
+
+
+def measure_rtt(server_ip, tcp_port, timeout=1.0):
+    '''
+        This Method is used to estimate the round trip time to a server from its TCP handshake.
+        Returns:
+            rtt (float): The connect time in seconds, or None if the server didn't answer.
+    '''
+    try:
+        start_time = time.perf_counter()
+        with socket.create_connection((server_ip, tcp_port), timeout=timeout):
+            return time.perf_counter() - start_time
+    except OSError:
+        return None
+
+
+
+class OfferDiscovery:
+    '''
+        Listens for offer packets in the background and keeps a table of the servers
+        that advertised themselves within the last ttl seconds.
+        After the first offer, select() answers instantly from the table instead of
+        waiting for the next broadcast.
+    '''
+
+    def __init__(self, offer_port, ttl=5.0):
+        '''
+            Args:
+                offer_port (int): The port the servers broadcast their offers to.
+                ttl (float): Servers not heard from for this many seconds are forgotten.
+        '''
+        self.ttl = ttl
+        # (ip, udp_port, tcp_port) -> {'server', 'first_seen', 'last_seen', 'load', 'rtt', 'rtt_time'}
+        self._servers = {}
+        self._changed = threading.Condition()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # Allow address reuse
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("", offer_port))
+        print(f"Listening for offer packets on port {offer_port}...")
+        threading.Thread(target=self._listen, name="offer-discovery", daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                # !!! recvfrom is blocking so No Busy Waiting !!!
+                data, address = self._socket.recvfrom(1024)
+            except OSError:
+                return  # the socket was closed
+            offer = decode_offer_packet(data)
+            if offer is None:
+                print(f"[ERROR] Invalid packet received from {address[0]}.")
+                continue
+            udp_port, tcp_port, load = offer
+            key = (address[0], udp_port, tcp_port)
+            now = time.monotonic()
+            with self._changed:
+                entry = self._servers.get(key)
+                if entry is None:
+                    entry = {'server': key, 'first_seen': now, 'load': None, 'rtt': None, 'rtt_time': None}
+                    self._servers[key] = entry
+                entry['last_seen'] = now
+                entry['load'] = load
+                self._changed.notify_all()
+
+    def servers(self):
+        '''
+            Returns:
+                list: The table entries of the servers seen within the last ttl seconds, oldest first.
+        '''
+        now = time.monotonic()
+        with self._changed:
+            for key in [key for key, entry in self._servers.items() if now - entry['last_seen'] > self.ttl]:
+                del self._servers[key]
+            return sorted((dict(entry) for entry in self._servers.values()), key=lambda entry: entry['first_seen'])
+
+    def select(self, strategy='first', timeout=None):
+        '''
+            Pick a server, waiting for the first offer if none is known yet.
+            Args:
+                strategy (str): 'first' - the longest known server (stable across rounds),
+                                'rtt' - the lowest TCP handshake time (measured at most once per ttl),
+                                'load' - the fewest clients in service (servers that don't advertise it come last).
+                timeout (float): The longest time to wait for an offer in seconds, None to wait forever.
+            Returns:
+                server (tuple): (server_ip, udp_port, tcp_port), or None if no offer arrived in time.
+        '''
+        if strategy not in SELECTION_STRATEGIES:
+            raise ValueError(f"unknown selection strategy: {strategy}")
+        with self._changed:
+            if not self._changed.wait_for(self.servers, timeout):
+                return None
+        servers = self.servers()
+        if strategy == 'rtt':
+            for entry in servers:
+                self._refresh_rtt(entry)
+            reachable = [entry for entry in servers if entry['rtt'] is not None]
+            if reachable:
+                return min(reachable, key=lambda entry: entry['rtt'])['server']
+        elif strategy == 'load':
+            return min(servers, key=lambda entry: (entry['load'] is None, entry['load'] or 0))['server']
+        return servers[0]['server']
+
+    def _refresh_rtt(self, entry):
+        now = time.monotonic()
+        if entry['rtt_time'] is not None and now - entry['rtt_time'] < self.ttl:
+            return
+        server_ip, _, tcp_port = entry['server']
+        entry['rtt'] = measure_rtt(server_ip, tcp_port)
+        entry['rtt_time'] = now
+        with self._changed:
+            if entry['server'] in self._servers:
+                self._servers[entry['server']].update(rtt=entry['rtt'], rtt_time=now)
+
+    def close(self):
+        self._socket.close()
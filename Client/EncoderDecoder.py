@@ -2,6 +2,63 @@ import struct
 
 PAYLOAD_SIZE = 512
 
+# '!I B Q Q' means: ! - network byte order, I - unsigned int (4 bytes),
+#                   B - unsigned char (1 byte), Q - unsigned long long (8 bytes)
+_PAYLOAD_HEADER = struct.Struct('!I B Q Q')
+PAYLOAD_HEADER_SIZE = _PAYLOAD_HEADER.size
+# the largest payload that fits in one IPv4 UDP datagram (65535 - 20 IP - 8 UDP header bytes)
+MAX_DATAGRAM_SIZE = 65507
+MAX_PAYLOAD_SIZE = MAX_DATAGRAM_SIZE - PAYLOAD_HEADER_SIZE
+# the most datagrams one UDP GSO send may carry (UDP_MAX_SEGMENTS in linux/udp.h)
+UDP_GSO_MAX_SEGMENTS = 64
+# the two segment fields (total_segments, segment_number) start right after the cookie and type
+_SEGMENT_FIELDS = struct.Struct('!Q Q')
+_SEGMENT_FIELDS_OFFSET = 5
+
+# The request packet may carry optional fields after the file size, in this order.
+# A request only carries the fields up to the last one that isn't at its default,
+# so a plain download request is still the original 13-byte packet.
+# Each entry is (name, struct format, default).
+REQUEST_EXTENSIONS = (
+    ('rate_bps', 'Q', 0),  # UDP target bitrate in bits/second, 0 = as fast as possible
+    ('duration_ms', 'I', 0),  # stream for this long instead of file_size bytes, 0 = size-bounded
+    ('direction', 'B', 0),  # one of the DIRECTION_* values below
+    ('adaptive', 'B', 0),  # 1 = the client sends feedback packets and the server adapts its UDP rate to them
+    ('payload_size', 'H', 0),  # the payload bytes per UDP payload packet (both ways), 0 = PAYLOAD_SIZE
+)
+# which way a test moves its data
+DIRECTION_DOWNLOAD = 0  # server to client
+DIRECTION_UPLOAD = 1  # client to server, the server reports what it received
+DIRECTION_BIDIRECTIONAL = 2  # both at once
+DIRECTION_NAMES = ('download', 'upload', 'bidirectional')
+
+# The server's report of an upload: '!I B Q Q Q' = cookie, type, bytes received,
+# packets received (0 over TCP) and nanoseconds from the first to the last arrival.
+_REPORT_PACKET = struct.Struct('!I B Q Q Q')
+REPORT_PACKET_SIZE = _REPORT_PACKET.size
+
+# The client's feedback on a UDP download: '!I B Q Q' = cookie, type, the number of distinct
+# segments received and the highest segment number seen so far. The segments between two
+# feedbacks that did not arrive are the loss of that interval.
+_FEEDBACK_PACKET = struct.Struct('!I B Q Q')
+
+# A latency probe: '!I B I Q Q' = cookie, type, sequence number, the client's send time and the
+# server's receive time (nanoseconds). The server echoes the probe with its receive time filled in,
+# the client's send time comes back unchanged so the RTT needs no clock synchronization.
+_PROBE_PACKET = struct.Struct('!I B I Q Q')
+PROBE_PACKET_SIZE = _PROBE_PACKET.size
+
+# The framed protocol of a persistent TCP connection (the first byte tells it from a request line).
+# Every test starts with a test frame: '!I B Q I B' = cookie, type, file size, duration in ms and direction.
+# The test's data then goes both ways in blocks, each a '!I' length followed by that many bytes;
+# a zero-length block ends the data of a direction. An upload is answered with a report packet, then
+# the next test frame may follow on the same connection.
+_TEST_FRAME = struct.Struct('!I B Q I B')
+TEST_FRAME_SIZE = _TEST_FRAME.size
+BLOCK_HEADER = struct.Struct('!I')
+END_BLOCK = BLOCK_HEADER.pack(0)
+
+
 def create_payload_packet(payload_size, total_segments, segment_number):
     '''
         This Method is used to create the payload packet.
@@ -20,15 +77,79 @@ def create_payload_packet(payload_size, total_segments, segment_number):
     # '!I B I' means: ! - network byte order, I - unsigned int (4 bytes), 
     #                   B - unsigned char (1 byte), <num>s - <num> length String (<num> bytes)
     #                   Q - unsigned long long (8 bytes)
-    payload_packet = struct.pack(f'!I B Q Q {PAYLOAD_SIZE}s', magic_cookie, message_type, total_segments, segment_number, payload)
+    payload_packet = struct.pack(f'!I B Q Q {payload_size}s', magic_cookie, message_type, total_segments, segment_number, payload)
     return payload_packet
 
-def create_offer_packet(udp_port, tcp_port):
+
+class PayloadPacketFactory:
+    '''
+        Builds payload packets out of one preallocated buffer.
+        The cookie, message type and demi payload of every packet slot are written once,
+        and only the two 8-byte segment fields are patched in place (struct.pack_into).
+        Notes:
+            The returned packets are views into the factory's buffer, they are only valid
+            until the next call. Every sender thread should use its own factory.
+    '''
+
+    def __init__(self, batch_size=None, payload_size=PAYLOAD_SIZE):
+        '''
+            Args:
+                batch_size (int): The maximal number of packets returned by one batch() call. By default
+                                  as many as fit in one maximal datagram, up to UDP_GSO_MAX_SEGMENTS,
+                                  so a whole batch can always go out in a single GSO send.
+                payload_size (int): The size of the demi payload of each packet in bytes.
+        '''
+        self.packet_size = PAYLOAD_HEADER_SIZE + payload_size
+        if batch_size is None:
+            batch_size = max(1, min(UDP_GSO_MAX_SEGMENTS, MAX_DATAGRAM_SIZE // self.packet_size))
+        self.batch_size = batch_size
+        template = _PAYLOAD_HEADER.pack(0xabcddcba, 0x4, 0, 0) + b'A' * payload_size
+        self._buffer = bytearray(template * batch_size)
+        self._view = memoryview(self._buffer)
+        self._packets = [self._view[i*self.packet_size:(i+1)*self.packet_size] for i in range(batch_size)]
+
+    def packet(self, total_segments, segment_number):
+        '''
+            Returns a single payload packet (a view, valid until the next call).
+        '''
+        _SEGMENT_FIELDS.pack_into(self._buffer, _SEGMENT_FIELDS_OFFSET, total_segments, segment_number)
+        return self._packets[0]
+
+    def batch(self, total_segments, first_segment, count):
+        '''
+            Returns up to batch_size consecutive payload packets starting at first_segment.
+            Args:
+                total_segments (int): The total number of segments in the transfer.
+                first_segment (int): The segment number of the first packet in the batch.
+                count (int): The number of packets wanted, capped at batch_size.
+            Returns:
+                packets (list): memoryviews of the packets, valid until the next call.
+        '''
+        count = min(count, self.batch_size)
+        pack_into = _SEGMENT_FIELDS.pack_into
+        buffer = self._buffer
+        offset = _SEGMENT_FIELDS_OFFSET
+        for i in range(count):
+            pack_into(buffer, offset, total_segments, first_segment + i)
+            offset += self.packet_size
+        return self._packets[:count]
+
+    def buffer(self, count):
+        '''
+            Returns the first count packets of the last batch as one contiguous view,
+            for a single UDP GSO send that the kernel splits back into the packets.
+        '''
+        return self._view[:count * self.packet_size]
+
+
+def create_offer_packet(udp_port, tcp_port, load=None):
     '''
         This Method is used to create the offer packet.
         Args:
             udp_port (int): The UDP port to be sent in the offer packet.
             tcp_port (int): The TCP port to be sent in the offer packet.
+            load (int): The number of clients the server is serving. When given it is appended
+                        to the offer, otherwise the offer is the plain 9-byte packet.
         Returns:
             offer_packet (bytes): The offer packet in binary format.
     '''
@@ -39,27 +160,80 @@ def create_offer_packet(udp_port, tcp_port):
     # Pack the data into binary format using struct
     # '!I B H H' means: ! - network byte order, I - unsigned int (4 bytes), 
     #                   B - unsigned char (1 byte), H - unsigned short (2 bytes)
-    offer_packet = struct.pack('!I B H H', magic_cookie, message_type, udp_port, tcp_port)
-    return offer_packet
+    if load is None:
+        return struct.pack('!I B H H', magic_cookie, message_type, udp_port, tcp_port)
+    return struct.pack('!I B H H H', magic_cookie, message_type, udp_port, tcp_port, min(load, 0xFFFF))
+
+def decode_offer_packet(data):
+    '''
+        This Method is used to decode an offer packet.
+        Args:
+            data (bytes): The received packet.
+        Returns:
+            (udp_port, tcp_port, load) (tuple): load is None if the server doesn't advertise it,
+            or None if the packet is not a valid offer.
+    '''
+    try:
+        if len(data) == 9:
+            magic_cookie, message_type, udp_port, tcp_port = struct.unpack('!I B H H', data)
+            load = None
+        else:
+            magic_cookie, message_type, udp_port, tcp_port, load = struct.unpack('!I B H H H', data)
+        if magic_cookie != 0xabcddcba or message_type != 0x2:
+            return None
+        return (udp_port, tcp_port, load)
+    except struct.error:
+        return None
 
 
-def create_request_packet(file_size):
+def create_request_packet(file_size, **options):
     '''
         This Method is used to create a request packet.
         Args:
             file_size: requested file size in bytes
+            options: values for the optional fields in REQUEST_EXTENSIONS (e.g. rate_bps)
         Returns:
             request_packet (bytes): The request packet in binary format.
     '''
     # Packet fields
     magic_cookie = 0xabcddcba  # 4 bytes
     message_type = 0x3         # 1 byte
-    
+    unknown = set(options) - {name for name, _, _ in REQUEST_EXTENSIONS}
+    if unknown:
+        raise ValueError(f"unknown request options: {', '.join(sorted(unknown))}")
+    extensions = [options.get(name, default) for name, _, default in REQUEST_EXTENSIONS]
+    # drop the trailing fields that are at their default
+    used = len(extensions)
+    while used > 0 and extensions[used-1] == REQUEST_EXTENSIONS[used-1][2]:
+        used -= 1
+
     # Pack the data into binary format using struct
-    # '!I B H H' means: ! - network byte order, I - unsigned int (4 bytes), 
+    # '!I B Q' means: ! - network byte order, I - unsigned int (4 bytes), 
     #                   B - unsigned char (1 byte), Q - unsigned long long (8 bytes)
-    offer_packet = struct.pack('!I B Q', magic_cookie, message_type, file_size)
-    return offer_packet
+    # followed by the formats of the optional fields in use
+    request_format = '!I B Q ' + ' '.join(fmt for _, fmt, _ in REQUEST_EXTENSIONS[:used])
+    request_packet = struct.pack(request_format, magic_cookie, message_type, file_size, *extensions[:used])
+    return request_packet
+
+def decode_payload_header(buffer, nbytes, payload_size=PAYLOAD_SIZE):
+    '''
+        This Method is used to validate a received payload packet by its header only.
+        Args:
+            buffer (bytes-like): The buffer the packet was received into.
+            nbytes (int): The number of bytes received.
+            payload_size (int): The payload size of the transfer the packet belongs to.
+        Returns:
+            (total_segments, segment_number) (tuple): if the packet is a valid payload packet, None otherwise.
+        Notes:
+            Only the 21 header bytes are unpacked (unpack_from, no slicing),
+            the payload itself is never copied.
+    '''
+    if nbytes != PAYLOAD_HEADER_SIZE + payload_size:
+        return None
+    magic_cookie, message_type, total_segments, segment_number = _PAYLOAD_HEADER.unpack_from(buffer)
+    if magic_cookie != 0xabcddcba or message_type != 0x4:
+        return None
+    return (total_segments, segment_number)
 
 def is_payload_packet(data):
     '''
@@ -69,11 +243,99 @@ def is_payload_packet(data):
         Returns:
             bool: True if the packet is a payload packet, False otherwise.
     '''
-    try:
-        # '!I B Q Q 512s' means: ! - network byte order, I - unsigned int (4 bytes), 
-        #                   B - unsigned char (1 byte), Q - unsigned long long (8 bytes)
-        #                   512s - 512 length String (512 bytes)
-        type = struct.unpack(f'!I B Q Q {PAYLOAD_SIZE}s', data)[1]
-        return type == 0x4
-    except struct.error:
-        return False
\ No newline at end of file
+    return decode_payload_header(data, len(data)) is not None
+
+
+def create_stop_packet():
+    '''
+        This Method is used to create the stop packet, sent by the client to end a time-bounded UDP transfer early.
+        Returns:
+            stop_packet (bytes): The stop packet in binary format.
+    '''
+    # '!I B' means: ! - network byte order, I - unsigned int (4 bytes), B - unsigned char (1 byte)
+    return struct.pack('!I B', 0xabcddcba, 0x5)
+
+
+
+def create_tcp_request(file_size, duration_ms=0, direction=DIRECTION_DOWNLOAD):
+    '''
+        This Method is used to create the request line a TCP client sends: "<file_size>[ <duration_ms>[ <direction>]]\n".
+        Only the fields up to the last one that isn't at its default are sent, like the UDP request.
+        Returns:
+            request_line (bytes): The request line, newline included.
+    '''
+    fields = [file_size, duration_ms, direction]
+    while len(fields) > 1 and fields[-1] == 0:
+        fields.pop()
+    return (' '.join(str(field) for field in fields) + '\n').encode('utf-8')
+
+
+def decode_report_packet(buffer, nbytes):
+    '''
+        This Method is used to decode the server's report of an upload.
+        Args:
+            buffer (bytes-like): The buffer the packet was received into.
+            nbytes (int): The number of bytes received.
+        Returns:
+            (bytes_received, packets_received, duration_ns) (tuple): if the packet is a valid report, None otherwise.
+    '''
+    if nbytes != REPORT_PACKET_SIZE:
+        return None
+    magic_cookie, message_type, bytes_received, packets_received, duration_ns = _REPORT_PACKET.unpack_from(buffer)
+    if magic_cookie != 0xabcddcba or message_type != 0x6:
+        return None
+    return (bytes_received, packets_received, duration_ns)
+
+
+def create_feedback_packet(segments_received, highest_segment):
+    '''
+        This Method is used to create the feedback packet a client sends during an adaptive UDP download.
+        Args:
+            segments_received (int): The number of distinct segments received so far.
+            highest_segment (int): The highest segment number seen so far.
+        Returns:
+            feedback_packet (bytes): The feedback packet in binary format.
+    '''
+    return _FEEDBACK_PACKET.pack(0xabcddcba, 0x7, segments_received, highest_segment)
+
+
+def create_probe_packet(sequence, sent_ns):
+    '''
+        This Method is used to create a latency probe.
+        Args:
+            sequence (int): The probe's sequence number, matches the echo to the probe.
+            sent_ns (int): The send time in nanoseconds, on any clock of the client (it is only echoed).
+        Returns:
+            probe_packet (bytes): The probe packet in binary format.
+    '''
+    return _PROBE_PACKET.pack(0xabcddcba, 0x8, sequence, sent_ns, 0)
+
+
+def decode_probe_packet(buffer, nbytes):
+    '''
+        This Method is used to decode the server's echo of a latency probe.
+        Args:
+            buffer (bytes-like): The buffer the packet was received into.
+            nbytes (int): The number of bytes received.
+        Returns:
+            (sequence, sent_ns, received_ns) (tuple): if the packet is a valid probe, None otherwise.
+    '''
+    if nbytes != PROBE_PACKET_SIZE:
+        return None
+    magic_cookie, message_type, sequence, sent_ns, received_ns = _PROBE_PACKET.unpack_from(buffer)
+    if magic_cookie != 0xabcddcba or message_type != 0x8:
+        return None
+    return (sequence, sent_ns, received_ns)
+
+
+def create_test_frame(file_size, duration_ms=0, direction=DIRECTION_DOWNLOAD):
+    '''
+        This Method is used to create the test frame that starts a test on a persistent TCP connection.
+        Args:
+            file_size (int): The number of bytes to transfer (ignored when duration_ms is set).
+            duration_ms (int): Stream for this long instead, 0 = size-bounded.
+            direction (int): One of the DIRECTION_* values.
+        Returns:
+            test_frame (bytes): The test frame in binary format.
+    '''
+    return _TEST_FRAME.pack(0xabcddcba, 0x9, file_size, duration_ms, direction)
@@ -0,0 +1,367 @@
+import errno
+import socket
+import time
+from EncoderDecoder import BLOCK_HEADER
+from EncoderDecoder import END_BLOCK
+
+# Every TCP upload is streamed out of this one shared buffer in fixed-size chunks,
+# so the client's memory stays flat no matter the size or the number of connections.
+PATTERN_CHUNK_SIZE = 64 * 1024
+_PATTERN_BUFFER = memoryview(b'A' * PATTERN_CHUNK_SIZE)
+# the same chunk as a full data block of a persistent TCP connection (length prefix and data), built once
+_FULL_BLOCK = memoryview(BLOCK_HEADER.pack(PATTERN_CHUNK_SIZE) + b'A' * PATTERN_CHUNK_SIZE)
+
+# Linux UDP generic segmentation offload (UDP_SEGMENT in linux/udp.h, not exported by the socket module):
+# one send of up to UDP_GSO_MAX_SEGMENTS (EncoderDecoder) equal-sized datagrams back to back, split by the kernel
+_SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+_UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+# the path MTU of a connected socket (linux/in.h)
+_IP_MTU = getattr(socket, 'IP_MTU', 14)
+
+# Named socket tuning profiles, applied by create_socket (the server has the same ones).
+# An option that is missing is left at the OS default:
+#   sndbuf / rcvbuf (bytes): SO_SNDBUF / SO_RCVBUF, large enough for the bandwidth-delay product of fast, long paths
+#   nodelay (bool): TCP_NODELAY, send small writes right away instead of coalescing them
+#   congestion (str): TCP_CONGESTION, the congestion control algorithm (if the kernel has it)
+#   notsent_lowat (bytes): TCP_NOTSENT_LOWAT, how much unsent data may queue in the kernel
+#   busy_poll (us): SO_BUSY_POLL, spin on the device queue that long before sleeping in a receive
+TUNING_PROFILES = {
+    'default': {},
+    'high-bdp': {'sndbuf': 16 * 1024 * 1024, 'rcvbuf': 16 * 1024 * 1024, 'congestion': 'bbr'},
+    'low-latency': {'nodelay': True, 'notsent_lowat': 16 * 1024, 'busy_poll': 50},
+}
+# not every Python exports these (values from the Linux headers)
+_SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+_SO_SNDBUFFORCE = getattr(socket, 'SO_SNDBUFFORCE', 32)
+_SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+_TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', 25)
+# TCP data is received into buffers this large, so a fast connection needs few recv calls
+TCP_RECEIVE_SIZE = 256 * 1024
+
+
+
+def _kernel_buffer_limit(option):
+    '''
+        Returns:
+            int: The largest SO_SNDBUF / SO_RCVBUF an unprivileged process may ask for, None if unknown.
+    '''
+    name = 'wmem_max' if option == socket.SO_SNDBUF else 'rmem_max'
+    try:
+        with open(f"/proc/sys/net/core/{name}") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _set_buffer_size(sock, option, force_option, size):
+    '''
+        This Method is used to set a socket buffer size, past the kernel limit if the process is allowed to.
+        Notes:
+            Setting a TCP buffer turns off the kernel's buffer autotuning. When the limit would clamp the
+            buffer below the request, the TCP buffer is left to autotuning, which may grow past the limit.
+    '''
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, force_option, size)
+        return
+    except OSError:
+        pass  # needs CAP_NET_ADMIN
+    limit = _kernel_buffer_limit(option)
+    if sock.type == socket.SOCK_STREAM and limit is not None and limit < size:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+
+def _try_setsockopt(sock, level, option, value):
+    try:
+        sock.setsockopt(level, option, value)
+    except OSError:
+        pass  # keep the OS default
+
+
+def apply_tuning(sock, profile='default'):
+    '''
+        This Method is used to apply a tuning profile to a socket.
+        Args:
+            sock (socket.socket): The socket, TCP sockets must not be connected or listening yet.
+            profile (str): A name from TUNING_PROFILES.
+        Notes:
+            An option the kernel doesn't support (or doesn't allow) is skipped, socket_tuning()
+            tells which values the socket ended up with.
+    '''
+    options = TUNING_PROFILES[profile]
+    try:
+        if 'sndbuf' in options:
+            _set_buffer_size(sock, socket.SO_SNDBUF, _SO_SNDBUFFORCE, options['sndbuf'])
+        if 'rcvbuf' in options:
+            _set_buffer_size(sock, socket.SO_RCVBUF, _SO_RCVBUFFORCE, options['rcvbuf'])
+    except OSError:
+        pass  # keep the OS default
+    if 'busy_poll' in options:
+        _try_setsockopt(sock, socket.SOL_SOCKET, _SO_BUSY_POLL, options['busy_poll'])
+    if sock.type != socket.SOCK_STREAM:
+        return
+    if 'nodelay' in options:
+        _try_setsockopt(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, int(options['nodelay']))
+    if 'congestion' in options and hasattr(socket, 'TCP_CONGESTION'):
+        _try_setsockopt(sock, socket.IPPROTO_TCP, socket.TCP_CONGESTION, options['congestion'].encode())
+    if 'notsent_lowat' in options:
+        _try_setsockopt(sock, socket.IPPROTO_TCP, _TCP_NOTSENT_LOWAT, options['notsent_lowat'])
+
+
+def socket_tuning(sock):
+    '''
+        This Method is used to read the tuning the kernel actually applied to a socket.
+        Returns:
+            tuning (dict): so_sndbuf, so_rcvbuf and so_busy_poll, and for TCP tcp_nodelay and tcp_congestion
+                           (None where the kernel can't tell). Linux reports buffers at twice the size asked
+                           for, the extra half is its bookkeeping overhead.
+    '''
+    def read(level, option, length=0):
+        try:
+            return sock.getsockopt(level, option, length) if length else sock.getsockopt(level, option)
+        except OSError:
+            return None
+
+    tuning = {'so_sndbuf': read(socket.SOL_SOCKET, socket.SO_SNDBUF),
+              'so_rcvbuf': read(socket.SOL_SOCKET, socket.SO_RCVBUF),
+              'so_busy_poll': read(socket.SOL_SOCKET, _SO_BUSY_POLL),
+              'tcp_nodelay': None,
+              'tcp_congestion': None}
+    if sock.type == socket.SOCK_STREAM:
+        nodelay = read(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        tuning['tcp_nodelay'] = bool(nodelay) if nodelay is not None else None
+        if hasattr(socket, 'TCP_CONGESTION'):
+            congestion = read(socket.IPPROTO_TCP, socket.TCP_CONGESTION, 16)
+            if congestion is not None:
+                tuning['tcp_congestion'] = congestion.split(b'\0', 1)[0].decode()
+    return tuning
+
+
+def create_socket(kind, profile='default'):
+    '''
+        This Method is used to create an IPv4 socket tuned with a profile (see apply_tuning).
+        Args:
+            kind (int): socket.SOCK_DGRAM or socket.SOCK_STREAM.
+            profile (str): A name from TUNING_PROFILES.
+        Returns:
+            sock (socket.socket): The created, unbound socket.
+    '''
+    sock = socket.socket(socket.AF_INET, kind)
+    try:
+        apply_tuning(sock, profile)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def send_pattern(conn, size):
+    '''
+        This Method is used to stream demi data over a connected TCP socket.
+        Args:
+            conn (socket.socket): The connected TCP socket.
+            size (int): The number of bytes to send.
+        Notes:
+            The data is sent as slices of a shared preallocated buffer (memoryview slices don't copy).
+    '''
+    remaining = size
+    while remaining >= PATTERN_CHUNK_SIZE:
+        conn.sendall(_PATTERN_BUFFER)
+        remaining -= PATTERN_CHUNK_SIZE
+    if remaining > 0:
+        conn.sendall(_PATTERN_BUFFER[:remaining])
+
+
+def send_pattern_until(conn, deadline):
+    '''
+        This Method is used to stream demi data over a connected TCP socket until a deadline.
+        Args:
+            conn (socket.socket): The connected TCP socket.
+            deadline (float): The time.perf_counter() value to stop at.
+        Returns:
+            sent (int): The number of bytes sent.
+    '''
+    sent = 0
+    while time.perf_counter() < deadline:
+        conn.sendall(_PATTERN_BUFFER)
+        sent += PATTERN_CHUNK_SIZE
+    return sent
+
+
+def send_blocks(conn, size):
+    '''
+        This Method is used to send size bytes of demi data as the data blocks of a persistent TCP
+        connection, then the end block.
+    '''
+    remaining = size
+    while remaining >= PATTERN_CHUNK_SIZE:
+        conn.sendall(_FULL_BLOCK)
+        remaining -= PATTERN_CHUNK_SIZE
+    if remaining > 0:
+        conn.sendall(BLOCK_HEADER.pack(remaining) + _PATTERN_BUFFER[:remaining])
+    conn.sendall(END_BLOCK)
+
+
+def send_blocks_until(conn, deadline):
+    '''
+        This Method is used to send full data blocks until a deadline, then the end block.
+        Returns:
+            sent (int): The number of data bytes sent.
+    '''
+    sent = 0
+    while time.perf_counter() < deadline:
+        conn.sendall(_FULL_BLOCK)
+        sent += PATTERN_CHUNK_SIZE
+    conn.sendall(END_BLOCK)
+    return sent
+
+
+def receive_blocks(conn, counter, buffer_size=TCP_RECEIVE_SIZE):
+    '''
+        This Method is used to receive the data blocks of one direction of a test on a persistent TCP
+        connection, until its end block.
+        Args:
+            conn (socket.socket): The connected TCP socket.
+            counter (object): Its add(nbytes, now) method is called with the data bytes of every receive
+                              (a ReceiveMeter or a ThroughputSampler).
+            buffer_size (int): The size of the preallocated receive buffer.
+        Returns:
+            (total, leftover) (tuple): The number of data bytes, and the bytes received after the end block.
+        Raises:
+            ConnectionError: If the connection closes before the end block.
+    '''
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    recv_into = conn.recv_into
+    total = 0
+    remaining = 0  # data bytes left in the current block
+    header = b""  # a block header split between two receives
+    while True:
+        nbytes = recv_into(view)
+        if nbytes == 0:
+            raise ConnectionError("the connection closed in the middle of a test")
+        position = 0
+        data = 0
+        while position < nbytes:
+            if remaining:
+                taken = min(remaining, nbytes - position)
+                remaining -= taken
+                position += taken
+                data += taken
+                continue
+            missing = BLOCK_HEADER.size - len(header)
+            header += view[position:position + missing]
+            position += min(missing, nbytes - position)
+            if len(header) < BLOCK_HEADER.size:
+                break
+            remaining = BLOCK_HEADER.unpack(header)[0]
+            header = b""
+            if remaining == 0:
+                if data:
+                    counter.add(data, time.perf_counter())
+                return total + data, bytes(view[position:nbytes])
+        if data:
+            counter.add(data, time.perf_counter())
+            total += data
+
+
+def receive_exactly(conn, size):
+    '''
+        This Method is used to receive exactly size bytes from a connected TCP socket.
+        Returns:
+            data (bytes): The received bytes, shorter than size if the connection closed first.
+    '''
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def send_packets(udp_socket, packets, address):
+    '''
+        This Method is used to send a batch of UDP datagrams to one address.
+        Args:
+            udp_socket (socket.socket): The UDP socket to send from.
+            packets (iterable): The datagrams (bytes-like objects) to send.
+            address (tuple): The (ip, port) destination.
+    '''
+    sendto = udp_socket.sendto
+    for packet in packets:
+        sendto(packet, address)
+
+
+def enable_udp_gso(udp_socket, segment_size):
+    '''
+        This Method is used to turn on UDP GSO for a socket, so that one send of a buffer holding
+        several segment_size datagrams back to back leaves as those datagrams (one syscall per batch).
+        Returns:
+            bool: True if the kernel supports it, False otherwise (not Linux, or an older kernel).
+    '''
+    try:
+        udp_socket.setsockopt(_SOL_UDP, _UDP_SEGMENT, segment_size)
+        return True
+    except OSError:
+        return False
+
+
+def disable_udp_gso(udp_socket):
+    '''
+        This Method is used to turn UDP GSO off again, every send is then one datagram.
+    '''
+    udp_socket.setsockopt(_SOL_UDP, _UDP_SEGMENT, 0)
+
+
+def is_gso_rejection(error):
+    '''
+        Returns:
+            bool: True if the OSError of a send means the kernel can't send GSO batches on this path
+                  (EIO when the device can't offload the checksums, EINVAL for a batch it won't segment),
+                  False for any other error (e.g. a full buffer or an unreachable server).
+    '''
+    return error.errno in (errno.EIO, errno.EINVAL)
+
+
+def send_batch(udp_socket, packets, buffer, address, gso):
+    '''
+        This Method is used to send a batch of equal-sized payload packets to one address.
+        Args:
+            udp_socket (socket.socket): The UDP socket to send from.
+            packets (list): The datagrams of the batch.
+            buffer (bytes-like): The same datagrams back to back in one buffer (see PayloadPacketFactory.buffer).
+            address (tuple): The (ip, port) destination.
+            gso (bool): Whether GSO is enabled on the socket (see enable_udp_gso).
+        Returns:
+            bool: Whether GSO is still enabled. If the kernel rejects a GSO send (see is_gso_rejection)
+                  it is turned off and the batch is sent one datagram at a time.
+        Raises:
+            OSError: For any other error of the send.
+    '''
+    if gso:
+        try:
+            udp_socket.sendto(buffer, address)
+            return True
+        except OSError as e:
+            if not is_gso_rejection(e):
+                raise
+            disable_udp_gso(udp_socket)
+    send_packets(udp_socket, packets, address)
+    return False
+
+
+def get_path_mtu(server_ip, default=1500):
+    '''
+        This Method is used to ask the kernel for the MTU of the path to a server.
+        Returns:
+            mtu (int): The path MTU in bytes, default if the kernel can't tell (not Linux).
+        Notes:
+            A connected UDP socket doesn't send anything, connect() only picks the route.
+    '''
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect((server_ip, 9))
+            return s.getsockopt(socket.IPPROTO_IP, _IP_MTU)
+    except OSError:
+        return default
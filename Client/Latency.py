@@ -0,0 +1,200 @@
+import socket
+import threading
+import time
+from array import array
+from EncoderDecoder import create_probe_packet
+from EncoderDecoder import decode_probe_packet
+from EncoderDecoder import PROBE_PACKET_SIZE
+
+# default time between two probes, in seconds
+PROBE_INTERVAL = 0.02
+# a UDP probe without an echo after this many seconds is counted as lost
+PROBE_TIMEOUT = 2.0
+# how long the idle RTT is measured before the load starts, in seconds
+IDLE_PROBE_DURATION = 1.0
+
+
+
+class LatencyProbe:
+    '''
+        Measures the round-trip time to a server with small timestamped probes, one every interval,
+        in a thread of its own so it can run next to the transfers (latency under load).
+        The RTTs go into a preallocated array, so recording one is an index and a store; the array
+        only grows (doubling) when the measurement outlasts the preallocated probes.
+    '''
+
+    def __init__(self, server, protocol='UDP', interval=PROBE_INTERVAL, timeout=PROBE_TIMEOUT, max_probes=1024):
+        '''
+            Args:
+                server (tuple): The (server_ip, udp_port, tcp_port) to probe.
+                protocol (str): 'UDP' probes the server's UDP port, 'TCP' sends the probes over one TCP connection.
+                interval (float): The time between two probes in seconds.
+                timeout (float): How long to wait for the echo of a probe in seconds.
+                max_probes (int): The number of RTTs to preallocate.
+        '''
+        if protocol not in ('UDP', 'TCP'):
+            raise ValueError(f"unknown probe protocol: {protocol}")
+        self.server = server
+        self.protocol = protocol
+        self.interval = interval
+        self.timeout = timeout
+        self._rtts = array('d', bytes(8 * max_probes))
+        self.count = 0
+        self.sent = 0
+        self.error = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''
+            Start probing in the background, until stop() is called.
+        '''
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+            Stop probing and wait for the last probe.
+        '''
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def run(self, duration):
+        '''
+            Probe for duration seconds (blocking).
+        '''
+        self.start()
+        self._stopped.wait(duration)
+        return self.stop()
+
+    def _connect(self):
+        server_ip, udp_port, tcp_port = self.server
+        if self.protocol == 'UDP':
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((server_ip, udp_port))
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # every probe leaves on its own, not coalesced with the next one
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(self.timeout)
+            sock.connect((server_ip, tcp_port))
+        return sock
+
+    def _run(self):
+        try:
+            sock = self._connect()
+        except OSError as e:
+            self.error = str(e)
+            return
+        buffer = bytearray(PROBE_PACKET_SIZE + 1)
+        view = memoryview(buffer)
+        try:
+            sequence = 0
+            next_send = time.perf_counter()
+            while not self._stopped.is_set():
+                sequence += 1
+                sent_ns = time.perf_counter_ns()
+                sock.sendall(create_probe_packet(sequence, sent_ns))
+                self.sent += 1
+                rtt_ns = self._receive_echo(sock, view, sequence, sent_ns)
+                if rtt_ns is not None:
+                    self._record(rtt_ns / 1e9)
+                next_send += self.interval
+                # under load an RTT may outlast the interval, the next probe then leaves right away
+                self._stopped.wait(max(0, next_send - time.perf_counter()))
+        except OSError as e:
+            self.error = str(e)
+        finally:
+            sock.close()
+
+    def _receive_echo(self, sock, view, sequence, sent_ns):
+        '''
+            Wait for the echo of the given probe, skipping late echoes of earlier ones.
+            Returns:
+                int: The RTT in nanoseconds, None if the echo didn't come in time (UDP only, a TCP
+                     probe can't be lost, so a timeout ends the measurement).
+        '''
+        deadline = sent_ns + int(self.timeout * 1e9)
+        while True:
+            remaining = (deadline - time.perf_counter_ns()) / 1e9
+            if remaining <= 0:
+                return None
+            sock.settimeout(remaining)
+            try:
+                if self.protocol == 'UDP':
+                    nbytes = sock.recv_into(view)
+                else:
+                    nbytes = self._receive_exactly(sock, view[:PROBE_PACKET_SIZE])
+            except socket.timeout:
+                if self.protocol == 'TCP':
+                    raise
+                return None
+            echo = decode_probe_packet(view, nbytes)
+            if echo is not None and echo[0] == sequence:
+                return time.perf_counter_ns() - echo[1]
+
+    @staticmethod
+    def _receive_exactly(sock, view):
+        filled = 0
+        while filled < len(view):
+            nbytes = sock.recv_into(view[filled:])
+            if nbytes == 0:
+                raise ConnectionResetError("the server closed the probe connection")
+            filled += nbytes
+        return filled
+
+    def _record(self, rtt):
+        if self.count >= len(self._rtts):
+            self._rtts.frombytes(bytes(8 * len(self._rtts)))
+        self._rtts[self.count] = rtt
+        self.count += 1
+
+    @property
+    def lost(self):
+        return self.sent - self.count
+
+    def rtts(self):
+        '''
+            Returns:
+                list: The RTT of every answered probe so far, in seconds.
+        '''
+        return self._rtts[:self.count].tolist()
+
+    def percentiles(self, percents=(50, 90, 99)):
+        '''
+            Returns:
+                dict: percent -> RTT in seconds (nearest rank), None for each if no probe was answered.
+        '''
+        rtts = sorted(self._rtts[:self.count])
+        if not rtts:
+            return {percent: None for percent in percents}
+        return {percent: rtts[min(len(rtts) - 1, max(0, round(percent / 100 * len(rtts)) - 1))] for percent in percents}
+
+    def summary(self):
+        '''
+            Returns:
+                dict: probes_sent, probes_lost and rtt_min, rtt_p50, rtt_p90, rtt_p99, rtt_max in seconds.
+        '''
+        percentiles = self.percentiles()
+        rtts = self._rtts[:self.count]
+        return {'probes_sent': self.sent, 'probes_lost': self.lost,
+                'rtt_min': min(rtts) if rtts else None,
+                'rtt_p50': percentiles[50], 'rtt_p90': percentiles[90], 'rtt_p99': percentiles[99],
+                'rtt_max': max(rtts) if rtts else None}
+
+    def report(self, label):
+        '''
+            Returns:
+                str: A line with the RTT percentiles and the probe loss.
+        '''
+        if self.error is not None and not self.count:
+            return f"{label} RTT: no measurement ({self.error})"
+        summary = self.summary()
+        if not self.count:
+            return f"{label} RTT: no probe answered ({summary['probes_sent']} sent)"
+        return (f"{label} RTT ({self.protocol}, {self.count} probes): min {summary['rtt_min'] * 1000:.3f}, " +
+                ", ".join(f"p{percent} {summary[f'rtt_p{percent}'] * 1000:.3f}" for percent in (50, 90, 99)) +
+                f", max {summary['rtt_max'] * 1000:.3f} ms, lost {summary['probes_lost']}")
@@ -0,0 +1,62 @@
+import time
+
+
+
+class TokenBucket:
+    '''
+        Paces a sender to a target bitrate.
+        Tokens (bytes) refill continuously at the target rate up to the bucket size.
+        A sender reserves the bytes of a whole batch of datagrams at once and sleeps off
+        the debt, so there is one wakeup per batch instead of one per datagram.
+        Oversleeping is harmless: the refill is computed from perf_counter(), so the next
+        batch simply goes out sooner and the average rate stays on target.
+    '''
+
+    def __init__(self, rate_bps, burst_bytes):
+        '''
+            Args:
+                rate_bps (int): The target rate in bits per second.
+                burst_bytes (int): The bucket size, the most that may be sent back to back.
+        '''
+        self.burst_bytes = burst_bytes
+        self.set_rate(rate_bps)
+        self._tokens = burst_bytes
+        self._last = time.perf_counter()
+
+    def set_rate(self, rate_bps):
+        '''
+            Change the target rate, takes effect from the next reservation.
+        '''
+        self.rate_bps = rate_bps
+        self._bytes_per_second = rate_bps / 8
+
+    def packets_per_wakeup(self, packet_size, max_packets, wakeup_interval=0.001):
+        '''
+            Returns:
+                int: How many packets of the given size to send per wakeup so the sender
+                     wakes up about once per wakeup_interval seconds (at least 1, at most max_packets).
+        '''
+        packets = int(self._bytes_per_second * wakeup_interval // packet_size)
+        return max(1, min(max_packets, packets))
+
+    def reserve(self, nbytes):
+        '''
+            Take nbytes tokens, going into debt if there are not enough.
+            Returns:
+                float: The number of seconds to wait before sending the reserved bytes (0 if none).
+        '''
+        now = time.perf_counter()
+        self._tokens = min(self.burst_bytes, self._tokens + (now - self._last) * self._bytes_per_second)
+        self._last = now
+        self._tokens -= nbytes
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self._bytes_per_second
+
+    def consume(self, nbytes):
+        '''
+            Block until nbytes may be sent at the target rate.
+        '''
+        delay = self.reserve(nbytes)
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,90 @@
+# Received datagrams land in one of these preallocated buffers instead of a new
+# bytes object per recvfrom(); big enough for any payload packet plus slack so an
+# oversized datagram shows up as a wrong length instead of passing as a valid one.
+RECEIVE_BUFFER_SIZE = 2048
+# the most memory a ring of buffers may take, large payloads get fewer buffers
+RING_MEMORY = 256 * 1024
+
+
+
+class UdpReceiver:
+    '''
+        Receives datagrams with recvfrom_into into a preallocated ring of buffers.
+        A received packet stays valid until ring_size more packets have been received,
+        so callers can look back at recent packets without copying them.
+        Notes:
+            Python has no recvmmsg(), so each datagram still costs one syscall, but none
+            of them allocates.
+    '''
+
+    def __init__(self, udp_socket, buffer_size=RECEIVE_BUFFER_SIZE, ring_size=None):
+        '''
+            Args:
+                udp_socket (socket.socket): The socket to receive from.
+                buffer_size (int): The size of each buffer, larger than the largest expected datagram.
+                ring_size (int): The number of buffers, by default 64 or as many as fit in RING_MEMORY.
+        '''
+        if ring_size is None:
+            ring_size = max(2, min(64, RING_MEMORY // buffer_size))
+        self._recvfrom_into = udp_socket.recvfrom_into
+        self._buffers = [bytearray(buffer_size) for _ in range(ring_size)]
+        self._ring_size = ring_size
+        self._next = 0
+
+    def receive(self):
+        '''
+            Block until a datagram arrives (or the socket's timeout expires).
+            Returns:
+                (buffer, nbytes, address) (tuple): the ring buffer holding the datagram,
+                the number of bytes received and the sender's (ip, port).
+            Raises:
+                socket.timeout: If the socket has a timeout and it expires.
+        '''
+        buffer = self._buffers[self._next]
+        self._next = (self._next + 1) % self._ring_size
+        nbytes, address = self._recvfrom_into(buffer)
+        return buffer, nbytes, address
+
+
+
+class AdaptiveIdleTimeout:
+    '''
+        Decides when a UDP transfer is over from the packet inter-arrival times.
+        The timeout is a few smoothed inter-arrival gaps (clamped to [minimum, maximum]),
+        so a fast stream is declared over milliseconds after it stops instead of after a
+        fixed second. It also remembers the first and last arrival times, so the transfer
+        time excludes the idle wait at the end.
+    '''
+
+    def __init__(self, initial=1.0, minimum=0.02, maximum=1.0, gaps=8, smoothing=1/16):
+        '''
+            Args:
+                initial (float): The timeout before the first packet arrives, in seconds.
+                minimum (float): The smallest timeout ever used, in seconds.
+                maximum (float): The largest timeout ever used, in seconds.
+                gaps (int): How many smoothed inter-arrival gaps of silence end the transfer.
+                smoothing (float): The weight of a new gap in the moving average.
+        '''
+        self.timeout = initial
+        self._minimum = minimum
+        self._maximum = maximum
+        self._gaps = gaps
+        self._smoothing = smoothing
+        self._average_gap = None
+        self.first_arrival = None
+        self.last_arrival = None
+
+    def arrival(self, now):
+        '''
+            Record a packet arrival at time now (time.perf_counter()).
+        '''
+        if self.first_arrival is None:
+            self.first_arrival = now
+        else:
+            gap = now - self.last_arrival
+            if self._average_gap is None:
+                self._average_gap = gap
+            else:
+                self._average_gap += (gap - self._average_gap) * self._smoothing
+            self.timeout = min(self._maximum, max(self._minimum, self._gaps * self._average_gap))
+        self.last_arrival = now
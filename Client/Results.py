@@ -0,0 +1,142 @@
+import csv
+import json
+import threading
+
+# The columns of a result record, in CSV order.
+# record is 'transfer' for one connection and 'summary' for the aggregate of a run.
+# direction is 'download' or 'upload', a bidirectional transfer has a record for each.
+# payload_size is the payload bytes per packet of a UDP transfer.
+# tuning is the socket tuning profile, so_* and tcp_* the values the kernel applied to the socket.
+# A 'latency' record holds the RTT probes of a run, in its 'idle' or 'loaded' phase (rtt_* in seconds).
+RESULT_FIELDS = ('record', 'run', 'timestamp', 'protocol', 'direction', 'id', 'file_size', 'payload_size', 'test_duration', 'bytes_received', 'duration',
+                 'bitrate_bps', 'loss_percent', 'segments_lost', 'duplicates', 'reordered', 'max_reorder_distance',
+                 'longest_loss_burst', 'interval', 'interval_bytes', 'phase', 'probes_sent', 'probes_lost', 'rtt_min',
+                 'rtt_p50', 'rtt_p90', 'rtt_p99', 'rtt_max', 'tuning', 'so_sndbuf', 'so_rcvbuf', 'so_busy_poll',
+                 'tcp_nodelay', 'tcp_congestion', 'error')
+
+
+
+def new_result(protocol, id, file_size, **fields):
+    '''
+        This Method is used to create a transfer result record.
+        Args:
+            protocol (str): 'TCP' or 'UDP'.
+            id (int): The number of the connection within its run.
+            file_size (int): The requested file size in bytes.
+            fields: values for any of the other RESULT_FIELDS (direction is 'download' unless given).
+        Returns:
+            result (dict): A record with every field of RESULT_FIELDS (None where unknown).
+    '''
+    result = dict.fromkeys(RESULT_FIELDS)
+    result.update(record='transfer', protocol=protocol, direction='download', id=id, file_size=file_size)
+    result.update(fields)
+    return result
+
+
+def latency_result(probe, phase, run=None, timestamp=None):
+    '''
+        This Method is used to create the latency record of a LatencyProbe.
+        Args:
+            probe (LatencyProbe): The finished probe.
+            phase (str): 'idle' or 'loaded'.
+        Returns:
+            result (dict): A 'latency' record, protocol is the probes' protocol and interval the time between them.
+    '''
+    return new_result(probe.protocol, None, None, record='latency', direction=None, run=run, timestamp=timestamp,
+                      phase=phase, interval=probe.interval, error=probe.error, **probe.summary())
+
+
+def summarize(results, run=None, timestamp=None):
+    '''
+        This Method is used to aggregate the transfer results of one run, per protocol and direction.
+        Returns:
+            summaries (list): One 'summary' record per protocol and direction, where id is the number of
+            connections, bytes_received the total, duration the longest transfer,
+            bitrate_bps the aggregate rate and loss_percent the mean loss.
+    '''
+    summaries = []
+    for protocol, direction in sorted({(result['protocol'], result['direction']) for result in results}):
+        group = [result for result in results if result['protocol'] == protocol and result['direction'] == direction]
+        transfers = [result for result in group if result['error'] is None]
+        failed = len(group) - len(transfers)
+        total_bytes = sum(result['bytes_received'] for result in transfers)
+        duration = max((result['duration'] for result in transfers), default=0)
+        losses = [result['loss_percent'] for result in transfers if result['loss_percent'] is not None]
+        summaries.append(new_result(protocol, len(transfers), None, record='summary', direction=direction,
+                                    run=run, timestamp=timestamp, tuning=group[0]['tuning'],
+                                    bytes_received=total_bytes, duration=duration,
+                                    bitrate_bps=total_bytes * 8 / duration if duration > 0 else 0,
+                                    loss_percent=sum(losses) / len(losses) if losses else None,
+                                    error=f"{failed} failed" if failed else None))
+    return summaries
+
+
+
+def check_csv_header(path):
+    '''
+        This Method is used to make sure records can be appended to a CSV file: it must be empty (or missing),
+        or start with the header of RESULT_FIELDS.
+        Raises:
+            ValueError: If the file has another header, e.g. written by a version with other columns.
+    '''
+    try:
+        with open(path, newline='') as f:
+            header = next(csv.reader(f), None)
+    except FileNotFoundError:
+        return
+    if header is not None and tuple(header) != RESULT_FIELDS:
+        raise ValueError(f"{path} has other columns than this version writes, choose a new results file")
+
+
+class ResultsWriter:
+    '''
+        Appends result records to a JSON Lines or CSV file through a buffered stream.
+        Records are written as they come (from any thread) and nothing is kept in memory,
+        so a long campaign can write thousands of records to one file.
+    '''
+
+    def __init__(self, path, format=None, buffer_size=64 * 1024):
+        '''
+            Args:
+                path (str): The file to append to.
+                format (str): 'jsonl' or 'csv', by default taken from the file extension (jsonl otherwise).
+                buffer_size (int): The size of the write buffer in bytes.
+            Raises:
+                ValueError: If the format is unknown, or a CSV file has other columns (see check_csv_header).
+        '''
+        if format is None:
+            format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+        if format not in ('jsonl', 'csv'):
+            raise ValueError(f"unknown results format: {format}")
+        self.format = format
+        if format == 'csv':
+            check_csv_header(path)
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', buffering=buffer_size, newline='')
+        self._csv = None
+        if format == 'csv':
+            self._csv = csv.DictWriter(self._file, fieldnames=RESULT_FIELDS)
+            if self._file.tell() == 0:
+                self._csv.writeheader()
+
+    def write(self, result):
+        '''
+            Append one result record.
+        '''
+        with self._lock:
+            if self._csv is not None:
+                row = dict(result)
+                if row['interval_bytes'] is not None:
+                    row['interval_bytes'] = ' '.join(str(nbytes) for nbytes in row['interval_bytes'])
+                self._csv.writerow(row)
+            else:
+                self._file.write(json.dumps(result, separators=(',', ':')))
+                self._file.write('\n')
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,79 @@
+from array import array
+
+# default length of one sampling interval, in seconds
+SAMPLE_INTERVAL = 0.1
+
+
+
+class ThroughputSampler:
+    '''
+        Samples the bytes received per fixed time interval of a transfer.
+        The counters live in a preallocated array, so recording a receive is one
+        index computation and one addition; the array only grows (doubling) when a
+        transfer outlasts the preallocated intervals.
+    '''
+
+    def __init__(self, start_time, interval=SAMPLE_INTERVAL, max_samples=600):
+        '''
+            Args:
+                start_time (float): The time.perf_counter() value the intervals are counted from.
+                interval (float): The length of an interval in seconds.
+                max_samples (int): The number of intervals to preallocate.
+        '''
+        self.start_time = start_time
+        self.interval = interval
+        self._samples = array('Q', bytes(8 * max_samples))
+        self._used = 0
+
+    def add(self, nbytes, now):
+        '''
+            Record nbytes received at time now (time.perf_counter()).
+        '''
+        index = int((now - self.start_time) / self.interval)
+        if index >= len(self._samples):
+            self._samples.frombytes(bytes(8 * max(len(self._samples), index + 1 - len(self._samples))))
+        self._samples[index] += nbytes
+        if index >= self._used:
+            self._used = index + 1
+
+    def samples(self):
+        '''
+            Returns:
+                list: The bytes received in every interval so far (the last one may be partial).
+        '''
+        return self._samples[:self._used].tolist()
+
+    def rates_bps(self):
+        '''
+            Returns:
+                list: The rate of every interval so far in bits/second (the last one may be partial).
+        '''
+        return [nbytes * 8 / self.interval for nbytes in self._samples[:self._used]]
+
+    def percentiles(self, percents=(5, 50, 95)):
+        '''
+            Returns:
+                dict: percent -> interval rate in bits/second (nearest rank), over the
+                      complete intervals (all of them if there is only one).
+        '''
+        rates = self.rates_bps()
+        if len(rates) > 1:
+            rates = rates[:-1]  # the last interval is cut short by the end of the transfer
+        if not rates:
+            return {percent: 0 for percent in percents}
+        rates.sort()
+        return {percent: rates[min(len(rates) - 1, max(0, round(percent / 100 * len(rates)) - 1))] for percent in percents}
+
+    def report(self, label, intervals=False):
+        '''
+            Returns:
+                str: A line with the rate percentiles, preceded by one line per interval if intervals is True.
+        '''
+        lines = []
+        if intervals:
+            for index, rate in enumerate(self.rates_bps()):
+                lines.append(f"{label} {index * self.interval:6.2f}-{(index + 1) * self.interval:6.2f} s: {rate:.0f} bits/second")
+        percentiles = self.percentiles()
+        lines.append(f"{label} interval rates ({self.interval * 1000:.0f} ms): " +
+                     ", ".join(f"p{percent}: {rate:.0f}" for percent, rate in percentiles.items()) + " bits/second")
+        return "\n".join(lines)
@@ -0,0 +1,113 @@
+# The most segments a transfer whose total isn't known yet is tracked for (16 MB of bit array, 64 GB
+# of 512-byte payloads). A segment number past it, e.g. from a corrupted or spoofed packet, is counted
+# as invalid instead of growing the bit array.
+MAX_SEGMENTS = 1 << 27
+
+
+
+class SegmentTracker:
+    '''
+        Tracks which segments of a UDP transfer arrived, in a bit array (1 bit per segment).
+        Recording a packet is O(1); loss bursts are found by one scan over the bit array
+        when the transfer is over.
+    '''
+
+    def __init__(self, total_segments=0, max_segments=MAX_SEGMENTS):
+        '''
+            Args:
+                total_segments (int): The number of segments the server sends, 0 if it is not known
+                                      yet (time-bounded transfers): the bit array then grows with the
+                                      highest segment seen, until set_total() is called.
+                max_segments (int): The highest segment number accepted while the total isn't known.
+        '''
+        self.total_segments = total_segments
+        self.max_segments = max_segments
+        self._bitmap = bytearray((total_segments + 7) // 8)
+        self.received = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.reordered = 0
+        self.max_reorder_distance = 0
+        self.highest_segment = 0
+
+    def record(self, segment_number):
+        '''
+            Record the arrival of a segment.
+            Args:
+                segment_number (int): The segment number from the payload packet (1-based).
+            Returns:
+                bool: True if this segment was new, False if it was a duplicate or out of range.
+        '''
+        if segment_number < 1 or segment_number > (self.total_segments or self.max_segments):
+            self.invalid += 1
+            return False
+        index = segment_number - 1
+        if index >> 3 >= len(self._bitmap):
+            # unknown total, grow by doubling (up to max_segments) so recording stays O(1) amortized
+            size = min(max(2 * len(self._bitmap), (index >> 3) + 1), (self.max_segments + 7) // 8)
+            self._bitmap.extend(bytes(size - len(self._bitmap)))
+        mask = 1 << (index & 7)
+        byte = self._bitmap[index >> 3]
+        if byte & mask:
+            self.duplicates += 1
+            return False
+        self._bitmap[index >> 3] = byte | mask
+        self.received += 1
+        if segment_number < self.highest_segment:
+            # arrived after a later segment
+            self.reordered += 1
+            distance = self.highest_segment - segment_number
+            if distance > self.max_reorder_distance:
+                self.max_reorder_distance = distance
+        else:
+            self.highest_segment = segment_number
+        return True
+
+    def set_total(self, total_segments):
+        '''
+            Set the number of segments once a time-bounded transfer announces it.
+            A total above max_segments is ignored (counted as invalid), like a segment number would be.
+        '''
+        if total_segments > self.max_segments:
+            self.invalid += 1
+            return
+        self.total_segments = total_segments
+
+    @property
+    def expected(self):
+        '''
+            The number of segments expected so far: the total if known, the highest segment seen otherwise.
+        '''
+        return self.total_segments or self.highest_segment
+
+    @property
+    def lost(self):
+        return self.expected - self.received
+
+    @property
+    def complete(self):
+        return self.total_segments > 0 and self.received == self.total_segments
+
+    def longest_loss_burst(self):
+        '''
+            Returns:
+                int: The longest run of consecutive missing segments.
+        '''
+        longest = 0
+        current = 0
+        total = self.expected
+        for byte_index, byte in enumerate(self._bitmap[:(total + 7) // 8]):
+            if byte == 0xFF:
+                current = 0
+                continue
+            if byte == 0 and (byte_index + 1) * 8 <= total:
+                current += 8
+                longest = max(longest, current)
+                continue
+            for bit in range(min(8, total - byte_index * 8)):
+                if byte >> bit & 1:
+                    current = 0
+                else:
+                    current += 1
+                    longest = max(longest, current)
+        return longest
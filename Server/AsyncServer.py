@@ -0,0 +1,615 @@
+import asyncio
+import signal
+import socket
+import time
+from EncoderDecoder import create_offer_packet
+from EncoderDecoder import decode_request_packet
+from EncoderDecoder import decode_tcp_request
+from EncoderDecoder import is_stop_packet
+from EncoderDecoder import PayloadPacketFactory
+from EncoderDecoder import PAYLOAD_SIZE
+from EncoderDecoder import DIRECTION_DOWNLOAD
+from EncoderDecoder import DIRECTION_UPLOAD
+from EncoderDecoder import DIRECTION_BIDIRECTIONAL
+from EncoderDecoder import DIRECTION_NAMES
+from EncoderDecoder import create_report_packet
+from EncoderDecoder import decode_payload_header
+from EncoderDecoder import decode_feedback_packet
+from EncoderDecoder import create_probe_echo
+from EncoderDecoder import PROBE_PACKET_SIZE
+from EncoderDecoder import BINARY_FIRST_BYTE
+from EncoderDecoder import BINARY_HEADER_SIZE
+from EncoderDecoder import TEST_FRAME_SIZE
+from EncoderDecoder import BLOCK_HEADER
+from EncoderDecoder import END_BLOCK
+from EncoderDecoder import binary_message_type
+from EncoderDecoder import decode_test_frame
+from Helpers import pattern_chunks
+from Helpers import block_chunks
+from Helpers import add_active_clients
+from Helpers import get_active_clients
+from Helpers import ReceiveMeter
+from Helpers import UPLOAD_IDLE_TIMEOUT
+from Helpers import SESSION_IDLE_TIMEOUT
+from Helpers import REPORT_COPIES
+from Helpers import TCP_RECEIVE_SIZE
+from Helpers import enable_udp_gso
+from Helpers import disable_udp_gso
+from Helpers import is_gso_rejection
+from Helpers import create_socket
+from Pacer import create_pacer
+from Metrics import metrics
+from Metrics import log
+
+# The event loop engine serves every client from one thread.
+# Senders yield to the loop after every batch / chunk, and wait whenever the
+# kernel buffers are full, so one fast client cannot starve the others.
+
+# the most a paced UDP sender may send back to back, in bytes
+UDP_PACING_BURST = 64 * 1024
+
+
+
+class Admission:
+    '''
+        Counts the clients being served per protocol and rejects new ones above the limit.
+    '''
+
+    def __init__(self, max_clients):
+        self.max_clients = max_clients
+        self.active = {'UDP': 0, 'TCP': 0}
+        self.rejected = {'UDP': 0, 'TCP': 0}
+
+    def acquire(self, protocol):
+        if self.active[protocol] >= self.max_clients:
+            self.rejected[protocol] += 1
+            metrics.count(protocol, 'rejected')
+            return False
+        self.active[protocol] += 1
+        add_active_clients(1)
+        return True
+
+    def release(self, protocol):
+        self.active[protocol] -= 1
+        add_active_clients(-1)
+
+    def stats(self):
+        '''
+            Returns:
+                dict: max_clients, and the active and rejected clients per protocol.
+        '''
+        return {'max_clients': self.max_clients, 'active': dict(self.active), 'rejected': dict(self.rejected)}
+
+
+
+class _FlowControlProtocol(asyncio.DatagramProtocol):
+    '''
+        A datagram protocol that lets a sender wait until the transport's buffer drains,
+        notices the client's stop packet, measures the payload packets the client uploads
+        and hands the feedback of an adaptive download to the rate controller.
+    '''
+
+    def __init__(self):
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._stop = asyncio.Event()
+        self.stopped = False
+        self.meter = ReceiveMeter()
+        self.controller = None
+        self.payload_size = PAYLOAD_SIZE
+        self.send_errors = 0
+        # the kernel refused a GSO send (see is_gso_rejection)
+        self.gso_rejected = False
+
+    def datagram_received(self, data, addr):
+        if decode_payload_header(data, len(data), self.payload_size) is not None:
+            self.meter.add(self.payload_size, time.perf_counter())
+        elif is_stop_packet(data):
+            self.stopped = True
+            self._stop.set()
+        elif self.controller is not None:
+            feedback = decode_feedback_packet(data)
+            if feedback is not None:
+                self.controller.feedback(*feedback)
+
+    async def upload_finished(self):
+        '''
+            Wait for the client's stop packet, or until no upload data arrived for UPLOAD_IDLE_TIMEOUT seconds.
+        '''
+        while not self.stopped:
+            packets = self.meter.packets
+            try:
+                await asyncio.wait_for(self._stop.wait(), UPLOAD_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if self.meter.packets == packets:
+                    return
+
+    def error_received(self, exc):
+        self.send_errors += 1
+        if is_gso_rejection(exc):
+            self.gso_rejected = True
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    async def writable(self):
+        await self._writable.wait()
+
+
+
+class UdpRequestProtocol(asyncio.DatagramProtocol):
+    '''
+        Receives UDP requests on the server's UDP port and starts a sender task for each one.
+    '''
+
+    def __init__(self, admission):
+        self._admission = admission
+        self._tasks = set()
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        # latency probes are echoed right away, they don't take a client's place
+        echo = create_probe_echo(data, time.time_ns())
+        if echo is not None:
+            self._transport.sendto(echo, addr)
+            metrics.count('UDP', 'probes')
+            return
+        if not self._admission.acquire('UDP'):
+            log(f"[UDP client {addr}] Rejected, server is busy")
+            return
+        task = asyncio.ensure_future(handle_udp_client(data, addr))
+        # keep a reference, the loop only keeps weak references to tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        self._admission.release('UDP')
+        if not task.cancelled() and task.exception() is not None:
+            metrics.count('UDP', 'errors')
+            log(f"[ERROR] Error handling UDP client: {task.exception()}")
+
+    def error_received(self, exc):
+        log(f"[ERROR] Error receiving UDP message: {exc}")
+
+
+
+async def broadcast_offer(udp_port, tcp_port, advertise_load=False):
+    '''
+        Broadcast the offer packet every second.
+        With advertise_load the offer also carries the number of clients being served.
+    '''
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, local_addr=('0.0.0.0', 0),
+                                                       allow_broadcast=True)
+    offer_packet = create_offer_packet(udp_port, tcp_port)
+    try:
+        while True:
+            if advertise_load:
+                offer_packet = create_offer_packet(udp_port, tcp_port, get_active_clients())
+            transport.sendto(offer_packet, ('255.255.255.255', 13117))
+            await asyncio.sleep(1)
+    finally:
+        transport.close()
+
+
+
+async def handle_udp_client(message, address):
+    request = decode_request_packet(message)
+    if request is None:
+        return
+    target = f"{request.duration_ms} ms" if request.duration_ms else f"{request.file_size} bytes"
+    rate_info = f" at {request.rate_bps} bits/second" if request.rate_bps else ""
+    if request.adaptive:
+        rate_info += " (adaptive)"
+    payload_size = request.payload_size or PAYLOAD_SIZE
+    log(f"[UDP client {address}] Received UDP message: {DIRECTION_NAMES[request.direction]} {target}{rate_info}, "
+        f"{payload_size} byte payloads")
+    loop = asyncio.get_running_loop()
+    # a tuned socket of our own, connected to the client
+    udp_socket = create_socket(socket.SOCK_DGRAM)
+    try:
+        udp_socket.setblocking(False)
+        udp_socket.connect(address)
+    except OSError:
+        udp_socket.close()
+        raise
+    transport, protocol = await loop.create_datagram_endpoint(_FlowControlProtocol, sock=udp_socket)
+    protocol.payload_size = payload_size
+    number_of_segments = 0
+    try:
+        with metrics.track('UDP', address, DIRECTION_NAMES[request.direction]) as stats:
+            stats.attach_meter(protocol.meter)
+            if request.direction == DIRECTION_DOWNLOAD:
+                number_of_segments = await send_udp_segments(transport, protocol, request, stats)
+            else:
+                # the empty report tells the client where to upload, the final one what arrived
+                transport.sendto(create_report_packet(0, 0, 0))
+                if request.direction == DIRECTION_BIDIRECTIONAL:
+                    number_of_segments, _ = await asyncio.gather(send_udp_segments(transport, protocol, request, stats),
+                                                                 protocol.upload_finished())
+                else:
+                    await protocol.upload_finished()
+                meter = protocol.meter
+                report_packet = create_report_packet(meter.bytes, meter.packets, meter.duration_ns)
+                for _ in range(REPORT_COPIES):
+                    transport.sendto(report_packet)
+                log(f"[UDP client {address}] received {meter.bytes} bytes in {meter.packets} segments")
+            stats.send_errors += protocol.send_errors
+    finally:
+        transport.close()
+    if request.direction != DIRECTION_UPLOAD:
+        log(f"[UDP client {address}] sent {number_of_segments * payload_size} bytes in {number_of_segments} segments")
+
+
+async def send_udp_segments(transport, protocol, request, stats=None):
+    '''
+        Send the payload packets of a request, like Server.send_udp_segments but on the event loop.
+        The client's feedback reaches the rate controller of an adaptive stream through the protocol.
+        stats (ClientStats) counts the packets sent as they go (optional).
+        Returns:
+            int: The number of segments sent.
+    '''
+    packet_factory = PayloadPacketFactory(payload_size=protocol.payload_size)
+    # the kernel splits one send of the whole batch into its packets
+    udp_socket = transport.get_extra_info('socket')
+    gso = packet_factory.batch_size > 1 and enable_udp_gso(udp_socket, packet_factory.packet_size)
+    pacer, controller = create_pacer(request.rate_bps, request.adaptive, UDP_PACING_BURST)
+    # the protocol hands the client's feedback to the controller
+    protocol.controller = controller
+    batch_size = packet_factory.batch_size
+    if pacer is not None:
+        batch_size = pacer.packets_per_wakeup(packet_factory.packet_size, batch_size)
+    number_of_segments = None
+    if request.duration_ms:
+        deadline = time.perf_counter() + request.duration_ms / 1000
+    else:
+        file_size = request.file_size
+        payload_size = protocol.payload_size
+        number_of_segments = file_size//payload_size if file_size % payload_size == 0 else file_size//payload_size+1
+    segment = 1
+    while True:
+        if controller is not None:
+            # the rate may have changed with the last feedback
+            batch_size = pacer.packets_per_wakeup(packet_factory.packet_size, packet_factory.batch_size)
+        if number_of_segments is None:
+            if time.perf_counter() >= deadline or protocol.stopped:
+                # the last packet of a time-bounded stream carries its segment number as the total
+                transport.sendto(packet_factory.packet(segment, segment))
+                if stats is not None:
+                    stats.packets_sent += 1
+                    stats.bytes_sent += protocol.payload_size
+                break
+            packets = packet_factory.batch(0, segment, batch_size)
+        else:
+            if segment > number_of_segments:
+                segment = number_of_segments
+                break
+            packets = packet_factory.batch(number_of_segments, segment, min(batch_size, number_of_segments - segment + 1))
+        if pacer is not None:
+            delay = pacer.reserve(len(packets) * packet_factory.packet_size)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if gso:
+            transport.sendto(packet_factory.buffer(len(packets)))
+            if protocol.gso_rejected:
+                # the kernel rejected the GSO send (reported through error_received), resend one datagram at a time
+                disable_udp_gso(udp_socket)
+                gso = False
+        if not gso:
+            for packet in packets:
+                transport.sendto(packet)
+        if stats is not None:
+            stats.packets_sent += len(packets)
+            stats.bytes_sent += len(packets) * protocol.payload_size
+        segment += len(packets)
+        # let the other clients run, and wait if the socket buffer is full
+        await asyncio.sleep(0)
+        await protocol.writable()
+    if controller is not None:
+        log(f"[UDP client {transport.get_extra_info('peername')}] {controller.summary()}")
+    return segment
+
+
+
+async def handle_tcp_client(reader, writer, admission):
+    addr = writer.get_extra_info('peername')
+    if not admission.acquire('TCP'):
+        log(f"[TCP CLIENT {addr}] Rejected, server is busy")
+        writer.close()
+        return
+    try:
+        log(f"[TCP CLIENT {addr}] Accepted TCP connection")
+        with metrics.track('TCP', addr) as stats:
+            first = await reader.read(1)
+            if not first:  # closed without a request, e.g. a client measuring the RTT
+                return
+            if first == BINARY_FIRST_BYTE:
+                # latency probes or a persistent connection instead of a request line
+                await serve_binary_connection(reader, writer, addr, first, stats)
+                return
+            line = first + await reader.readline()
+            if not line.endswith(b'\n'):  # Client disconnected
+                raise Exception("illegal byte from client")
+            await serve_tcp_test(reader, writer, addr, decode_tcp_request(line.rstrip(b'\n')), stats)
+    except asyncio.CancelledError:
+        pass  # the server is shutting down, the stream's callback would report the cancellation as an error
+    except Exception as e:
+        metrics.count('TCP', 'errors')
+        log(f"[FROM TCP CLIENT {addr}] Error handling TCP connection: {e}")
+    finally:
+        admission.release('TCP')
+        writer.close()
+
+
+async def serve_tcp_test(reader, writer, addr, request, stats, framed=False):
+    '''
+        Serve one TCP test: the download, the upload and its report, or both at once.
+        A legacy test streams raw bytes and its upload ends when the client shuts down its side,
+        a framed test (of a persistent connection) sends and receives data blocks.
+    '''
+    stats.direction = DIRECTION_NAMES[request.direction]
+    if request.direction == DIRECTION_DOWNLOAD:
+        file_size = await send_tcp_download(writer, request, stats, framed)
+        log(f"[TCP CLIENT {addr}] Sent {file_size} bytes to client")
+        return
+    # the report is the last thing we send for an upload
+    meter = ReceiveMeter()
+    stats.attach_meter(meter)
+    receive = receive_blocks(reader, meter) if framed else receive_all(reader, meter)
+    if request.direction == DIRECTION_BIDIRECTIONAL:
+        file_size, _ = await asyncio.gather(send_tcp_download(writer, request, stats, framed), receive)
+        log(f"[TCP CLIENT {addr}] Sent {file_size} bytes to client")
+    else:
+        await receive
+    writer.write(create_report_packet(meter.bytes, 0, meter.duration_ns))
+    await writer.drain()
+    log(f"[TCP CLIENT {addr}] Received {meter.bytes} bytes from client")
+
+
+async def serve_binary_connection(reader, writer, addr, first, stats):
+    '''
+        Serve a TCP connection that starts with a binary packet instead of a request line:
+        latency probes, or the test frame of a persistent connection.
+    '''
+    header = first + await reader.readexactly(BINARY_HEADER_SIZE - len(first))
+    message_type = binary_message_type(header)
+    if message_type == 0x8:
+        stats.direction = 'probes'
+        probes = await echo_tcp_probes(reader, writer, header)
+        metrics.count('TCP', 'probes', probes)
+        log(f"[TCP CLIENT {addr}] Echoed {probes} latency probes")
+    elif message_type == 0x9:
+        frame = header + await reader.readexactly(TEST_FRAME_SIZE - BINARY_HEADER_SIZE)
+        # the end block and the report are small writes, Nagle would hold them back until the client's
+        # delayed ACK of the test's last data (some 40 ms on every test after the first)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tests = await serve_tcp_session(reader, writer, addr, frame, stats)
+        log(f"[TCP CLIENT {addr}] Served {tests} tests on a persistent connection")
+    else:
+        raise Exception("illegal binary packet from client")
+
+
+async def serve_tcp_session(reader, writer, addr, frame, stats):
+    '''
+        Serve the tests of a persistent TCP connection, one after the other, until the client closes it
+        or sends no test frame for SESSION_IDLE_TIMEOUT seconds.
+        Returns:
+            int: The number of tests served.
+    '''
+    tests = 0
+    while True:
+        request = decode_test_frame(frame)
+        if request is None:
+            raise Exception("illegal test frame from client")
+        await serve_tcp_test(reader, writer, addr, request, stats, framed=True)
+        tests += 1
+        try:
+            frame = await asyncio.wait_for(reader.readexactly(TEST_FRAME_SIZE), SESSION_IDLE_TIMEOUT)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return tests
+        except asyncio.TimeoutError:
+            metrics.count('TCP', 'idle_timeouts')
+            log(f"[TCP CLIENT {addr}] Closing the persistent connection, idle for {SESSION_IDLE_TIMEOUT} seconds")
+            return tests
+
+
+
+async def echo_tcp_probes(reader, writer, prefix=b""):
+    '''
+        Echo the latency probes of a TCP connection until the client closes it.
+        Returns:
+            int: The number of probes echoed.
+    '''
+    probes = 0
+    try:
+        probe = prefix + await reader.readexactly(PROBE_PACKET_SIZE - len(prefix))
+        while True:
+            echo = create_probe_echo(probe, time.time_ns())
+            if echo is None:
+                raise Exception("illegal probe from client")
+            writer.write(echo)
+            await writer.drain()
+            probes += 1
+            probe = await reader.readexactly(PROBE_PACKET_SIZE)
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        return probes  # the client closed the connection
+
+
+async def send_tcp_download(writer, request, stats=None, framed=False):
+    '''
+        Send the download of a TCP request: file_size bytes, or for duration_ms when it is set.
+        A framed download (of a persistent connection) is sent as data blocks and ends with the end block.
+        stats (ClientStats) counts the bytes sent as they go (optional).
+        Returns:
+            int: The number of bytes sent.
+    '''
+    if framed:
+        return await send_tcp_blocks(writer, request, stats)
+    if not request.duration_ms:
+        for chunk in pattern_chunks(request.file_size):
+            writer.write(chunk)
+            await writer.drain()
+            if stats is not None:
+                stats.bytes_sent += len(chunk)
+        return request.file_size
+    # stream until the deadline, or until the client closes the connection
+    deadline = time.perf_counter() + request.duration_ms / 1000
+    file_size = 0
+    try:
+        for chunk in pattern_chunks():
+            if time.perf_counter() >= deadline:
+                break
+            writer.write(chunk)
+            await writer.drain()
+            file_size += len(chunk)
+            if stats is not None:
+                stats.bytes_sent += len(chunk)
+    except (ConnectionResetError, BrokenPipeError):
+        pass  # the client stopped the test
+    return file_size
+
+
+async def send_tcp_blocks(writer, request, stats=None):
+    '''
+        Send the download of a framed TCP test as data blocks, then the end block.
+        Returns:
+            int: The number of data bytes sent.
+    '''
+    deadline = time.perf_counter() + request.duration_ms / 1000 if request.duration_ms else None
+    file_size = 0
+    for block in block_chunks(None if deadline is not None else request.file_size):
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+        writer.write(block)
+        await writer.drain()
+        file_size += len(block) - BLOCK_HEADER.size
+        if stats is not None:
+            stats.bytes_sent += len(block) - BLOCK_HEADER.size
+    writer.write(END_BLOCK)
+    await writer.drain()
+    return file_size
+
+
+async def receive_blocks(reader, meter):
+    '''
+        Receive the upload of a framed TCP test, until its end block.
+        The client sends nothing more until it has the report, so the data is read in large reads
+        and the block headers are found in them, instead of one read per block.
+        Raises:
+            ConnectionError: If the client closes the connection before the end block.
+    '''
+    remaining = 0  # data bytes left in the current block
+    header = b""  # a block header split between two reads
+    ended = False
+    while True:
+        data = await reader.read(TCP_RECEIVE_SIZE)
+        if not data:
+            raise ConnectionError("the connection closed in the middle of a test")
+        nbytes = len(data)
+        position = 0
+        received = 0
+        while position < nbytes:
+            if remaining:
+                taken = min(remaining, nbytes - position)
+                remaining -= taken
+                position += taken
+                received += taken
+                continue
+            missing = BLOCK_HEADER.size - len(header)
+            header += data[position:position + missing]
+            position += min(missing, nbytes - position)
+            if len(header) < BLOCK_HEADER.size:
+                break
+            remaining = BLOCK_HEADER.unpack(header)[0]
+            header = b""
+            if remaining == 0:
+                if position < nbytes:
+                    raise Exception("data from client after the end of its upload")
+                ended = True
+                break
+        if received:
+            meter.add(received, time.perf_counter())
+        if ended:
+            return
+
+
+async def receive_all(reader, meter):
+    '''
+        Receive an upload until the client shuts down its side of the connection.
+    '''
+    try:
+        while True:
+            data = await reader.read(TCP_RECEIVE_SIZE)
+            if not data:
+                return
+            meter.add(len(data), time.perf_counter())
+    except ConnectionResetError:
+        pass  # the client went away, report what arrived
+
+
+
+async def serve(udp_socket, tcp_socket, max_clients, broadcast=True, advertise_load=False):
+    '''
+        Serve UDP and TCP clients on the given (already bound) sockets until cancelled.
+        Args:
+            udp_socket (socket.socket): The bound UDP socket requests arrive on.
+            tcp_socket (socket.socket): The bound TCP socket.
+            max_clients (int): The maximal number of concurrent clients per protocol.
+            broadcast (bool): Whether to broadcast the offer packet from this loop.
+            advertise_load (bool): Whether the offer carries the number of clients being served.
+    '''
+    loop = asyncio.get_running_loop()
+    admission = Admission(max_clients)
+    metrics.add_source('admission', admission.stats)
+    udp_transport, _ = await loop.create_datagram_endpoint(lambda: UdpRequestProtocol(admission), sock=udp_socket)
+    tcp_server = await asyncio.start_server(lambda reader, writer: handle_tcp_client(reader, writer, admission),
+                                            sock=tcp_socket)
+    print(" Listening for UDP messages and TCP connections on the event loop...")
+    try:
+        if broadcast:
+            await broadcast_offer(udp_socket.getsockname()[1], tcp_socket.getsockname()[1], advertise_load)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        tcp_server.close()
+        udp_transport.close()
+        # stop the clients being served and wait for them, so none is left running when the loop closes
+        clients = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in clients:
+            task.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+
+
+async def serve_until_interrupted(*args):
+    '''
+        Run serve(*args) until the process gets SIGINT (Ctrl-C) or SIGTERM.
+    '''
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, task.cancel)
+    try:
+        await serve(*args)
+    except asyncio.CancelledError:
+        pass
+
+
+
+def run(udp_socket, tcp_socket, max_clients, broadcast=True, advertise_load=False):
+    '''
+        Run the event loop server until interrupted (SIGINT or SIGTERM).
+        The clients being served are cancelled, and waited for, before the loop closes.
+        Raises:
+            KeyboardInterrupt: Once the server is interrupted and its loop closed, like the threads engine.
+    '''
+    asyncio.run(serve_until_interrupted(udp_socket, tcp_socket, max_clients, broadcast, advertise_load))
+    raise KeyboardInterrupt()
@@ -1,6 +1,65 @@
+import ctypes
+import errno
+import multiprocessing
+import os
+import signal
+import stat
 import struct
 import socket
+import sys
+import time
+from EncoderDecoder import BLOCK_HEADER
+from EncoderDecoder import END_BLOCK
 
+# Every TCP download is streamed out of this one shared buffer in fixed-size chunks,
+# so the server's memory stays flat no matter the requested size or the number of clients.
+PATTERN_CHUNK_SIZE = 64 * 1024
+_PATTERN_BUFFER = memoryview(b'A' * PATTERN_CHUNK_SIZE)
+# the same chunk as a full data block of a persistent TCP connection (length prefix and data), built once
+_FULL_BLOCK = memoryview(BLOCK_HEADER.pack(PATTERN_CHUNK_SIZE) + b'A' * PATTERN_CHUNK_SIZE)
+
+# The number of clients being served, in shared memory so that all the worker processes
+# (forked after this module is imported) count into the same value.
+_active_clients = multiprocessing.Value('i', 0)
+
+# Linux UDP generic segmentation offload (UDP_SEGMENT in linux/udp.h, not exported by the socket module):
+# one send of up to UDP_GSO_MAX_SEGMENTS (EncoderDecoder) equal-sized datagrams back to back, split by the kernel
+_SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+_UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+
+# Named socket tuning profiles, applied by the socket factories below (the client has the same ones).
+# An option that is missing is left at the OS default:
+#   sndbuf / rcvbuf (bytes): SO_SNDBUF / SO_RCVBUF, large enough for the bandwidth-delay product of fast, long paths
+#   nodelay (bool): TCP_NODELAY, send small writes right away instead of coalescing them
+#   congestion (str): TCP_CONGESTION, the congestion control algorithm (if the kernel has it)
+#   notsent_lowat (bytes): TCP_NOTSENT_LOWAT, how much unsent data may queue in the kernel
+#   busy_poll (us): SO_BUSY_POLL, spin on the device queue that long before sleeping in a receive
+TUNING_PROFILES = {
+    'default': {},
+    'high-bdp': {'sndbuf': 16 * 1024 * 1024, 'rcvbuf': 16 * 1024 * 1024, 'congestion': 'bbr'},
+    'low-latency': {'nodelay': True, 'notsent_lowat': 16 * 1024, 'busy_poll': 50},
+}
+# not every Python exports these (values from the Linux headers)
+_SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+_SO_SNDBUFFORCE = getattr(socket, 'SO_SNDBUFFORCE', 32)
+_SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+_TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', 25)
+# the profile of the sockets this process creates, see set_tuning_profile
+_tuning_profile = 'default'
+
+# prctl(2) option (linux/prctl.h): the signal a process gets when its parent dies
+_PR_SET_PDEATHSIG = 1
+
+# TCP data is received into buffers this large, so a fast connection needs few recv calls
+TCP_RECEIVE_SIZE = 256 * 1024
+
+# an upload is over when the client sends its stop packet, or after this many seconds without data
+UPLOAD_IDLE_TIMEOUT = 1.0
+# a persistent TCP connection is closed after this many seconds without the client's next test frame,
+# so idle clients don't hold on to the workers
+SESSION_IDLE_TIMEOUT = 30.0
+# the report that ends a UDP upload is sent this many times, a lost report would lose the whole measurement
+REPORT_COPIES = 3
 
 
 def get_local_ip():
@@ -23,9 +82,183 @@ def get_local_ip():
     return local_ip
 
 
-def get_udp_socket():
+def exit_with_parent(parent_pid):
+    '''
+        This Method is used to make a forked child get SIGTERM when its parent dies,
+        so that a killed server never leaves children behind holding its ports.
+        Args:
+            parent_pid (int): The pid of the parent, if it already died the child terminates right away.
+        Notes:
+            Linux only (prctl PR_SET_PDEATHSIG), elsewhere nothing happens.
+            The signal comes when the thread that forked the child exits, not the whole parent.
+    '''
+    if not sys.platform.startswith('linux'):
+        return
+    try:
+        ctypes.CDLL(None, use_errno=True).prctl(_PR_SET_PDEATHSIG, signal.SIGTERM)
+    except (OSError, AttributeError):
+        return
+    if os.getppid() != parent_pid:
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def release_inherited_sockets():
+    '''
+        This Method is used by a forked child that serves no socket of its own: every socket it inherited
+        is pointed at /dev/null, so that it doesn't keep the server's ports bound or its clients' connections open.
+        Notes:
+            The descriptor numbers stay taken, so the socket objects the child inherited can't close
+            (or write to) a descriptor it opens later. Linux only (/proc/self/fd), elsewhere nothing happens.
+    '''
+    try:
+        descriptors = [int(name) for name in os.listdir('/proc/self/fd')]
+    except OSError:
+        return
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        for fd in descriptors:
+            try:
+                if fd != devnull and stat.S_ISSOCK(os.fstat(fd).st_mode):
+                    os.dup2(devnull, fd)
+            except OSError:
+                pass  # closed since it was listed
+    finally:
+        os.close(devnull)
+
+
+def set_tuning_profile(name):
+    '''
+        This Method is used to choose the tuning profile (see TUNING_PROFILES) of every socket this process creates.
+        Raises:
+            ValueError: If there is no such profile.
+    '''
+    global _tuning_profile
+    if name not in TUNING_PROFILES:
+        raise ValueError(f"unknown tuning profile: {name}")
+    _tuning_profile = name
+
+
+def _kernel_buffer_limit(option):
+    '''
+        Returns:
+            int: The largest SO_SNDBUF / SO_RCVBUF an unprivileged process may ask for, None if unknown.
+    '''
+    name = 'wmem_max' if option == socket.SO_SNDBUF else 'rmem_max'
+    try:
+        with open(f"/proc/sys/net/core/{name}") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _set_buffer_size(sock, option, force_option, size):
+    '''
+        This Method is used to set a socket buffer size, past the kernel limit if the process is allowed to.
+        Notes:
+            Setting a TCP buffer turns off the kernel's buffer autotuning. When the limit would clamp the
+            buffer below the request, the TCP buffer is left to autotuning, which may grow past the limit.
+    '''
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, force_option, size)
+        return
+    except OSError:
+        pass  # needs CAP_NET_ADMIN
+    limit = _kernel_buffer_limit(option)
+    if sock.type == socket.SOCK_STREAM and limit is not None and limit < size:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+
+def _try_setsockopt(sock, level, option, value):
+    try:
+        sock.setsockopt(level, option, value)
+    except OSError:
+        pass  # keep the OS default
+
+
+def apply_tuning(sock, profile=None):
+    '''
+        This Method is used to apply a tuning profile to a socket.
+        Args:
+            sock (socket.socket): The socket, TCP sockets must not be connected or listening yet.
+            profile (str): A name from TUNING_PROFILES, None for the process's profile (see set_tuning_profile).
+        Notes:
+            An option the kernel doesn't support (or doesn't allow) is skipped, socket_tuning()
+            tells which values the socket ended up with.
+    '''
+    options = TUNING_PROFILES[profile or _tuning_profile]
+    try:
+        if 'sndbuf' in options:
+            _set_buffer_size(sock, socket.SO_SNDBUF, _SO_SNDBUFFORCE, options['sndbuf'])
+        if 'rcvbuf' in options:
+            _set_buffer_size(sock, socket.SO_RCVBUF, _SO_RCVBUFFORCE, options['rcvbuf'])
+    except OSError:
+        pass  # keep the OS default
+    if 'busy_poll' in options:
+        _try_setsockopt(sock, socket.SOL_SOCKET, _SO_BUSY_POLL, options['busy_poll'])
+    if sock.type != socket.SOCK_STREAM:
+        return
+    if 'nodelay' in options:
+        _try_setsockopt(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, int(options['nodelay']))
+    if 'congestion' in options and hasattr(socket, 'TCP_CONGESTION'):
+        _try_setsockopt(sock, socket.IPPROTO_TCP, socket.TCP_CONGESTION, options['congestion'].encode())
+    if 'notsent_lowat' in options:
+        _try_setsockopt(sock, socket.IPPROTO_TCP, _TCP_NOTSENT_LOWAT, options['notsent_lowat'])
+
+
+def socket_tuning(sock):
+    '''
+        This Method is used to read the tuning the kernel actually applied to a socket.
+        Returns:
+            tuning (dict): so_sndbuf, so_rcvbuf and so_busy_poll, and for TCP tcp_nodelay and tcp_congestion
+                           (None where the kernel can't tell). Linux reports buffers at twice the size asked
+                           for, the extra half is its bookkeeping overhead.
+    '''
+    def read(level, option, length=0):
+        try:
+            return sock.getsockopt(level, option, length) if length else sock.getsockopt(level, option)
+        except OSError:
+            return None
+
+    tuning = {'so_sndbuf': read(socket.SOL_SOCKET, socket.SO_SNDBUF),
+              'so_rcvbuf': read(socket.SOL_SOCKET, socket.SO_RCVBUF),
+              'so_busy_poll': read(socket.SOL_SOCKET, _SO_BUSY_POLL),
+              'tcp_nodelay': None,
+              'tcp_congestion': None}
+    if sock.type == socket.SOCK_STREAM:
+        nodelay = read(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        tuning['tcp_nodelay'] = bool(nodelay) if nodelay is not None else None
+        if hasattr(socket, 'TCP_CONGESTION'):
+            congestion = read(socket.IPPROTO_TCP, socket.TCP_CONGESTION, 16)
+            if congestion is not None:
+                tuning['tcp_congestion'] = congestion.split(b'\0', 1)[0].decode()
+    return tuning
+
+
+def create_socket(kind, profile=None):
+    '''
+        This Method is used to create an IPv4 socket tuned with a profile (see apply_tuning).
+        Args:
+            kind (int): socket.SOCK_DGRAM or socket.SOCK_STREAM.
+            profile (str): A name from TUNING_PROFILES, None for the process's profile.
+        Returns:
+            sock (socket.socket): The created, unbound socket.
+    '''
+    sock = socket.socket(socket.AF_INET, kind)
+    try:
+        apply_tuning(sock, profile)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def get_udp_socket(port=0, profile=None):
     '''
         This Method is used to create and bind a UDP socket.
+        Args:
+            port (int): The port to bind, 0 for any available port.
+            profile (str): The tuning profile, None for the process's profile (see set_tuning_profile).
         Returns:
             udp_socket (socket.socket): The created and bound UDP socket.
         Raises:
@@ -33,11 +266,11 @@ def get_udp_socket():
     '''
     try:
         # Create a UDP socket
-        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        udp_socket = create_socket(socket.SOCK_DGRAM, profile)
         # Allow the socket to broadcast
         udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        # Bind to an available port on all interfaces
-        udp_socket.bind(('', 0))
+        # Bind to the given (or an available) port on all interfaces
+        udp_socket.bind(('', port))
         return udp_socket
     except OSError as e:
         print(f"Error creating or binding UDP socket: {e}")
@@ -45,12 +278,14 @@ def get_udp_socket():
             udp_socket.close()
         raise
 
-def get_tcp_socket():
+def get_tcp_socket(port=0, profile=None):
     """
     Create and bind a TCP socket.
 
-    This method creates a TCP socket using IPv4 and binds it to an available port
-    chosen by the operating system.
+    This method creates a TCP socket using IPv4 and binds it to the given port,
+    or to an available port chosen by the operating system when port is 0.
+    The socket is tuned with the given profile (None for the process's profile),
+    connections it accepts inherit the tuning.
 
     Returns:
         socket.socket: The created and bound TCP socket.
@@ -64,13 +299,337 @@ def get_tcp_socket():
     """
     try:
         # Create a TCP socket
-        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Bind to an available port
-        tcp_socket.bind(('', 0))
+        tcp_socket = create_socket(socket.SOCK_STREAM, profile)
+        # Bind to the given (or an available) port
+        tcp_socket.bind(('', port))
         return tcp_socket
     except OSError as e:
         print(f"Error creating or binding TCP socket: {e}")
         # Ensure the socket is closed if partially created
         if 'tcp_socket' in locals():  
             tcp_socket.close()
-        raise
\ No newline at end of file
+        raise
+
+
+def pattern_chunks(size=None):
+    '''
+        This Method is used to split a demi file of the given size into chunks to send.
+        Args:
+            size (int): The total number of bytes, None for an endless stream of full chunks.
+        Yields:
+            chunk (memoryview): A slice of the shared preallocated pattern buffer (no copy).
+    '''
+    if size is None:
+        while True:
+            yield _PATTERN_BUFFER
+    remaining = size
+    while remaining >= PATTERN_CHUNK_SIZE:
+        yield _PATTERN_BUFFER
+        remaining -= PATTERN_CHUNK_SIZE
+    if remaining > 0:
+        yield _PATTERN_BUFFER[:remaining]
+
+
+def send_pattern(conn, size, stats=None):
+    '''
+        This Method is used to stream demi data over a connected TCP socket.
+        Args:
+            conn (socket.socket): The connected TCP socket.
+            size (int): The number of bytes to send.
+            stats (ClientStats): Counts the bytes sent as they go (optional).
+        Notes:
+            The data is sent as slices of a shared preallocated buffer (memoryview slices
+            don't copy), so the first byte leaves right away even for multi-GB requests.
+    '''
+    for chunk in pattern_chunks(size):
+        conn.sendall(chunk)
+        if stats is not None:
+            stats.bytes_sent += len(chunk)
+
+
+
+def send_pattern_until(conn, deadline, stats=None):
+    '''
+        This Method is used to stream demi data over a connected TCP socket until a deadline.
+        Args:
+            conn (socket.socket): The connected TCP socket.
+            deadline (float): The time.perf_counter() value to stop at.
+            stats (ClientStats): Counts the bytes sent as they go (optional).
+        Returns:
+            sent (int): The number of bytes sent.
+        Notes:
+            The client may end the test early by closing the connection, that is not an error.
+    '''
+    sent = 0
+    try:
+        while time.perf_counter() < deadline:
+            conn.sendall(_PATTERN_BUFFER)
+            sent += PATTERN_CHUNK_SIZE
+            if stats is not None:
+                stats.bytes_sent += PATTERN_CHUNK_SIZE
+    except (ConnectionResetError, BrokenPipeError):
+        pass  # the client stopped the test
+    return sent
+
+
+
+def block_chunks(size=None):
+    '''
+        This Method is used to split a demi file into the data blocks of a persistent TCP connection.
+        Args:
+            size (int): The total number of data bytes, None for an endless stream of full blocks.
+        Yields:
+            block (bytes-like): A data block, its length prefix included (the end block is not).
+    '''
+    if size is None:
+        while True:
+            yield _FULL_BLOCK
+    remaining = size
+    while remaining >= PATTERN_CHUNK_SIZE:
+        yield _FULL_BLOCK
+        remaining -= PATTERN_CHUNK_SIZE
+    if remaining > 0:
+        yield BLOCK_HEADER.pack(remaining) + _PATTERN_BUFFER[:remaining]
+
+
+def send_blocks(conn, size, stats=None):
+    '''
+        This Method is used to send size bytes of demi data as data blocks, then the end block.
+        Args:
+            conn (socket.socket): The connected TCP socket.
+            size (int): The number of data bytes to send.
+            stats (ClientStats): Counts the bytes sent as they go (optional).
+    '''
+    for block in block_chunks(size):
+        conn.sendall(block)
+        if stats is not None:
+            stats.bytes_sent += len(block) - BLOCK_HEADER.size
+    conn.sendall(END_BLOCK)
+
+
+def send_blocks_until(conn, deadline, stats=None):
+    '''
+        This Method is used to send full data blocks until a deadline, then the end block.
+        Returns:
+            sent (int): The number of data bytes sent.
+    '''
+    sent = 0
+    while time.perf_counter() < deadline:
+        conn.sendall(_FULL_BLOCK)
+        sent += PATTERN_CHUNK_SIZE
+        if stats is not None:
+            stats.bytes_sent += PATTERN_CHUNK_SIZE
+    conn.sendall(END_BLOCK)
+    return sent
+
+
+def receive_blocks(conn, counter, buffer_size=TCP_RECEIVE_SIZE):
+    '''
+        This Method is used to receive the data blocks of one direction of a test on a persistent TCP
+        connection, until its end block.
+        Args:
+            conn (socket.socket): The connected TCP socket.
+            counter (object): Its add(nbytes, now) method is called with the data bytes of every receive
+                              (a ReceiveMeter or a ThroughputSampler).
+            buffer_size (int): The size of the preallocated receive buffer.
+        Returns:
+            (total, leftover) (tuple): The number of data bytes, and the bytes received after the end block.
+        Raises:
+            ConnectionError: If the connection closes before the end block.
+    '''
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    recv_into = conn.recv_into
+    total = 0
+    remaining = 0  # data bytes left in the current block
+    header = b""  # a block header split between two receives
+    while True:
+        nbytes = recv_into(view)
+        if nbytes == 0:
+            raise ConnectionError("the connection closed in the middle of a test")
+        position = 0
+        data = 0
+        while position < nbytes:
+            if remaining:
+                taken = min(remaining, nbytes - position)
+                remaining -= taken
+                position += taken
+                data += taken
+                continue
+            missing = BLOCK_HEADER.size - len(header)
+            header += view[position:position + missing]
+            position += min(missing, nbytes - position)
+            if len(header) < BLOCK_HEADER.size:
+                break
+            remaining = BLOCK_HEADER.unpack(header)[0]
+            header = b""
+            if remaining == 0:
+                if data:
+                    counter.add(data, time.perf_counter())
+                return total + data, bytes(view[position:nbytes])
+        if data:
+            counter.add(data, time.perf_counter())
+            total += data
+
+
+def receive_frame(conn, view):
+    '''
+        This Method is used to receive a fixed-size frame, in one call unless the kernel splits it.
+        Args:
+            conn (socket.socket): The connected TCP socket.
+            view (memoryview): Where to receive the frame, as many bytes as it is long.
+        Returns:
+            bool: True once the frame is in, False if the connection closed before it started.
+        Raises:
+            ConnectionError: If the connection closes in the middle of the frame.
+    '''
+    filled = 0
+    while filled < len(view):
+        nbytes = conn.recv_into(view[filled:], len(view) - filled, socket.MSG_WAITALL)
+        if nbytes == 0:
+            if filled == 0:
+                return False
+            raise ConnectionError("the connection closed in the middle of a frame")
+        filled += nbytes
+    return True
+
+
+class ReceiveMeter:
+    '''
+        Measures the data a client uploads: bytes and packets received, and the time
+        from the first to the last arrival (so the idle wait at the end is not counted).
+    '''
+
+    def __init__(self):
+        self.bytes = 0
+        self.packets = 0
+        self.first_arrival = None
+        self.last_arrival = None
+
+    def add(self, nbytes, now):
+        '''
+            Record nbytes received at time now (time.perf_counter()).
+        '''
+        if self.first_arrival is None:
+            self.first_arrival = now
+        self.last_arrival = now
+        self.bytes += nbytes
+        self.packets += 1
+
+    @property
+    def duration_ns(self):
+        if self.first_arrival is None:
+            return 0
+        return int((self.last_arrival - self.first_arrival) * 1e9)
+
+
+def receive_all(conn, meter):
+    '''
+        This Method is used to receive an upload over a connected TCP socket, until the client shuts down its side.
+        Args:
+            conn (socket.socket): The connected TCP socket.
+            meter (ReceiveMeter): Measures the received bytes.
+        Notes:
+            The data is received into one large preallocated buffer (recv_into) and thrown away.
+    '''
+    buffer = bytearray(TCP_RECEIVE_SIZE)
+    recv_into = conn.recv_into
+    try:
+        while True:
+            nbytes = recv_into(buffer)
+            if nbytes == 0:
+                return
+            meter.add(nbytes, time.perf_counter())
+    except ConnectionResetError:
+        pass  # the client went away, report what arrived
+
+
+
+def send_packets(udp_socket, packets, address):
+    '''
+        This Method is used to send a batch of UDP datagrams to one address.
+        Args:
+            udp_socket (socket.socket): The UDP socket to send from.
+            packets (iterable): The datagrams (bytes-like objects) to send.
+            address (tuple): The (ip, port) destination.
+        Notes:
+            Python has no sendmmsg(), so this is a tight loop over a pre-bound sendto.
+    '''
+    sendto = udp_socket.sendto
+    for packet in packets:
+        sendto(packet, address)
+
+
+def enable_udp_gso(udp_socket, segment_size):
+    '''
+        This Method is used to turn on UDP GSO for a socket, so that one send of a buffer holding
+        several segment_size datagrams back to back leaves as those datagrams (one syscall per batch).
+        Returns:
+            bool: True if the kernel supports it, False otherwise (not Linux, or an older kernel).
+    '''
+    try:
+        udp_socket.setsockopt(_SOL_UDP, _UDP_SEGMENT, segment_size)
+        return True
+    except OSError:
+        return False
+
+
+def disable_udp_gso(udp_socket):
+    '''
+        This Method is used to turn UDP GSO off again, every send is then one datagram.
+    '''
+    udp_socket.setsockopt(_SOL_UDP, _UDP_SEGMENT, 0)
+
+
+def is_gso_rejection(error):
+    '''
+        Returns:
+            bool: True if the OSError of a send means the kernel can't send GSO batches on this path
+                  (EIO when the device can't offload the checksums, EINVAL for a batch it won't segment),
+                  False for any other error (e.g. a full buffer or an unreachable client).
+    '''
+    return error.errno in (errno.EIO, errno.EINVAL)
+
+
+def send_batch(udp_socket, packets, buffer, address, gso):
+    '''
+        This Method is used to send a batch of equal-sized payload packets to one address.
+        Args:
+            udp_socket (socket.socket): The UDP socket to send from.
+            packets (list): The datagrams of the batch.
+            buffer (bytes-like): The same datagrams back to back in one buffer (see PayloadPacketFactory.buffer).
+            address (tuple): The (ip, port) destination.
+            gso (bool): Whether GSO is enabled on the socket (see enable_udp_gso).
+        Returns:
+            bool: Whether GSO is still enabled. If the kernel rejects a GSO send (see is_gso_rejection)
+                  it is turned off and the batch is sent one datagram at a time.
+        Raises:
+            OSError: For any other error of the send.
+    '''
+    if gso:
+        try:
+            udp_socket.sendto(buffer, address)
+            return True
+        except OSError as e:
+            if not is_gso_rejection(e):
+                raise
+            disable_udp_gso(udp_socket)
+    send_packets(udp_socket, packets, address)
+    return False
+
+
+
+def add_active_clients(delta):
+    '''
+        This Method is used to count clients in (delta=1) and out (delta=-1) of service.
+    '''
+    with _active_clients.get_lock():
+        _active_clients.value += delta
+
+
+def get_active_clients():
+    '''
+        Returns:
+            int: The number of clients being served by all the server's processes.
+    '''
+    return _active_clients.value
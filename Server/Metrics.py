@@ -0,0 +1,263 @@
+import atexit
+import contextlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+# The server's telemetry: a registry of per-client counters, and a log queue.
+# Every client's counters are written by the one thread (or task) serving it, so updating one
+# is a plain attribute addition, no lock. The registry only locks when a client comes or goes,
+# and when the stats endpoint takes a snapshot.
+
+_PROTOCOLS = ('UDP', 'TCP')
+# the per-protocol event counters, next to the client totals
+_EVENTS = ('rejected', 'errors', 'probes', 'idle_timeouts')
+
+
+
+class ClientStats:
+    '''
+        The live counters of one client. Only the thread (or task) serving the client writes them.
+        An upload is counted by its ReceiveMeter (see attach_meter).
+    '''
+    __slots__ = ('protocol', 'address', 'direction', 'started', 'bytes_sent', 'packets_sent', 'send_errors', 'meter',
+                 '_bytes_received', '_packets_received')
+
+    def __init__(self, protocol, address, direction):
+        self.protocol = protocol
+        self.address = address
+        self.direction = direction
+        self.started = time.perf_counter()
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.send_errors = 0
+        self.meter = None
+        # what the previous uploads of a persistent connection received
+        self._bytes_received = 0
+        self._packets_received = 0
+
+    def attach_meter(self, meter):
+        '''
+            Count the client's upload with the ReceiveMeter measuring it (the next test's replaces it).
+        '''
+        if self.meter is not None:
+            self._bytes_received += self.meter.bytes
+            self._packets_received += self.meter.packets
+        self.meter = meter
+
+    @property
+    def bytes_received(self):
+        return self._bytes_received + (self.meter.bytes if self.meter is not None else 0)
+
+    @property
+    def packets_received(self):
+        return self._packets_received + (self.meter.packets if self.meter is not None else 0)
+
+    def totals(self):
+        '''
+            Returns:
+                dict: The client's traffic counters (see MetricsRegistry.add_client), picklable so that a worker
+                      process can hand them to the process that serves the stats.
+        '''
+        return {'bytes_sent': self.bytes_sent, 'packets_sent': self.packets_sent, 'bytes_received': self.bytes_received,
+                'packets_received': self.packets_received, 'send_errors': self.send_errors}
+
+    def snapshot(self, now):
+        elapsed = now - self.started
+        return {'protocol': self.protocol, 'address': f"{self.address[0]}:{self.address[1]}",
+                'direction': self.direction, 'seconds': round(elapsed, 3),
+                'bytes_sent': self.bytes_sent, 'packets_sent': self.packets_sent,
+                'bytes_received': self.bytes_received, 'packets_received': self.packets_received,
+                'send_errors': self.send_errors,
+                'send_bps': round(self.bytes_sent * 8 / elapsed) if elapsed > 0 else 0,
+                'receive_bps': round(self.bytes_received * 8 / elapsed) if elapsed > 0 else 0}
+
+
+
+class MetricsRegistry:
+    '''
+        Collects the counters of the clients being served and the totals of the ones that finished,
+        per protocol, and the stats of the worker pools (or any other source of a stats dict).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = set()
+        self._totals = {protocol: dict.fromkeys(('connections', 'bytes_sent', 'packets_sent', 'bytes_received',
+                                                 'packets_received', 'send_errors') + _EVENTS, 0)
+                        for protocol in _PROTOCOLS}
+        self._sources = []
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def track(self, protocol, address, direction=None):
+        '''
+            Register a client for as long as it is served.
+            Args:
+                protocol (str): 'UDP' or 'TCP'.
+                address (tuple): The client's (ip, port).
+                direction (str): The direction of its test, if known yet.
+            Yields:
+                stats (ClientStats): The client's counters, folded into the totals when it is done.
+        '''
+        stats = ClientStats(protocol, address, direction)
+        with self._lock:
+            self._clients.add(stats)
+        try:
+            yield stats
+        finally:
+            with self._lock:
+                self._clients.discard(stats)
+                self._add_totals(protocol, stats.totals())
+
+    def add_client(self, protocol, counters):
+        '''
+            Add a finished client to the totals.
+            Args:
+                protocol (str): 'UDP' or 'TCP'.
+                counters (dict): The client's ClientStats.totals(), e.g. returned by a task of a worker process.
+        '''
+        with self._lock:
+            self._add_totals(protocol, counters)
+
+    def _add_totals(self, protocol, counters):
+        totals = self._totals[protocol]
+        totals['connections'] += 1
+        for name, value in counters.items():
+            totals[name] += value
+
+    def count(self, protocol, event, n=1):
+        '''
+            Count an event that isn't a client's (one of 'rejected', 'errors', 'probes', 'idle_timeouts').
+        '''
+        with self._lock:
+            self._totals[protocol][event] += n
+
+    def add_source(self, name, stats):
+        '''
+            Add a stats source to the snapshot, e.g. a worker pool's stats method.
+            Args:
+                name (str): The key of its stats in the snapshot.
+                stats (callable): Returns a dict of the source's current stats.
+        '''
+        with self._lock:
+            self._sources.append((name, stats))
+
+    def snapshot(self):
+        '''
+            Returns:
+                dict: The uptime, thread count, per-protocol totals (finished and active clients),
+                      every active client with its rates, and the stats of every source.
+        '''
+        now = time.perf_counter()
+        with self._lock:
+            clients = list(self._clients)
+            totals = {protocol: dict(counters) for protocol, counters in self._totals.items()}
+            sources = list(self._sources)
+        active = [client.snapshot(now) for client in clients]
+        for protocol, counters in totals.items():
+            counters['active'] = 0
+        for client in active:
+            counters = totals[client['protocol']]
+            counters['active'] += 1
+            for name in ('bytes_sent', 'packets_sent', 'bytes_received', 'packets_received', 'send_errors'):
+                counters[name] += client[name]
+        return {'pid': os.getpid(), 'uptime': round(time.time() - self.started, 3),
+                'threads': threading.active_count(), 'protocols': totals, 'clients': active,
+                **{name: stats() for name, stats in sources}}
+
+
+# the registry of this process
+metrics = MetricsRegistry()
+
+
+
+class _StatsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ('/', '/stats'):
+            self.send_error(404)
+            return
+        body = json.dumps(metrics.snapshot(), indent=1).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # a polled endpoint shouldn't flood the log
+
+
+def start_stats_server(port, host='127.0.0.1'):
+    '''
+        This Method is used to serve the registry's snapshot as JSON on http://host:port/stats, from a daemon thread.
+        Returns:
+            server (ThreadingHTTPServer): The running server (server.server_address has the bound port).
+        Raises:
+            OSError: If the port can't be bound.
+    '''
+    server = ThreadingHTTPServer((host, port), _StatsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stats-endpoint", daemon=True).start()
+    return server
+
+
+
+# Log lines are queued and written by one background thread, so a handler never waits on stdout.
+_log_queue = queue.SimpleQueue()
+# the process the writer thread runs in, a forked worker process starts its own
+_log_writer_pid = None
+_log_writer_lock = threading.Lock()
+
+
+def log(message):
+    '''
+        This Method is used to log a line without blocking: it is queued and printed by the log writer thread.
+    '''
+    if _log_writer_pid != os.getpid():
+        _start_log_writer()
+    _log_queue.put(message)
+
+
+def _start_log_writer():
+    global _log_writer_pid
+    with _log_writer_lock:
+        if _log_writer_pid == os.getpid():
+            return
+        _log_writer_pid = os.getpid()
+        threading.Thread(target=_write_log, name="log-writer", daemon=True).start()
+
+
+def _write_log():
+    while True:
+        lines = [_log_queue.get()]
+        # write whatever else is queued in the same call
+        while True:
+            try:
+                lines.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+
+@atexit.register
+def flush_log():
+    '''
+        Print what is still queued (at exit, the writer thread may not get to it).
+    '''
+    lines = []
+    while True:
+        try:
+            lines.append(_log_queue.get_nowait())
+        except queue.Empty:
+            break
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
@@ -0,0 +1,159 @@
+import time
+
+
+
+class TokenBucket:
+    '''
+        Paces a sender to a target bitrate.
+        Tokens (bytes) refill continuously at the target rate up to the bucket size.
+        A sender reserves the bytes of a whole batch of datagrams at once and sleeps off
+        the debt, so there is one wakeup per batch instead of one per datagram.
+        Oversleeping is harmless: the refill is computed from perf_counter(), so the next
+        batch simply goes out sooner and the average rate stays on target.
+    '''
+
+    def __init__(self, rate_bps, burst_bytes):
+        '''
+            Args:
+                rate_bps (int): The target rate in bits per second.
+                burst_bytes (int): The bucket size, the most that may be sent back to back.
+        '''
+        self.burst_bytes = burst_bytes
+        self.set_rate(rate_bps)
+        self._tokens = burst_bytes
+        self._last = time.perf_counter()
+
+    def set_rate(self, rate_bps):
+        '''
+            Change the target rate, takes effect from the next reservation.
+        '''
+        self.rate_bps = rate_bps
+        self._bytes_per_second = rate_bps / 8
+
+    def packets_per_wakeup(self, packet_size, max_packets, wakeup_interval=0.001):
+        '''
+            Returns:
+                int: How many packets of the given size to send per wakeup so the sender
+                     wakes up about once per wakeup_interval seconds (at least 1, at most max_packets).
+        '''
+        packets = int(self._bytes_per_second * wakeup_interval // packet_size)
+        return max(1, min(max_packets, packets))
+
+    def reserve(self, nbytes):
+        '''
+            Take nbytes tokens, going into debt if there are not enough.
+            Returns:
+                float: The number of seconds to wait before sending the reserved bytes (0 if none).
+        '''
+        now = time.perf_counter()
+        self._tokens = min(self.burst_bytes, self._tokens + (now - self._last) * self._bytes_per_second)
+        self._last = now
+        self._tokens -= nbytes
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self._bytes_per_second
+
+    def consume(self, nbytes):
+        '''
+            Block until nbytes may be sent at the target rate.
+        '''
+        delay = self.reserve(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
+
+
+# the rate an adaptive stream starts at when the client didn't ask for one, in bits/second
+ADAPTIVE_INITIAL_RATE = 10_000_000
+
+
+def create_pacer(rate_bps, adaptive, burst_bytes):
+    '''
+        Returns:
+            (pacer, controller) (tuple): the TokenBucket pacing a UDP stream (None if it is not paced)
+            and the AimdRateController adapting its rate (None unless adaptive).
+    '''
+    if adaptive:
+        pacer = TokenBucket(rate_bps or ADAPTIVE_INITIAL_RATE, burst_bytes)
+        return pacer, AimdRateController(pacer)
+    if rate_bps:
+        return TokenBucket(rate_bps, burst_bytes), None
+    return None, None
+
+
+
+class AimdRateController:
+    '''
+        Adapts a TokenBucket's rate to the client's feedback (additive increase, multiplicative decrease).
+        Every feedback covers the segments since the previous one. Without loss the rate grows,
+        doubling until the first loss and by a fixed step after it; above loss_threshold it is cut
+        by the decrease factor. So the rate keeps probing just above and falling back just below the
+        highest rate the path sustains.
+        Notes:
+            The feedback right after a decrease still covers packets sent at the old rate,
+            so it may not decrease the rate again.
+    '''
+
+    def __init__(self, pacer, min_rate_bps=100_000, max_rate_bps=10_000_000_000, loss_threshold=0.02, decrease=0.5):
+        '''
+            Args:
+                pacer (TokenBucket): The pacer whose rate is adapted.
+                min_rate_bps (int): The rate is never decreased below this.
+                max_rate_bps (int): The rate is never increased above this.
+                loss_threshold (float): The fraction of segments lost in an interval that counts as congestion.
+                decrease (float): The factor the rate is multiplied by on congestion.
+        '''
+        self.pacer = pacer
+        self.min_rate_bps = min_rate_bps
+        self.max_rate_bps = max_rate_bps
+        self.loss_threshold = loss_threshold
+        self.decrease = decrease
+        self.slow_start = True
+        self.increase_bps = 0
+        self.peak_rate_bps = pacer.rate_bps
+        self.decreases = 0
+        self._segments_received = 0
+        self._highest_segment = 0
+        self._hold = False
+
+    def feedback(self, segments_received, highest_segment):
+        '''
+            Adapt the rate to one feedback packet.
+            Args:
+                segments_received (int): The number of distinct segments the client received so far.
+                highest_segment (int): The highest segment number the client has seen so far.
+            Returns:
+                int: The new rate in bits/second.
+        '''
+        rate = self.pacer.rate_bps
+        new_segments = highest_segment - self._highest_segment
+        if new_segments <= 0:
+            return rate  # a late or duplicated feedback packet
+        lost = new_segments - (segments_received - self._segments_received)
+        self._segments_received = segments_received
+        self._highest_segment = highest_segment
+        if lost / new_segments > self.loss_threshold:
+            if self._hold:
+                self._hold = False
+                return rate
+            rate = max(self.min_rate_bps, int(rate * self.decrease))
+            if self.slow_start:
+                # from now on probe linearly, in steps of an eighth of the first sustainable rate
+                self.slow_start = False
+                self.increase_bps = max(self.min_rate_bps, rate // 8)
+            self.decreases += 1
+            self._hold = True
+        else:
+            self._hold = False
+            rate = min(self.max_rate_bps, rate * 2 if self.slow_start else rate + self.increase_bps)
+        self.pacer.set_rate(rate)
+        self.peak_rate_bps = max(self.peak_rate_bps, rate)
+        return rate
+
+    def summary(self):
+        '''
+            Returns:
+                str: The final and peak rates and the number of decreases.
+        '''
+        return (f"adaptive rate {self.pacer.rate_bps} bits/second (peak {self.peak_rate_bps} bits/second, "
+                f"{self.decreases} decreases)")
@@ -1,3 +1,7 @@
+import argparse
+import multiprocessing
+import os
+import signal
 import threading
 import struct
 import time
@@ -6,9 +10,60 @@ from Helpers import get_local_ip
 from EncoderDecoder import create_offer_packet
 from Helpers import get_udp_socket
 from Helpers import get_tcp_socket
+from Helpers import create_socket
+from Helpers import exit_with_parent
+from Helpers import set_tuning_profile
+from Helpers import socket_tuning
+from Helpers import TUNING_PROFILES
+from Helpers import send_pattern
+from Helpers import send_pattern_until
 from EncoderDecoder import decode_request_packet
-from EncoderDecoder import create_payload_packet
+from EncoderDecoder import decode_tcp_request
+from EncoderDecoder import is_stop_packet
+from EncoderDecoder import PayloadPacketFactory
+from Helpers import send_packets
+from Helpers import send_batch
+from Helpers import enable_udp_gso
+from Helpers import add_active_clients
+from Helpers import get_active_clients
+from Pacer import create_pacer
+from WorkerPool import WorkerPool
+from WorkerPool import ProcessWorkerPool
+from WorkerPool import fork_available
+import AsyncServer
 from EncoderDecoder import PAYLOAD_SIZE
+from EncoderDecoder import PAYLOAD_HEADER_SIZE
+from EncoderDecoder import DIRECTION_DOWNLOAD
+from EncoderDecoder import DIRECTION_UPLOAD
+from EncoderDecoder import DIRECTION_BIDIRECTIONAL
+from EncoderDecoder import DIRECTION_NAMES
+from EncoderDecoder import create_report_packet
+from EncoderDecoder import decode_payload_header
+from EncoderDecoder import decode_feedback_packet
+from EncoderDecoder import create_probe_echo
+from EncoderDecoder import PROBE_PACKET_SIZE
+from EncoderDecoder import BINARY_FIRST_BYTE
+from EncoderDecoder import BINARY_HEADER_SIZE
+from EncoderDecoder import TEST_FRAME_SIZE
+from EncoderDecoder import binary_message_type
+from EncoderDecoder import decode_test_frame
+from Helpers import ReceiveMeter
+from Helpers import receive_all
+from Helpers import receive_blocks
+from Helpers import receive_frame
+from Helpers import send_blocks
+from Helpers import send_blocks_until
+from Helpers import UPLOAD_IDLE_TIMEOUT
+from Helpers import SESSION_IDLE_TIMEOUT
+from Helpers import REPORT_COPIES
+from Metrics import metrics
+from Metrics import log
+from Metrics import start_stats_server
+
+# the most a paced UDP sender may send back to back, in bytes
+UDP_PACING_BURST = 64 * 1024
+# how long a terminated worker process may take to clean up before it is killed, in seconds
+WORKER_EXIT_TIMEOUT = 5.0
 
 class bcolors:
     HEADER = '\033[95m'
@@ -21,9 +76,10 @@ class bcolors:
 
 
 
-def broadcast_offer(udp_port, tcp_port):
+def broadcast_offer(udp_port, tcp_port, advertise_load=False):
     '''
         This Method is used to broadcast the offer packet every second.
+        With advertise_load the offer also carries the number of clients being served.
     '''
     try:
         # create an IPv4, Datagram, UDP socket (AF_INET, SOCK_DGRAM, IPPROTO_UDP)
@@ -33,6 +89,8 @@ def broadcast_offer(udp_port, tcp_port):
         offer_packet = create_offer_packet(udp_port, tcp_port)
         # Broadcast the packet every second
         while True:
+            if advertise_load:
+                offer_packet = create_offer_packet(udp_port, tcp_port, get_active_clients())
             broadcast_socket.sendto(offer_packet, ('255.255.255.255', 13117))
             time.sleep(1)  # Wait for 1 second before broadcasting again
     except Exception as e:
@@ -40,37 +98,216 @@ def broadcast_offer(udp_port, tcp_port):
     
     
     
-def listen_for_udp_requests(udp_socket):
+def listen_for_udp_requests(udp_socket, pool):
     '''
         Handle incoming UDP messages on the given socket.
+        Every request is handed to the given worker pool, requests the pool rejects are dropped.
     '''
     print(f"{bcolors.OKGREEN} Listening for UDP messages... {bcolors.ENDC}")
     while True:
         try:
             # !!! recvfrom is blocking so No Busy Waiting !!!
             message, address = udp_socket.recvfrom(1024)  #recvfrom brings one packet at a time
-            threading.Thread(target=handle_udp_client, args=(message, address), daemon=True).start()
+            # latency probes are echoed right here, waiting for a worker would add to the measured RTT
+            echo = create_probe_echo(message, time.time_ns())
+            if echo is not None:
+                udp_socket.sendto(echo, address)
+                metrics.count('UDP', 'probes')
+                continue
+            if not pool.submit(handle_udp_client, message, address):
+                metrics.count('UDP', 'rejected')
+                log(f"{bcolors.RED}[UDP client {address}] Rejected, server is busy {bcolors.ENDC}")
         except Exception as e:
-            print(f"[ERROR] Error receiving UDP message: {e}")
+            log(f"[ERROR] Error receiving UDP message: {e}")
 
 def handle_udp_client(message, address):
-    file_size = decode_request_packet(message)
-    if file_size is not None:
-        print(f"[UDP client {address}] Received UDP message: {file_size} bytes")
-        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        with udp_socket:
-            number_of_segments = file_size//PAYLOAD_SIZE if file_size % PAYLOAD_SIZE == 0 else file_size//PAYLOAD_SIZE+1
-            # send size message
-            for i in range(number_of_segments):
-                payload_packet = create_payload_packet(number_of_segments, i+1)
-                udp_socket.sendto(payload_packet, address)
-        print(f"[UDP client {address}] sent {file_size} bytes in {number_of_segments} segments")
+    '''
+        Serve the UDP request of a client.
+        Returns:
+            dict: The client's ClientStats.totals(), for a process pool to count, None if the request was illegal.
+    '''
+    request = decode_request_packet(message)
+    if request is not None:
+        target = f"{request.duration_ms} ms" if request.duration_ms else f"{request.file_size} bytes"
+        rate_info = f" at {request.rate_bps} bits/second" if request.rate_bps else ""
+        if request.adaptive:
+            rate_info += " (adaptive)"
+        payload_size = request.payload_size or PAYLOAD_SIZE
+        log(f"[UDP client {address}] Received UDP message: {DIRECTION_NAMES[request.direction]} {target}{rate_info}, "
+            f"{payload_size} byte payloads")
+        udp_socket = create_socket(socket.SOCK_DGRAM)
+        add_active_clients(1)
+        try:
+            with udp_socket, metrics.track('UDP', address, DIRECTION_NAMES[request.direction]) as stats:
+                if request.direction == DIRECTION_DOWNLOAD:
+                    number_of_segments = send_udp_segments(udp_socket, address, request, stats=stats)
+                else:
+                    number_of_segments, meter = serve_udp_upload(udp_socket, address, request, stats)
+                    log(f"[UDP client {address}] received {meter.bytes} bytes in {meter.packets} segments")
+        finally:
+            add_active_clients(-1)
+        if request.direction != DIRECTION_UPLOAD:
+            log(f"[UDP client {address}] sent {number_of_segments * payload_size} bytes in {number_of_segments} segments")
+        return stats.totals()
+
+
+def serve_udp_upload(udp_socket, address, request, stats=None):
+    '''
+        Measure the upload of a request (and send its download too if it is bidirectional).
+        An empty report tells the client which socket to upload to, the final report carries
+        what arrived until the client's stop packet (or until the upload went idle).
+        stats (ClientStats) counts the client's traffic as it goes (optional).
+        Returns:
+            (number_of_segments, meter) (tuple): the segments sent (0 for an upload) and the upload's ReceiveMeter.
+    '''
+    meter = ReceiveMeter()
+    if stats is not None:
+        stats.attach_meter(meter)
+    udp_socket.sendto(create_report_packet(0, 0, 0), address)
+    number_of_segments = 0
+    if request.direction == DIRECTION_BIDIRECTIONAL:
+        # the per-client socket is read by the receiver thread, it tells the sender about the stop
+        # packet and hands the feedback of an adaptive download to the rate controller
+        stopped = threading.Event()
+        _, controller = create_pacer(request.rate_bps, request.adaptive, UDP_PACING_BURST)
+        receiver = threading.Thread(target=receive_udp_upload, args=(udp_socket, meter, request.payload_size or PAYLOAD_SIZE,
+                                                                      stopped, controller), daemon=True)
+        receiver.start()
+        number_of_segments = send_udp_segments(udp_socket, address, request, stopped, controller, stats)
+        receiver.join()
+    else:
+        receive_udp_upload(udp_socket, meter, request.payload_size or PAYLOAD_SIZE)
+    report_packet = create_report_packet(meter.bytes, meter.packets, meter.duration_ns)
+    for _ in range(REPORT_COPIES):
+        udp_socket.sendto(report_packet, address)
+    return number_of_segments, meter
+
+
+def receive_udp_upload(udp_socket, meter, payload_size=PAYLOAD_SIZE, stopped=None, controller=None):
+    '''
+        Receive payload packets on the given per-client socket until the client's stop packet,
+        or until no packet arrived for UPLOAD_IDLE_TIMEOUT seconds.
+        Args:
+            meter (ReceiveMeter): Measures the received payload bytes.
+            payload_size (int): The payload size the client uploads with.
+            stopped (threading.Event): Set when the stop packet arrives (optional).
+            controller (AimdRateController): Gets the feedback packets (optional).
+    '''
+    # one byte more than a payload packet, so an oversized datagram shows up as a wrong length
+    buffer = bytearray(max(64, PAYLOAD_HEADER_SIZE + payload_size + 1))
+    view = memoryview(buffer)
+    udp_socket.settimeout(UPLOAD_IDLE_TIMEOUT)
+    while True:
+        try:
+            nbytes, _ = udp_socket.recvfrom_into(buffer)
+        except socket.timeout:
+            return
+        if decode_payload_header(buffer, nbytes, payload_size) is not None:
+            meter.add(payload_size, time.perf_counter())
+        elif is_stop_packet(view[:nbytes]):
+            if stopped is not None:
+                stopped.set()
+            return
+        elif controller is not None:
+            feedback = decode_feedback_packet(view[:nbytes])
+            if feedback is not None:
+                controller.feedback(*feedback)
+
 
+def send_udp_segments(udp_socket, address, request, stopped=None, controller=None, stats=None):
+    '''
+        Send the payload packets of a request: file_size bytes worth, or for duration_ms when it is set.
+        A time-bounded stream sends total_segments 0 until its last packet, which carries its own
+        segment number as the total. It ends at the deadline or when the client sends a stop packet.
+        An adaptive stream reads the client's feedback between batches and lets an AimdRateController
+        set its rate. Where the kernel supports UDP GSO every batch leaves in a single send.
+        stopped (threading.Event) and controller are given when another thread reads the socket:
+        the stop packet signal and the rate controller that thread feeds.
+        stats (ClientStats) counts the packets sent as they go (optional).
+        Returns:
+            int: The number of segments sent.
+    '''
+    # send the segments in batches built by patching a preallocated template
+    payload_size = request.payload_size or PAYLOAD_SIZE
+    packet_factory = PayloadPacketFactory(payload_size=payload_size)
+    # the kernel splits one send of the whole batch into its packets
+    gso = packet_factory.batch_size > 1 and enable_udp_gso(udp_socket, packet_factory.packet_size)
+    if controller is not None:
+        pacer = controller.pacer
+    else:
+        pacer, controller = create_pacer(request.rate_bps, request.adaptive, UDP_PACING_BURST)
+    batch_size = packet_factory.batch_size
+    if pacer is not None:
+        batch_size = pacer.packets_per_wakeup(packet_factory.packet_size, packet_factory.batch_size)
+    number_of_segments = None
+    if request.duration_ms:
+        deadline = time.perf_counter() + request.duration_ms / 1000
+    else:
+        file_size = request.file_size
+        number_of_segments = file_size//payload_size if file_size % payload_size == 0 else file_size//payload_size+1
+    # the client only talks to us in a time-bounded or adaptive stream
+    listen = number_of_segments is None or controller is not None
+    segment = 1
+    while True:
+        client_stopped = False
+        if listen:
+            client_stopped = stopped.is_set() if stopped is not None else read_client_packets(udp_socket, controller)
+        if controller is not None:
+            batch_size = pacer.packets_per_wakeup(packet_factory.packet_size, packet_factory.batch_size)
+        if number_of_segments is None:
+            if time.perf_counter() >= deadline or client_stopped:
+                send_packets(udp_socket, [packet_factory.packet(segment, segment)], address)
+                if stats is not None:
+                    stats.packets_sent += 1
+                    stats.bytes_sent += payload_size
+                break
+            packets = packet_factory.batch(0, segment, batch_size)
+        else:
+            if segment > number_of_segments:
+                segment = number_of_segments
+                break
+            packets = packet_factory.batch(number_of_segments, segment, min(batch_size, number_of_segments - segment + 1))
+        if pacer is not None:
+            pacer.consume(len(packets) * packet_factory.packet_size)
+        if gso:
+            gso = send_batch(udp_socket, packets, packet_factory.buffer(len(packets)), address, gso)
+            if not gso and stats is not None:
+                stats.send_errors += 1  # the kernel rejected the GSO send
+        else:
+            send_packets(udp_socket, packets, address)
+        if stats is not None:
+            stats.packets_sent += len(packets)
+            stats.bytes_sent += len(packets) * payload_size
+        segment += len(packets)
+    if controller is not None:
+        log(f"[UDP client {address}] {controller.summary()}")
+    return segment
 
 
-def listen_for_tcp_requests(tcp_socket):
+def read_client_packets(udp_socket, controller=None):
+    '''
+        Read, without blocking, what the client sent to the given per-client socket.
+        Feedback packets are handed to the rate controller (if any).
+        Returns:
+            bool: True if the client sent a stop packet.
+    '''
+    while True:
+        try:
+            data, _ = udp_socket.recvfrom(64, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return False
+        if is_stop_packet(data):
+            return True
+        feedback = decode_feedback_packet(data)
+        if feedback is not None and controller is not None:
+            controller.feedback(*feedback)
+
+
+
+def listen_for_tcp_requests(tcp_socket, pool):
     '''
         Handle incoming TCP connections on the given socket.
+        Every connection is handed to the given worker pool, connections the pool rejects are closed.
     '''
     print(f"{bcolors.OKGREEN} Listening for TCP connections...{bcolors.ENDC}")
     tcp_socket.listen()
@@ -78,59 +315,392 @@ def listen_for_tcp_requests(tcp_socket):
         try:
             # !! BLOCKING no busy-waiting !!
             conn, addr = tcp_socket.accept()
-            threading.Thread(target=handle_tcp_client, args=(conn, addr), daemon=True).start()
+            if not pool.submit(handle_tcp_client, conn, addr):
+                metrics.count('TCP', 'rejected')
+                log(f"{bcolors.RED}[TCP CLIENT {addr}] Rejected, server is busy {bcolors.ENDC}")
+                conn.close()
         except Exception as e:
-            print(f"Error handling TCP connection: {e}")
+            log(f"Error handling TCP connection: {e}")
 
 
 def handle_tcp_client(conn, addr):
     '''
         Handle incoming TCP connections on the given socket.
     '''
+    add_active_clients(1)
     try:
-        print(f"[TCP CLIENT {addr}] Accepted TCP connection")
-        with conn:
+        log(f"[TCP CLIENT {addr}] Accepted TCP connection")
+        with conn, metrics.track('TCP', addr) as stats:
             data = b""
             while True:
                 byte = conn.recv(1)
+                if not byte and not data:  # closed without a request, e.g. a client measuring the RTT
+                    return
                 if not byte:  # Client disconnected
                     raise Exception("illegal byte from client")
+                if not data and byte == BINARY_FIRST_BYTE:
+                    # latency probes or a persistent connection instead of a request line
+                    serve_binary_connection(conn, addr, byte, stats)
+                    return
                 if byte == b'\n':  # Stop when newline is found
                     break
                 data += byte
-            file_size = (int)(data.decode('utf-8'))
-            demi_file = ('A'*file_size).encode('utf-8')
-            conn.sendall(demi_file)
-            print(f"[TCP CLIENT {addr}] Sent {file_size} bytes to client")
+            serve_tcp_test(conn, addr, decode_tcp_request(data), stats)
     except Exception as e:
-        print(f"[FROM TCP CLIENT {addr}] Error handling TCP connection: {e}")
+        metrics.count('TCP', 'errors')
+        log(f"[FROM TCP CLIENT {addr}] Error handling TCP connection: {e}")
+    finally:
+        add_active_clients(-1)
+
+
+def serve_tcp_test(conn, addr, request, stats, framed=False):
+    '''
+        Serve one TCP test: the download, the upload and its report, or both at once.
+        A legacy test streams raw bytes and its upload ends when the client shuts down its side,
+        a framed test (of a persistent connection) sends and receives data blocks.
+    '''
+    stats.direction = DIRECTION_NAMES[request.direction]
+    if request.direction == DIRECTION_DOWNLOAD:
+        file_size = send_tcp_download(conn, request, stats, framed)
+        log(f"[TCP CLIENT {addr}] Sent {file_size} bytes to client")
+        return
+    # the report is the last thing we send for an upload
+    meter = ReceiveMeter()
+    stats.attach_meter(meter)
+    if request.direction == DIRECTION_BIDIRECTIONAL:
+        receiver = threading.Thread(target=receive_tcp_upload, args=(conn, meter, framed), daemon=True)
+        receiver.start()
+        file_size = send_tcp_download(conn, request, stats, framed)
+        receiver.join()
+        log(f"[TCP CLIENT {addr}] Sent {file_size} bytes to client")
+    else:
+        receive_tcp_upload(conn, meter, framed)
+    conn.sendall(create_report_packet(meter.bytes, 0, meter.duration_ns))
+    log(f"[TCP CLIENT {addr}] Received {meter.bytes} bytes from client")
+
 
+def receive_tcp_upload(conn, meter, framed=False):
+    '''
+        Receive the upload of a TCP test into the given ReceiveMeter: until the client shuts down its side,
+        or until the end block of a framed test.
+    '''
+    if not framed:
+        receive_all(conn, meter)
+        return
+    _, leftover = receive_blocks(conn, meter)
+    if leftover:
+        raise Exception("data from client after the end of its upload")
+
+
+def serve_binary_connection(conn, addr, first, stats):
+    '''
+        Serve a TCP connection that starts with a binary packet instead of a request line:
+        latency probes, or the test frame of a persistent connection.
+        Args:
+            first (bytes): The first byte, already received.
+    '''
+    frame = bytearray(TEST_FRAME_SIZE)
+    view = memoryview(frame)
+    view[0:1] = first
+    if not receive_frame(conn, view[1:BINARY_HEADER_SIZE]):
+        raise Exception("illegal byte from client")
+    message_type = binary_message_type(frame)
+    if message_type == 0x8:
+        stats.direction = 'probes'
+        probes = echo_tcp_probes(conn, bytes(view[:BINARY_HEADER_SIZE]))
+        metrics.count('TCP', 'probes', probes)
+        log(f"[TCP CLIENT {addr}] Echoed {probes} latency probes")
+    elif message_type == 0x9:
+        if not receive_frame(conn, view[BINARY_HEADER_SIZE:]):
+            raise Exception("the client closed the connection in its test frame")
+        # the end block and the report are small writes, Nagle would hold them back until the client's
+        # delayed ACK of the test's last data (some 40 ms on every test after the first)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tests = serve_tcp_session(conn, addr, view, stats)
+        log(f"[TCP CLIENT {addr}] Served {tests} tests on a persistent connection")
+    else:
+        raise Exception("illegal binary packet from client")
+
+
+def serve_tcp_session(conn, addr, frame, stats):
+    '''
+        Serve the tests of a persistent TCP connection, one after the other, until the client closes it
+        or sends no test frame for SESSION_IDLE_TIMEOUT seconds.
+        Args:
+            frame (memoryview): The first test frame, received; the next ones are received into it.
+        Returns:
+            int: The number of tests served.
+    '''
+    tests = 0
+    while True:
+        request = decode_test_frame(frame)
+        if request is None:
+            raise Exception("illegal test frame from client")
+        serve_tcp_test(conn, addr, request, stats, framed=True)
+        tests += 1
+        conn.settimeout(SESSION_IDLE_TIMEOUT)
+        try:
+            if not receive_frame(conn, frame):
+                return tests
+        except socket.timeout:
+            metrics.count('TCP', 'idle_timeouts')
+            log(f"[TCP CLIENT {addr}] Closing the persistent connection, idle for {SESSION_IDLE_TIMEOUT} seconds")
+            return tests
+        conn.settimeout(None)
+
+
+
+def echo_tcp_probes(conn, prefix=b""):
+    '''
+        Echo the latency probes of a TCP connection until the client closes it.
+        Args:
+            conn (socket.socket): The connected TCP socket.
+            prefix (bytes): The start of the first probe, already received.
+        Returns:
+            int: The number of probes echoed.
+    '''
+    # every probe is answered on its own, not coalesced with the next one
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    buffer = bytearray(PROBE_PACKET_SIZE)
+    view = memoryview(buffer)
+    filled = len(prefix)
+    view[:filled] = prefix
+    probes = 0
+    try:
+        while True:
+            while filled < PROBE_PACKET_SIZE:
+                nbytes = conn.recv_into(view[filled:])
+                if nbytes == 0:
+                    return probes
+                filled += nbytes
+            echo = create_probe_echo(buffer, time.time_ns())
+            if echo is None:
+                raise Exception("illegal probe from client")
+            conn.sendall(echo)
+            probes += 1
+            filled = 0
+    except ConnectionResetError:
+        return probes
+
+
+def send_tcp_download(conn, request, stats=None, framed=False):
+    '''
+        Send the download of a TCP request: file_size bytes, or for duration_ms when it is set.
+        A framed download (of a persistent connection) is sent as data blocks and ends with the end block.
+        stats (ClientStats) counts the bytes sent as they go (optional).
+        Returns:
+            int: The number of bytes sent.
+    '''
+    if framed:
+        if request.duration_ms:
+            return send_blocks_until(conn, time.perf_counter() + request.duration_ms / 1000, stats)
+        send_blocks(conn, request.file_size, stats)
+        return request.file_size
+    if request.duration_ms:
+        # stream until the deadline, or until the client closes the connection
+        return send_pattern_until(conn, time.perf_counter() + request.duration_ms / 1000, stats)
+    # stream the demi file in chunks instead of building it in memory
+    send_pattern(conn, request.file_size, stats)
+    return request.file_size
+
+
+
+def start_stats_endpoint(port):
+    '''
+        Serve this process's metrics on the given local port, the server runs on without them if the port is taken.
+    '''
+    try:
+        server = start_stats_server(port)
+        print(f"Serving live stats on http://{server.server_address[0]}:{server.server_address[1]}/stats")
+    except OSError as e:
+        print(f"{bcolors.RED}[ERROR] Can't serve stats on port {port}: {e} {bcolors.ENDC}")
+
+
+def print_pool_stats(pools):
+    '''
+        Print one line of queue-depth and admission stats per worker pool.
+    '''
+    for pool in pools:
+        stats = pool.stats()
+        log(f"[STATS {stats['name']}] workers: {stats['workers']}, active: {stats['active']}, queued: {stats['queued']}, "
+              f"completed: {stats['completed']}, rejected: {stats['rejected']}")
+
+
+def print_tuning(profile, sock):
+    '''
+        Print the tuning profile and the values the kernel applied to the given socket.
+    '''
+    tuning = socket_tuning(sock)
+    print(f"Tuning profile {profile}: " + ", ".join(f"{name} {value}" for name, value in tuning.items() if value is not None))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Speed test server.")
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads',
+                        help="threads: worker pools of blocking sockets, asyncio: one event loop for all clients (default: threads)")
+    parser.add_argument('--max-clients', type=int, default=1024,
+                        help="asyncio engine only: concurrent clients per protocol before new ones are rejected (default: 1024)")
+    parser.add_argument('--workers', type=int, default=16,
+                        help="number of worker threads for each protocol (default: 16)")
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help="number of requests that may wait for a worker before new ones are rejected (default: 64)")
+    parser.add_argument('--udp-processes', type=int, default=0,
+                        help="serve UDP requests from a pool of this many processes instead of threads (default: 0 = threads)")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="number of worker processes sharing the server's ports, to use more than one core (default: 1)")
+    parser.add_argument('--advertise-load', action='store_true',
+                        help="append the number of clients being served to the offer packet, for clients choosing a server by load")
+    parser.add_argument('--udp-port', type=int, default=0, help="UDP port to listen on (default: 0 = any available)")
+    parser.add_argument('--tcp-port', type=int, default=0, help="TCP port to listen on (default: 0 = any available)")
+    parser.add_argument('--no-broadcast', action='store_true',
+                        help="don't broadcast offers, for clients that are given the ports (e.g. the benchmarks)")
+    parser.add_argument('--tuning', choices=tuple(TUNING_PROFILES), default='default',
+                        help="socket tuning profile: OS defaults, large buffers for high bandwidth-delay paths, or low latency (default: default)")
+    parser.add_argument('--stats-port', type=int,
+                        help="serve live stats as JSON on http://127.0.0.1:PORT/stats (with --processes, worker i uses PORT + i)")
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help="print worker pool stats every this many seconds (default: 0 = never)")
+    args = parser.parse_args()
+    if (args.udp_processes > 0 or args.processes > 1) and not fork_available():
+        parser.error("--udp-processes and --processes need the fork start method, which this platform doesn't have")
+    return args
+
+
+def serve_threads(udp_socket, tcp_socket, args, name=""):
+    '''
+        Serve clients on the given sockets from worker pools of blocking sockets.
+        Never returns, the pools are shut down when the server is interrupted.
+    '''
+    if args.udp_processes > 0:
+        udp_pool = ProcessWorkerPool(f"UDP{name}", 'UDP', args.udp_processes, args.queue_size)
+    else:
+        udp_pool = WorkerPool(f"UDP{name}", 'UDP', args.workers, args.queue_size)
+    tcp_pool = WorkerPool(f"TCP{name}", 'TCP', args.workers, args.queue_size)
+    metrics.add_source('pools', lambda: [udp_pool.stats(), tcp_pool.stats()])
+    udp_handling_thread = threading.Thread(target=listen_for_udp_requests, args=(udp_socket, udp_pool), daemon=True)
+    udp_handling_thread.start()
+    tcp_handling_thread = threading.Thread(target=listen_for_tcp_requests, args=(tcp_socket, tcp_pool), daemon=True)
+    tcp_handling_thread.start()
+    # Keep the server running, until it is interrupted
+    last_stats = time.monotonic()
+    try:
+        while True:
+            time.sleep(1)
+            if args.stats_interval > 0 and time.monotonic() - last_stats >= args.stats_interval:
+                print_pool_stats((udp_pool, tcp_pool))
+                last_stats = time.monotonic()
+    finally:
+        udp_pool.shutdown()
+        tcp_pool.shutdown()
+
+
+def serve_worker(udp_socket, tcp_socket, args, index, master_pid):
+    '''
+        Entry point of a forked worker process.
+        The worker serves the listening sockets it inherited from the master, so the kernel
+        spreads requests and connections between all the workers on the same ports.
+        It is terminated (like the master, see interrupt_on_sigterm) when the master dies.
+    '''
+    try:
+        exit_with_parent(master_pid)
+        if args.stats_port is not None:
+            start_stats_endpoint(args.stats_port + index)
+        if args.engine == 'asyncio':
+            AsyncServer.run(udp_socket, tcp_socket, args.max_clients, broadcast=False)
+        else:
+            serve_threads(udp_socket, tcp_socket, args, name=f"-{index}")
+    except KeyboardInterrupt:
+        pass  # the master reports the interrupt
+
+
+def start_workers(udp_socket, tcp_socket, args):
+    '''
+        Fork args.processes worker processes sharing the given sockets.
+        Returns:
+            workers (list): The started multiprocessing.Process objects.
+        Notes:
+            Must be called before the master starts any thread, forking a threaded process is unsafe.
+    '''
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for i in range(args.processes):
+        worker = context.Process(target=serve_worker, args=(udp_socket, tcp_socket, args, i, os.getpid()),
+                                 name=f"worker-{i}")
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def stop_workers(workers):
+    '''
+        Terminate the worker processes and wait for them, killing the ones that don't exit in WORKER_EXIT_TIMEOUT seconds.
+    '''
+    for worker in workers:
+        worker.terminate()
+    deadline = time.monotonic() + WORKER_EXIT_TIMEOUT
+    for worker in workers:
+        worker.join(max(0, deadline - time.monotonic()))
+        if worker.is_alive():
+            worker.kill()
+            worker.join()
+
+
+def interrupt_on_sigterm():
+    '''
+        Handle SIGTERM like Ctrl-C (SIGINT), so that a terminated server cleans up like an interrupted one:
+        the worker processes and the process pools are stopped instead of left serving the ports.
+    '''
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, interrupt)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
 
 
 # Main function to start the server
 def main():
+    args = parse_args()
+    workers = []
+    interrupt_on_sigterm()
     try:
         print(f" {bcolors.UNDERLINE}{bcolors.HEADER} Server started. Listening on IP address {get_local_ip()}. {bcolors.ENDC}")
-        udp_socket = get_udp_socket()
-        tcp_socket = get_tcp_socket()
+        set_tuning_profile(args.tuning)
+        udp_socket = get_udp_socket(args.udp_port)
+        tcp_socket = get_tcp_socket(args.tcp_port)
         print(f"Selected UDP Port: {udp_socket.getsockname()[1]}")
         print(f"Selected TCP Port: {tcp_socket.getsockname()[1]}")
-        # Create and start a thread for broadcasting. daemon = True to stop the thread when the main thread stops
-        broadcast_thread = threading.Thread(target=broadcast_offer, args=(udp_socket.getsockname()[1], tcp_socket.getsockname()[1]), daemon=True)
-        broadcast_thread.start()
-        udp_handling_thread = threading.Thread(target=listen_for_udp_requests, args=(udp_socket,), daemon=True)
-        udp_handling_thread.start()
-        tcp_handling_thread = threading.Thread(target=listen_for_tcp_requests, args=(tcp_socket,), daemon=True)
-        tcp_handling_thread.start()
-        # Keep the server running
-        while True:
-            time.sleep(1)  
+        print_tuning(args.tuning, tcp_socket)
+        if args.processes > 1:
+            # the workers serve the clients, the master only advertises the one port pair
+            tcp_socket.listen()
+            workers = start_workers(udp_socket, tcp_socket, args)
+            print(f"Started {len(workers)} worker processes")
+            if args.no_broadcast:
+                for worker in workers:
+                    worker.join()
+            else:
+                broadcast_offer(udp_socket.getsockname()[1], tcp_socket.getsockname()[1], args.advertise_load)
+        elif args.engine == 'asyncio':
+            if args.stats_port is not None:
+                start_stats_endpoint(args.stats_port)
+            # the event loop broadcasts the offer and serves everyone, blocks until interrupted
+            AsyncServer.run(udp_socket, tcp_socket, args.max_clients, broadcast=not args.no_broadcast,
+                            advertise_load=args.advertise_load)
+        else:
+            if args.stats_port is not None:
+                start_stats_endpoint(args.stats_port)
+            if not args.no_broadcast:
+                # Create and start a thread for broadcasting. daemon = True to stop the thread when the main thread stops
+                broadcast_thread = threading.Thread(target=broadcast_offer, args=(udp_socket.getsockname()[1], tcp_socket.getsockname()[1], args.advertise_load), daemon=True)
+                broadcast_thread.start()
+            serve_threads(udp_socket, tcp_socket, args)
 
     except Exception as e:
         print(f"\n{bcolors.RED} [ERROR] Server shutting down. {bcolors.ENDC}")
         print(f"\n{bcolors.RED} [CAUSE] {bcolors.ENDC} {e}")
     except KeyboardInterrupt as e:
-        print(f"\n{bcolors.RED} [QUIT] Server got KeyboardInterrupted. {bcolors.ENDC}")
+        print(f"\n{bcolors.RED} [QUIT] Server got interrupted. {bcolors.ENDC}")
+    finally:
+        stop_workers(workers)
 
     
     
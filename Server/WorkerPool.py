@@ -0,0 +1,169 @@
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from Helpers import exit_with_parent
+from Helpers import release_inherited_sockets
+from Metrics import metrics
+from Metrics import log
+
+
+
+class WorkerPool:
+    '''
+        A fixed number of worker threads fed by a bounded queue.
+        submit() never blocks: when the queue is full the task is rejected, so a burst
+        of clients turns into rejections instead of hundreds of threads fighting for the GIL.
+    '''
+
+    def __init__(self, name, protocol, workers, queue_size):
+        '''
+            Args:
+                name (str): The name of the pool, used in thread names and stats.
+                protocol (str): 'UDP' or 'TCP', the metrics protocol its failed tasks are counted as errors of.
+                workers (int): The number of worker threads.
+                queue_size (int): The maximal number of tasks waiting for a worker.
+        '''
+        self.name = name
+        self.protocol = protocol
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._completed = 0
+        self._rejected = 0
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"{name}-worker-{i}", daemon=True).start()
+
+    def submit(self, task, *args):
+        '''
+            Queue task(*args) for a worker.
+            Returns:
+                bool: True if the task was accepted, False if it was rejected (queue full).
+        '''
+        try:
+            self._queue.put_nowait((task, args))
+            return True
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+    def _work(self):
+        while True:
+            # !! BLOCKING no busy-waiting !!
+            task, args = self._queue.get()
+            with self._lock:
+                self._active += 1
+            try:
+                task(*args)
+            except Exception as e:
+                metrics.count(self.protocol, 'errors')
+                log(f"[ERROR] [{self.name}] task failed: {e}")
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+
+    def stats(self):
+        '''
+            Returns:
+                dict: name, workers, active, queued, completed and rejected task counts.
+        '''
+        with self._lock:
+            return {'name': self.name, 'workers': self.workers, 'active': self._active,
+                    'queued': self._queue.qsize(), 'completed': self._completed, 'rejected': self._rejected}
+
+    def shutdown(self):
+        '''
+            Nothing to stop, the worker threads are daemons and end with the process.
+        '''
+
+
+
+def fork_available():
+    '''
+        Returns:
+            bool: Whether this platform can fork worker processes (ProcessWorkerPool and the server's --processes).
+    '''
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+
+class ProcessWorkerPool:
+    '''
+        Same interface as WorkerPool, backed by a process pool.
+        Meant for CPU-heavy work (UDP packet generation) that would otherwise be
+        serialized by the GIL. Tasks and their arguments must be picklable.
+        Needs the fork start method (not on Windows), see fork_available.
+        The worker processes are forked on the first task, they let go of every socket they
+        inherited and terminate when the process that created the pool dies.
+        A worker process counts into a metrics registry of its own, so a task returns the
+        ClientStats.totals() of the client it served (or None) and they are added to this process's.
+    '''
+
+    def __init__(self, name, protocol, workers, queue_size):
+        self.name = name
+        self.protocol = protocol
+        self.workers = workers
+        # forked, the tasks are functions of the server's __main__ module that a spawned process couldn't import
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                             initializer=_init_worker_process, initargs=(os.getpid(),))
+        # admission control: at most workers + queue_size tasks in flight
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._closed = False
+
+    def submit(self, task, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            return False
+        with self._lock:
+            self._in_flight += 1
+        self._executor.submit(task, *args).add_done_callback(self._done)
+        return True
+
+    def _done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+        self._slots.release()
+        if self._closed or future.cancelled():
+            return
+        if future.exception() is not None:
+            # counted here, a worker process counts into a registry of its own
+            metrics.count(self.protocol, 'errors')
+            log(f"[ERROR] [{self.name}] task failed: {future.exception()}")
+        elif future.result() is not None:
+            metrics.add_client(self.protocol, future.result())
+
+    def stats(self):
+        with self._lock:
+            active = min(self._in_flight, self.workers)
+            return {'name': self.name, 'workers': self.workers, 'active': active,
+                    'queued': self._in_flight - active, 'completed': self._completed, 'rejected': self._rejected}
+
+    def shutdown(self):
+        '''
+            Stop the worker processes, the tasks they are running are cut short and the queued ones cancelled.
+        '''
+        self._closed = True
+        # the executor has no public way to stop a running task
+        for process in list((self._executor._processes or {}).values()):
+            process.terminate()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+
+def _init_worker_process(parent_pid):
+    # the worker only computes and sends from sockets of its own
+    release_inherited_sockets()
+    # terminate() must stop a running task, not interrupt it like the server's handler does
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    exit_with_parent(parent_pid)